@@ -1,3 +1,4 @@
+import os
 from datetime import date, time
 
 import pytest
@@ -48,6 +49,7 @@ def test_delay_args(delay_parser):
     assert args.out == 'test/scenario_1/'
     assert args.download_only is False
     assert args.verbose == 1
+    assert args.cpus == os.cpu_count()
 
 
 def test_delay_los_mutually_exclusive(delay_parser):
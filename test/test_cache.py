@@ -0,0 +1,455 @@
+import datetime
+import multiprocessing as mp
+import os
+import sqlite3
+import time
+from test import pushd
+
+import h5py
+import numpy as np
+import pytest
+from pyproj import CRS
+
+import RAiDER.delay
+from RAiDER.cache import WeatherModelCache, make_cache_key
+from RAiDER.constants import Zenith
+from RAiDER.models.weatherModel import WeatherModel
+from RAiDER.processWM import (
+    cropWeatherModelFile, fetchWeatherModel, interpolateWeatherModelFilesInTime,
+    readWeatherModelFile
+)
+
+
+_TIME = datetime.datetime(2020, 1, 1, 12)
+
+
+def _make_file(path, nbytes):
+    with open(path, 'wb') as f:
+        f.write(b'\0' * nbytes)
+    return str(path)
+
+
+def _add_entry(args):
+    cache_dir, i = args
+    cache = WeatherModelCache(cache_dir)
+    key = make_cache_key('raw', 'ERA5', _TIME + datetime.timedelta(hours=i))
+    cache.add(key, _make_file(os.path.join(cache_dir, 'f{}.nc'.format(i)), 10), 'raw')
+    return cache.lookup(key) is not None
+
+
+def test_make_cache_key():
+    key = make_cache_key('processed', 'ERA5', _TIME, (10, 20, 30, 40))
+    assert key == make_cache_key('processed', 'ERA5', _TIME, [10., 20., 30., 40.])
+    assert key != make_cache_key('raw', 'ERA5', _TIME, (10, 20, 30, 40))
+    assert key != make_cache_key('processed', 'HRRR', _TIME, (10, 20, 30, 40))
+    assert key != make_cache_key('processed', 'ERA5', _TIME, (10, 20, 30, 41))
+    assert key != make_cache_key(
+        'processed', 'ERA5', _TIME + datetime.timedelta(hours=1), (10, 20, 30, 40)
+    )
+
+
+def test_lookup_and_evict(tmp_path):
+    cache = WeatherModelCache(str(tmp_path))
+    keys = [make_cache_key('raw', 'ERA5', _TIME + datetime.timedelta(hours=i)) for i in range(3)]
+    paths = [_make_file(tmp_path / 'f{}.nc'.format(i), 100) for i in range(3)]
+    for key, path in zip(keys, paths):
+        cache.add(key, path, 'raw', 'ERA5', _TIME)
+        time.sleep(0.01)
+
+    assert cache.lookup(make_cache_key('raw', 'ERA5', _TIME, (0, 1, 2, 3))) is None
+    assert cache.stats()['size'] == 300
+
+    # Using the oldest file makes the second one the least recently used
+    assert cache.lookup(keys[0]) == os.path.abspath(paths[0])
+    cache.set_max_size(250)
+    new_key = make_cache_key('processed', 'ERA5', _TIME, (0, 1, 2, 3))
+    cache.add(new_key, _make_file(tmp_path / 'new.h5', 100), 'processed', 'ERA5', _TIME, (0, 1, 2, 3))
+
+    assert not os.path.exists(paths[1])
+    assert not os.path.exists(paths[2])
+    assert os.path.exists(paths[0])
+    stats = WeatherModelCache(str(tmp_path)).stats()
+    assert stats['size'] == 200
+    assert stats['max_size'] == 250
+    assert stats['kinds']['raw']['count'] == 1
+    assert stats['kinds']['processed']['count'] == 1
+
+    # Files removed behind the cache's back are dropped from the index
+    os.remove(paths[0])
+    assert cache.lookup(keys[0]) is None
+    assert cache.stats()['count'] == 1
+
+    assert cache.clear() == 100
+    assert cache.stats()['count'] == 0
+
+
+def test_evict_skips_locked(tmp_path):
+    cache = WeatherModelCache(str(tmp_path))
+    keys = [make_cache_key('raw', 'ERA5', _TIME + datetime.timedelta(hours=i)) for i in range(3)]
+    paths = [_make_file(tmp_path / 'f{}.nc'.format(i), 100) for i in range(3)]
+    for key, path in zip(keys, paths):
+        cache.add(key, path, 'raw', 'ERA5', _TIME)
+
+    # A file being written and one being read are not evicted
+    with cache.lock(keys[0]), cache.use(lambda: paths[1]) as path:
+        assert path == paths[1]
+        assert cache.evict(max_size=0) == 100
+        assert [os.path.exists(p) for p in paths] == [True, True, False]
+    assert cache.evict(max_size=0) == 200
+    assert cache.stats()['count'] == 0
+
+
+def test_use_evicted(tmp_path):
+    cache = WeatherModelCache(str(tmp_path))
+    key = make_cache_key('raw', 'ERA5', _TIME)
+    calls = []
+
+    def get_file():
+        path = _make_file(tmp_path / 'f.nc', 100)
+        cache.add(key, path, 'raw', 'ERA5', _TIME)
+        if not calls:
+            # evicted by another process before it could be locked
+            cache.evict(max_size=0)
+        calls.append(path)
+        return path
+
+    with cache.use(get_file) as path:
+        assert os.path.exists(path)
+        assert cache.evict(max_size=0) == 0
+    assert len(calls) == 2
+
+    # Files outside of the cache are not locked
+    with cache.use(lambda: None) as path:
+        assert path is None
+
+
+def test_concurrent_access(tmp_path):
+    WeatherModelCache(str(tmp_path))
+    with mp.Pool(4) as pool:
+        assert all(pool.map(_add_entry, [(str(tmp_path), i) for i in range(20)]))
+    assert WeatherModelCache(str(tmp_path)).stats()['count'] == 20
+
+
+class _CountingModel(object):
+    def __init__(self, fail=False, write=True):
+        self.calls = 0
+        self.fail = fail
+        self.write = write
+
+    def Model(self):
+        return 'FAKE'
+
+    def fetch(self, lats, lons, time, out):
+        self.calls += 1
+        if self.write:
+            with open(out, 'w') as f:
+                f.write('partial')
+        if self.fail:
+            raise RuntimeError('Lost connection')
+
+
+def test_fetchWeatherModel(tmp_path):
+    wmLoc = str(tmp_path / 'weather_files')
+    model = _CountingModel()
+    with pushd(str(tmp_path)):
+        f = fetchWeatherModel(model, None, None, _TIME, wmLoc)
+        assert fetchWeatherModel(model, None, None, _TIME, wmLoc) == f
+    assert model.calls == 1
+    assert WeatherModelCache(wmLoc).lookup(make_cache_key('raw', 'FAKE', _TIME)) == os.path.abspath(f)
+
+    failing = _CountingModel(fail=True)
+    with pushd(str(tmp_path)), pytest.raises(RuntimeError):
+        fetchWeatherModel(failing, None, None, _TIME + datetime.timedelta(hours=1), wmLoc)
+    assert sorted(os.listdir(wmLoc)) == ['.locks', os.path.basename(f), 'raider_cache.sqlite']
+
+    # Models read over OpenDAP download no file and fetch again every time
+    opendap = _CountingModel(write=False)
+    with pushd(str(tmp_path)):
+        assert fetchWeatherModel(opendap, None, None, _TIME, wmLoc + '_opendap') is None
+        with WeatherModelCache(wmLoc + '_opendap').use(
+            lambda: fetchWeatherModel(opendap, None, None, _TIME, wmLoc + '_opendap')
+        ) as f:
+            assert f is None
+    assert opendap.calls == 2
+    assert WeatherModelCache(wmLoc + '_opendap').stats()['count'] == 0
+
+
+def _write_processed(filename, zs=np.arange(0., 5000., 1000.), offset=0, latlon_3d=False):
+    '''
+    Write a small processed weather model laid out like write2HDF5, or like
+    older files with 3D lats and lons if latlon_3d
+    '''
+    ys = np.arange(0., 11.)
+    xs = np.arange(20., 36.)
+    lons, lats, _ = np.meshgrid(xs, ys, zs)
+    wet = lats * 100 + lons + zs / 1e4 + offset
+    if not latlon_3d:
+        lons, lats = lons[..., 0], lats[..., 0]
+    with h5py.File(filename, 'w') as f:
+        for name, data in (('x', xs), ('y', ys), ('z', zs)):
+            f.create_dataset(name, data=data).make_scale(name)
+        for name, data in (('lat', lats), ('lon', lons), ('wet', wet), ('hydro', 2 * wet)):
+            f.create_dataset(name, data=data)
+        f.create_dataset('Projection', data='{"proj": "latlon"}')
+    return wet
+
+
+def test_crop_superset(tmp_path):
+    big_bounds = (0, 10, 20, 35)
+    big_file = str(tmp_path / 'big.h5')
+    wet = _write_processed(big_file)
+    cache = WeatherModelCache(str(tmp_path))
+    cache.add(
+        make_cache_key('processed', 'ERA5', _TIME, big_bounds), big_file,
+        'processed', 'ERA5', _TIME, big_bounds
+    )
+
+    small_bounds = (4.5, 6, 25, 30)
+    assert cache.find_superset('processed', 'ERA5', _TIME, (4.5, 11, 25, 30)) is None
+    assert cache.find_superset('processed', 'HRRR', _TIME, small_bounds) is None
+    assert cache.find_superset(
+        'processed', 'ERA5', _TIME + datetime.timedelta(hours=1), small_bounds
+    ) is None
+    superset = cache.find_superset('processed', 'ERA5', _TIME, small_bounds)
+    assert superset == os.path.abspath(big_file)
+
+    small_file = str(tmp_path / 'small.h5')
+    cropWeatherModelFile(superset, small_file, small_bounds)
+    with h5py.File(small_file, 'r') as f:
+        # rows 5-6 and columns 25-30 plus two cells on each side
+        assert np.allclose(f['y'][()], np.arange(3., 9.))
+        assert np.allclose(f['x'][()], np.arange(23., 33.))
+        assert np.allclose(f['z'][()], np.arange(0., 5000., 1000.))
+        assert np.allclose(f['wet'][()], wet[3:9, 3:13, :])
+        assert np.allclose(f['hydro'][()], 2 * wet[3:9, 3:13, :])
+        assert np.allclose(f['lat'][:, 0], np.arange(3., 9.))
+        assert f['Projection'][()] == b'{"proj": "latlon"}'
+
+    with pytest.raises(RuntimeError):
+        cropWeatherModelFile(superset, small_file, (50, 60, 0, 10))
+
+
+def test_find_superset_zref(tmp_path):
+    bounds = (0, 10, 20, 35)
+    cache = WeatherModelCache(str(tmp_path))
+    for zref, nbytes in ((10000, 100), (15000, 200)):
+        cache.add(
+            make_cache_key('processed', 'ERA5', _TIME, bounds + (zref,)),
+            _make_file(tmp_path / '{}.h5'.format(zref), nbytes),
+            'processed', 'ERA5', _TIME, bounds, zref=zref, los='zenith'
+        )
+
+    # Files integrated below zref are not re-used
+    small_bounds = (4.5, 6, 25, 30)
+    expected = {8000: '10000.h5', 10000: '10000.h5', 12000: '15000.h5', 15000: '15000.h5'}
+    for zref, name in expected.items():
+        superset = cache.find_superset(
+            'processed', 'ERA5', _TIME, small_bounds, zref=zref, los='zenith'
+        )
+        assert superset == os.path.abspath(str(tmp_path / name))
+    assert cache.find_superset('processed', 'ERA5', _TIME, small_bounds, zref=20000) is None
+    assert cache.find_superset('processed', 'ERA5', _TIME, small_bounds, los='sv:orbit.txt') is None
+
+
+def test_cache_schema_upgrade(tmp_path):
+    # An index written before the zref and los columns existed
+    con = sqlite3.connect(str(tmp_path / 'raider_cache.sqlite'))
+    con.execute(
+        'CREATE TABLE entries (key TEXT PRIMARY KEY, path TEXT NOT NULL, kind TEXT NOT NULL, '
+        'model TEXT, time TEXT, south REAL, north REAL, west REAL, east REAL, '
+        'size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)'
+    )
+    con.execute(
+        "INSERT INTO entries VALUES ('old', ?, 'processed', 'ERA5', ?, 0, 10, 20, 35, 10, 0, 0)",
+        (_make_file(tmp_path / 'old.h5', 10), _TIME.strftime('%Y-%m-%dT%H:%M:%S'))
+    )
+    con.commit()
+    con.close()
+
+    cache = WeatherModelCache(str(tmp_path))
+    assert cache.lookup('old') is not None
+    assert cache.find_superset('processed', 'ERA5', _TIME, (1, 2, 25, 30)) is not None
+    # but it is not known what the old file was integrated up to
+    assert cache.find_superset('processed', 'ERA5', _TIME, (1, 2, 25, 30), zref=15000) is None
+
+
+def test_crop_latlon_3d(tmp_path):
+    big_file, small_file = str(tmp_path / 'big.h5'), str(tmp_path / 'small.h5')
+    wet = _write_processed(big_file, latlon_3d=True)
+
+    cropWeatherModelFile(big_file, small_file, (4.5, 6, 25, 30))
+    with h5py.File(small_file, 'r') as f:
+        assert np.allclose(f['wet'][()], wet[3:9, 3:13, :])
+        assert np.allclose(f['lat'][:, 0, 0], np.arange(3., 9.))
+
+
+def test_read_weather_model_window(tmp_path):
+    big_file, small_file = str(tmp_path / 'big.h5'), str(tmp_path / 'small.h5')
+    wet = _write_processed(big_file)
+
+    xs, ys, z, data = readWeatherModelFile(big_file, ('x', 'y', 'z', 'wet'), ll_bounds=(4.5, 6, 25, 30))
+    assert np.allclose(ys, np.arange(3., 9.))
+    assert np.allclose(xs, np.arange(23., 33.))
+    assert np.allclose(z, np.arange(0., 5000., 1000.))
+    assert np.allclose(data, wet[3:9, 3:13, :])
+
+    # outside of the grid everything is read
+    data, = readWeatherModelFile(big_file, ('wet',), ll_bounds=(50, 60, 0, 10))
+    assert np.allclose(data, wet)
+
+    # files written from others are chunked and compressed
+    cropWeatherModelFile(big_file, small_file, (0, 10, 20, 35))
+    with h5py.File(small_file, 'r') as f:
+        assert f['wet'].chunks == (11, 16, 5)
+        assert f['wet'].compression == 'lzf'
+        assert f['x'].chunks is None
+
+
+class _ProcessedModel(object):
+    def write2HDF5(self, filename):
+        _write_processed(filename)
+
+
+def test_full_weather_model_shared(tmp_path, monkeypatch):
+    calls = []
+
+    def prepare(weather_model, wmLoc, out, crop=True, **kwargs):
+        calls.append(crop)
+        return _ProcessedModel(), None, None
+
+    monkeypatch.setattr(RAiDER.delay, 'prepareWeatherModel', prepare)
+    wmLoc = str(tmp_path)
+    weather_model = {'name': 'ERA5', 'type': None, 'files': None}
+
+    # Two areas of interest share one processed model for the date
+    files = [
+        RAiDER.delay.getWeatherModelFile(
+            weather_model, wmLoc, wmLoc, None, None, bounds, Zenith, None, _TIME,
+            full_model=True
+        ) for bounds in ((1, 3, 22, 25), (4.5, 6, 25, 30))
+    ]
+    assert calls == [False]
+    with h5py.File(files[1], 'r') as f:
+        assert np.allclose(f['y'][()], np.arange(3., 9.))
+        assert np.allclose(f['x'][()], np.arange(23., 33.))
+
+    # Areas outside of the raw model and orbit-dependent delays are processed
+    # for their own area
+    RAiDER.delay.getWeatherModelFile(
+        weather_model, wmLoc, wmLoc, None, None, (20, 30, 22, 25), Zenith, None, _TIME,
+        full_model=True
+    )
+    RAiDER.delay.getWeatherModelFile(
+        weather_model, wmLoc, wmLoc, None, None, (0, 1, 50, 51), ('sv', 'orbit.txt'), None,
+        _TIME + datetime.timedelta(hours=1), full_model=True
+    )
+    assert calls == [False, True, True]
+
+    # Without full_model, areas that no cached model covers are processed
+    # for their own area
+    RAiDER.delay.getWeatherModelFile(
+        weather_model, wmLoc, wmLoc, None, None, (0, 1, 50, 51), Zenith, None,
+        _TIME + datetime.timedelta(hours=2)
+    )
+    assert calls == [False, True, True, True]
+
+
+class _GridModel(WeatherModel):
+    '''
+    Weather model on a small lat/lon grid, whose fetch stores the area of
+    interest like models that only download part of their grid
+    '''
+    def __init__(self, lats=np.arange(0., 21.), lons=np.arange(20., 51.)):
+        super().__init__()
+        self._grid = (lats, lons)
+        self._Name = 'GRID'
+        self._k1, self._k2, self._k3 = 0.776, 0.233, 3.75e3
+        self._lat_res = self._lon_res = 1.
+        self._valid_range = (datetime.datetime(1950, 1, 1), 'Present')
+        self._proj = CRS.from_epsg(4326)
+
+    def _fetch(self, lats, lons, time, out):
+        self._bounds = self._get_ll_bounds(lats, lons)
+        with open(out, 'w') as f:
+            f.write('grid')
+
+    def load_weather(self, filename):
+        lats, lons, zs = np.meshgrid(*self._grid, np.linspace(0., 20000., 15), indexing='ij')
+        self._lats, self._lons, self._ys, self._xs = lats, lons, lats, lons
+        self._zs = zs
+        self._p = 1e5 * np.exp(-zs / 8000)
+        self._t = 288. - 6.5e-3 * np.minimum(zs, 11000)
+        self._q = 1e-2 * np.exp(-zs / 2000)
+
+
+def test_full_weather_model_load(tmp_path):
+    wmLoc = str(tmp_path / 'weather_files')
+    model = _GridModel()
+    weather_model = {'name': 'GRID', 'type': model, 'files': None}
+    areas = [(1, 3, 22, 25), (15, 18, 40, 45)]
+    with pushd(str(tmp_path)):
+        for bounds in areas:
+            lats, lons = np.meshgrid(np.linspace(*bounds[:2], 3), np.linspace(*bounds[2:], 3))
+            RAiDER.delay.getWeatherModelFile(
+                weather_model, wmLoc, wmLoc, lats, lons, bounds, Zenith, None, _TIME,
+                full_model=True
+            )
+
+    # The full model covers the whole grid, although the fetch stored the
+    # first area of interest, and the second area is cropped from it
+    cache = WeatherModelCache(wmLoc)
+    entries = cache.entries('processed')
+    assert len(entries) == 3
+    full_file = cache.lookup(make_cache_key('processed', 'GRID', _TIME))
+    with h5py.File(full_file, 'r') as f:
+        assert f['lat'].shape == (21, 31)
+    assert model._bounds is None
+
+
+def test_small_area_cropped(tmp_path):
+    # A raw model with the extent of HRRR, and an area of interest of a few
+    # grid cells
+    model = _GridModel(np.arange(21., 53.5, 0.5), np.arange(-135., -59.5, 0.5))
+    weather_model = {'name': 'GRID', 'type': model, 'files': None}
+    wmLoc = str(tmp_path / 'weather_files')
+    bounds = (35, 36, -118, -117)
+    lats, lons = np.meshgrid(np.linspace(*bounds[:2], 3), np.linspace(*bounds[2:], 3))
+    with pushd(str(tmp_path)):
+        wm_file = RAiDER.delay.getWeatherModelFile(
+            weather_model, wmLoc, wmLoc, lats, lons, bounds, Zenith, None, _TIME
+        )
+
+    # Only the area of interest plus a buffer is processed
+    cache = WeatherModelCache(wmLoc)
+    assert cache.lookup(make_cache_key('processed', 'GRID', _TIME)) is None
+    assert len(cache.entries('processed')) == 1
+    with h5py.File(wm_file, 'r') as f:
+        assert f['lat'].shape[0] < 15 and f['lat'].shape[1] < 15
+
+
+def test_interpolate_in_time(tmp_path):
+    file1, file2, out_file = [str(tmp_path / n) for n in ('t1.h5', 't2.h5', 'out.h5')]
+    wet1 = _write_processed(file1)
+    wet2 = _write_processed(file2, offset=10)
+
+    interpolateWeatherModelFilesInTime(file1, file2, 0.25, out_file)
+    with h5py.File(out_file, 'r') as f:
+        assert np.allclose(f['wet'][()], wet1 + 2.5)
+        assert np.allclose(f['hydro'][()], 2 * wet1 + 5)
+        assert np.allclose(f['lat'][()], np.broadcast_to(np.arange(0., 11.)[:, None], wet1.shape[:2]))
+        assert np.allclose(f['z'][()], np.arange(0., 5000., 1000.))
+
+    # The second epoch has different height levels; it is resampled to the
+    # levels of the first, and its values are not used outside its levels
+    _write_processed(file2, zs=np.arange(500., 5500., 1000.), offset=10)
+    interpolateWeatherModelFilesInTime(file1, file2, 0.5, out_file)
+    with h5py.File(out_file, 'r') as f:
+        wet = f['wet'][()]
+    assert np.allclose(wet[..., 0], wet1[..., 0])
+    assert np.allclose(wet[..., 1:], wet1[..., 1:] + 5)
+
+    _write_processed(file2, zs=np.arange(0., 5000., 1000.))
+    with h5py.File(file2, 'r+') as f:
+        f['x'][0] = 0
+    with pytest.raises(RuntimeError):
+        interpolateWeatherModelFilesInTime(file1, file2, 0.5, out_file)
@@ -0,0 +1,171 @@
+from test import pushd
+
+import h5py
+import numpy as np
+import pytest
+from pyproj import CRS, Transformer
+from scipy.integrate import cumulative_trapezoid
+
+import RAiDER.delayFcns
+from RAiDER.delayFcns import get_delays
+
+_LATS = np.arange(30., 36.01, 0.1)
+_LONS = np.arange(-120., -113.99, 0.1)
+
+
+def _wet(z):
+    return 60 * np.exp(-z / 2000)
+
+
+def _hydro(z):
+    return 300 * np.exp(-z / 8000)
+
+
+def _zenith_delays(hgt, top):
+    '''
+    Wet and hydrostatic zenith delays of _wet and _hydro from hgt up to top
+    '''
+    return (
+        1e-6 * 2000 * (_wet(hgt) - _wet(top)),
+        1e-6 * 8000 * (_hydro(hgt) - _hydro(top)),
+    )
+
+
+def make_weather_model(path, top, bottom=-100.):
+    '''
+    Write a processed weather model on a lat/lon grid with levels every 50 m
+    from bottom to top, whose refractivity decays exponentially with height
+    '''
+    z = np.arange(bottom, top + 1, 50.)
+    zs = np.broadcast_to(z, (len(_LATS), len(_LONS), len(z)))
+    wet, hydro = _wet(zs), _hydro(zs)
+
+    def total(refr):
+        return 1e-6 * cumulative_trapezoid(refr[..., ::-1], -z[::-1], axis=-1, initial=0)[..., ::-1]
+
+    with h5py.File(path, 'w') as f:
+        f['x'], f['y'], f['z'] = _LONS, _LATS, z
+        f['lat'], f['lon'] = np.meshgrid(_LATS, _LONS, indexing='ij')
+        f['wet'], f['hydro'] = wet, hydro
+        f['wet_total'], f['hydro_total'] = total(wet), total(hydro)
+        f.create_dataset('Projection', data=CRS.from_epsg(4326).to_json())
+    return str(path)
+
+
+def make_query_points(path, lat, lon, hgt, elevation=90., zref=15000., chunkSize=(2, 2), ndv=0):
+    '''
+    Write a query point file with rays looking north at the given elevation
+    angles from lat/lon/hgt, which are NaN for no-data pixels
+    '''
+    t = Transformer.from_crs(4326, 4978, always_xy=True)
+    sp = np.stack(t.transform(lon, lat, hgt), axis=-1)
+
+    # local up and north vectors
+    la, lo = np.radians(lat), np.radians(lon)
+    up = np.stack([np.cos(la) * np.cos(lo), np.cos(la) * np.sin(lo), np.sin(la)], axis=-1)
+    north = np.stack([-np.sin(la) * np.cos(lo), -np.sin(la) * np.sin(lo), np.cos(la)], axis=-1)
+    el = np.broadcast_to(np.radians(elevation), lat.shape)[..., np.newaxis]
+    slv = np.sin(el) * up + np.cos(el) * north
+
+    with h5py.File(path, 'w') as f:
+        f['lat'], f['lon'], f['hgt'] = lat, lon, hgt
+        f['lon'].attrs['Shape'] = lat.shape
+        f['Rays_SP'], f['Rays_SLV'] = sp, slv
+        f['Rays_len'] = np.nan_to_num((zref - hgt) / np.sin(el[..., 0]))
+        f.attrs['NumRays'] = lat.size
+        f.attrs['ChunkSize'] = chunkSize
+        f.attrs['NoDataValue'] = ndv
+    return str(path)
+
+
+@pytest.fixture
+def wm_proj(monkeypatch):
+    # h5py may return the projection as bytes, which CRS.from_json rejects
+    monkeypatch.setattr(RAiDER.delayFcns, 'getProjFromWMFile', lambda wm_file: CRS.from_epsg(4326))
+
+
+@pytest.mark.parametrize('zcut', [None, 8000.])
+def test_get_delays_nodata(tmp_path, wm_proj, zcut):
+    wm_file = make_weather_model(tmp_path / 'wm.h5', 30000)
+    lat, lon = np.meshgrid(np.linspace(32, 34, 4), np.linspace(-118, -116, 5), indexing='ij')
+    hgt = np.random.default_rng(0).uniform(0, 800, lat.shape)
+    mask = np.zeros(lat.shape, dtype=bool)
+    mask[0, :3] = mask[2, 4] = True
+    lat[mask], lon[mask], hgt[mask] = np.nan, np.nan, np.nan
+    pnts_file = make_query_points(tmp_path / 'pnts.h5', lat, lon, hgt, ndv=-9999)
+    valid_file = make_query_points(
+        tmp_path / 'valid.h5', lat[~mask], lon[~mask], hgt[~mask], chunkSize=(4,), ndv=-9999
+    )
+
+    with pushd(tmp_path):
+        wet, hydro, counts = get_delays(
+            50., pnts_file, wm_file, cpu_num=1, zcut=zcut, return_counts=True
+        )
+        valid_wet, valid_hydro, valid_counts = get_delays(
+            50., valid_file, wm_file, cpu_num=1, zcut=zcut, return_counts=True
+        )
+
+    assert wet.shape == hydro.shape == lat.shape
+    assert np.all(wet[mask] == -9999)
+    assert np.all(hydro[mask] == -9999)
+    for name, count in counts.items():
+        assert np.all(count[mask] == 0)
+        assert np.array_equal(count[~mask], valid_counts[name])
+    assert np.allclose(wet[~mask], valid_wet)
+    assert np.allclose(hydro[~mask], valid_hydro)
+    assert np.all(valid_counts['evaluations'] > 0)
+    assert np.all(np.isfinite(valid_wet)) and np.all(np.isfinite(valid_hydro))
+
+
+@pytest.mark.parametrize('quadrature', ['rectangle', 'simpson', 'exact'])
+def test_get_delays_model_top(tmp_path, wm_proj, quadrature):
+    stepSize, top, bottom = 50., 12000., -100.
+    wm_file = make_weather_model(tmp_path / 'wm.h5', top, bottom)
+    lat, lon = np.meshgrid(np.linspace(32, 34, 4), np.linspace(-118, -116, 5), indexing='ij')
+    # the rays end partway between two samples at the model top
+    hgt = np.random.default_rng(0).uniform(0, 800, lat.shape)
+    # the first samples of this ray are below the lowest level
+    hgt[0, 0] = bottom - 80
+    pnts_file = make_query_points(tmp_path / 'pnts.h5', lat, lon, hgt, zref=15000.)
+
+    with pushd(tmp_path):
+        wet, hydro, counts = get_delays(
+            stepSize, pnts_file, wm_file, quadrature=quadrature, cpu_num=1, return_counts=True
+        )
+
+    # Each ray stops at the model top, 3 km below zref
+    assert np.all(counts['truncated'] == 3000 // stepSize)
+    assert counts['filled'][0, 0] == 2
+    assert np.count_nonzero(counts['filled']) == 1
+
+    # The zenith delays up to the model top, with the bias of the rectangle
+    # rule of half a step at the bottom of each ray
+    expected_wet, expected_hydro = _zenith_delays(hgt, top)
+    if quadrature == 'rectangle':
+        expected_wet = expected_wet + 1e-6 * stepSize / 2 * _wet(hgt)
+        expected_hydro = expected_hydro + 1e-6 * stepSize / 2 * _hydro(hgt)
+    inside = counts['filled'] == 0
+    assert np.allclose(wet[inside], expected_wet[inside], rtol=0, atol=5e-5)
+    assert np.allclose(hydro[inside], expected_hydro[inside], rtol=0, atol=5e-5)
+
+
+def test_get_delays_zcut(tmp_path, wm_proj):
+    wm_file = make_weather_model(tmp_path / 'wm.h5', 30000)
+    elevation = np.array([90., 45., 20., 10., 5.])
+    lat, lon = np.meshgrid(np.linspace(32, 33, len(elevation)), np.linspace(-118, -116, 4), indexing='ij')
+    hgt = np.random.default_rng(0).uniform(0, 800, lat.shape)
+    pnts_file = make_query_points(tmp_path / 'pnts.h5', lat, lon, hgt, elevation[:, np.newaxis])
+
+    with pushd(tmp_path):
+        wet, hydro, counts = get_delays(
+            50., pnts_file, wm_file, quadrature='simpson', cpu_num=1, return_counts=True
+        )
+        wet_cut, hydro_cut, counts_cut = get_delays(
+            50., pnts_file, wm_file, quadrature='simpson', zcut=8000., cpu_num=1, return_counts=True
+        )
+
+    # 0.1 mm down to 20 degrees and 1 mm at 5 degrees elevation
+    tol = np.where(elevation >= 20, 1e-4, 1e-3)[:, np.newaxis]
+    assert np.all(np.abs(wet_cut - wet) < tol)
+    assert np.all(np.abs(hydro_cut - hydro) < tol)
+    assert np.all(counts_cut['evaluations'] < 0.6 * counts['evaluations'])
@@ -1,8 +1,12 @@
 import numpy as np
 import pytest
-from scipy.interpolate import RegularGridInterpolator
+from scipy.interpolate import PchipInterpolator, RegularGridInterpolator
 
-from RAiDER.interpolate import interpolate, interpolate_along_axis
+from RAiDER.interpolate import (
+    integrate_rays, interpolate, interpolate_along_axis, interpolate_columns,
+    pchip_slopes
+)
+from RAiDER.interpolator import ColumnGridInterpolator
 from RAiDER.interpolator import RegularGridInterpolator as Interpolator
 from RAiDER.interpolator import fillna3D, interp_along_axis, interpVector
 
@@ -196,8 +200,8 @@ def test_interp_along_axis_2d_threads_edge_case():
     def f(x):
         return 2 * x
 
-    # Max of 4 threads but 5 rows to interpolate over. Each thread will get 2
-    # rows which means only 3 threads will be used
+    # Max of 4 threads but 5 rows to interpolate over, so the rows don't split
+    # evenly between the threads
     max_threads = 4
     xs = np.array([
         [1, 2, 3, 4],
@@ -226,6 +230,31 @@ def test_interp_along_axis_2d_threads_edge_case():
     )
 
 
+@pytest.mark.parametrize('axis', [0, 1, 2])
+@pytest.mark.parametrize('max_threads', [0, 3, 64])
+def test_interp_along_axis_threads(axis, max_threads):
+    shape = [40, 30, 50]
+    xs = np.cumsum(np.random.uniform(0.1, 1, shape), axis=axis)
+    ys = np.sin(xs)
+    shape[axis] = 17
+    points = np.random.uniform(xs.min(), xs.max(), shape)
+
+    ans = interpolate_along_axis(
+        xs, ys, points, axis=axis, fill_value=np.nan, max_threads=max_threads
+    )
+
+    assert np.allclose(
+        ans,
+        interpolate_along_axis(xs, ys, points, axis=axis, fill_value=np.nan, max_threads=1),
+        equal_nan=True
+    )
+    assert np.allclose(
+        ans,
+        interp_along_axis(xs, points, ys, axis=axis),
+        equal_nan=True
+    )
+
+
 def test_interp_along_axis_3d():
     def f(x):
         return 2 * x
@@ -798,6 +827,41 @@ def test_3d_cube_large():
     assert np.allclose(ans, ans_scipy, 1e-15)
 
 
+@pytest.mark.parametrize('ndim', [1, 2, 3, 4])
+@pytest.mark.parametrize('max_threads', [0, 3, 64])
+def test_threads(ndim, max_threads):
+    grid = tuple(np.linspace(0, 1, 10) for _ in range(ndim))
+    values = np.random.uniform(0, 1, (10,) * ndim)
+    points = np.random.uniform(-0.1, 1.1, (40000, ndim))
+
+    ans = interpolate(grid, values, points, fill_value=np.nan, max_threads=max_threads)
+
+    assert np.allclose(
+        ans,
+        interpolate(grid, values, points, fill_value=np.nan, max_threads=1),
+        equal_nan=True
+    )
+    assert np.allclose(
+        ans,
+        RegularGridInterpolator(grid, values, bounds_error=False, fill_value=np.nan)(points),
+        equal_nan=True
+    )
+
+
+@pytest.mark.parametrize('ndim', [1, 2, 3, 4])
+def test_sort_points(ndim):
+    grid = tuple(np.linspace(0, 1, 40) for _ in range(ndim))
+    values = np.random.uniform(0, 1, (40,) * ndim)
+    points = np.random.uniform(-0.1, 1.1, (40000, ndim))
+    points[0] = np.nan
+
+    assert np.array_equal(
+        interpolate(grid, values, points, fill_value=np.nan, sort_points=True, max_threads=3),
+        interpolate(grid, values, points, fill_value=np.nan),
+        equal_nan=True
+    )
+
+
 def test_4d_basic():
     xs = np.array([0, 1])
     ys = np.array([0, 1])
@@ -913,3 +977,308 @@ def test_interpolate_wrapper():
 
     assert np.allclose(ans, ans_scipy, 1e-15)
     assert np.allclose(ans2, ans_scipy, 1e-15)
+
+
+def test_interpolate_coordinate_arrays():
+    xs = np.linspace(0, 10, 11)
+    ys = np.linspace(0, 20, 21)
+    zs = np.linspace(0, 5, 6)
+    values = np.random.uniform(0, 1, (11, 21, 6))
+
+    # Strided, multidimensional coordinate arrays
+    coords = np.random.uniform(0, 5, (3, 40, 60))
+    points = (coords[0, ::2, ::3], coords[1, :20, :20].T, coords[2, 20:, 40:])
+    shape = (20, 20)
+    assert not any(p.flags.c_contiguous for p in points)
+
+    ans = interpolate((xs, ys, zs), values, points)
+    ans_stacked = interpolate(
+        (xs, ys, zs), values, np.stack([p.ravel() for p in points], axis=-1)
+    )
+
+    assert ans.shape == shape
+    assert np.array_equal(ans.ravel(), ans_stacked)
+    assert np.array_equal(ans, interpolate((xs, ys, zs), values, points, sort_points=True))
+
+    # Mismatched coordinate arrays
+    with pytest.raises(TypeError):
+        interpolate((xs, ys, zs), values, (points[0], points[1]))
+    with pytest.raises(TypeError):
+        interpolate((xs, ys, zs), values, (points[0], points[1], points[2][:-1]))
+
+
+def test_interpolate_out():
+    xs = np.linspace(0, 10, 11)
+    ys = np.linspace(0, 20, 21)
+    values = np.random.uniform(0, 1, (11, 21))
+    points = (np.random.uniform(0, 10, 100), np.random.uniform(0, 20, 100))
+
+    out = np.empty(100)
+    ans = Interpolator((xs, ys), values)(points, out=out)
+
+    assert ans is out or np.shares_memory(ans, out)
+    assert np.array_equal(out, interpolate((xs, ys), values, points))
+
+    # Rejects an output that can't be written in place
+    with pytest.raises(TypeError):
+        interpolate((xs, ys), values, points, out=np.empty(99))
+    with pytest.raises(TypeError):
+        interpolate((xs, ys), values, points, out=np.empty(100, dtype=np.float32))
+    with pytest.raises(TypeError):
+        interpolate((xs, ys), values, points, out=np.empty(200)[::2])
+
+
+def test_columns_uniform_heights():
+    def f(x, y, z):
+        return x ** 2 + 3 * y - z
+
+    xs = np.linspace(0, 1000, 100)
+    ys = np.linspace(0, 1000, 50)
+    zs = np.linspace(0, 1000, 20)
+
+    values = f(*np.meshgrid(xs, ys, zs, indexing="ij"))
+    heights = np.ascontiguousarray(np.broadcast_to(zs, values.shape))
+    points = np.stack((
+        np.random.uniform(10, 990, 100),
+        np.random.uniform(10, 990, 100),
+        np.random.uniform(10, 990, 100)
+    ), axis=-1)
+
+    ans = interpolate_columns((xs, ys), heights, values, points)
+
+    rgi = RegularGridInterpolator((xs, ys, zs), values)
+    ans_scipy = rgi(points)
+
+    assert np.allclose(ans, ans_scipy, 1e-15)
+
+
+def test_columns_terrain_following():
+    xs = np.linspace(0, 10, 11)
+    ys = np.linspace(0, 5, 6)
+    levels = np.linspace(0, 1000, 11)
+
+    # every column is shifted up by its own terrain height
+    X, Y, L = np.meshgrid(xs, ys, levels, indexing="ij")
+    heights = L + 100 * np.sin(X) * np.cos(Y) ** 2
+    values = 2 * X - Y + heights
+
+    points = np.stack((
+        np.random.uniform(0, 10, 100),
+        np.random.uniform(0, 5, 100),
+        np.random.uniform(200, 900, 100)
+    ), axis=-1)
+
+    ans = interpolate_columns((xs, ys), heights, values, points, max_threads=1)
+
+    assert np.allclose(ans, 2 * points[:, 0] - points[:, 1] + points[:, 2])
+
+
+def test_columns_fill_value():
+    xs = np.array([0., 1.])
+    ys = np.array([0., 1.])
+    heights = np.array([
+        [[0., 1.], [0., 1.]],
+        [[0., 1.], [0.5, 2.]]
+    ])
+    values = heights * 2
+
+    ans = interpolate_columns(
+        (xs, ys),
+        heights,
+        values,
+        np.array([[0.5, 0.5, 0.8], [0.5, 0.5, 0.2], [2., 0.5, 0.5]]),
+        fill_value=np.nan
+    )
+
+    assert np.allclose(ans[0], 1.6)
+    # below the lowest node of one of the corner columns
+    assert np.isnan(ans[1])
+    # outside of the horizontal grid
+    assert np.isnan(ans[2])
+
+
+def test_columns_sort_points():
+    xs = np.linspace(0, 100, 101)
+    ys = np.linspace(0, 50, 51)
+    levels = np.linspace(0, 1000, 11)
+
+    X, Y, L = np.meshgrid(xs, ys, levels, indexing="ij")
+    heights = L + 10 * np.sin(X)
+    values = np.random.uniform(0, 1, heights.shape)
+
+    points = np.stack((
+        np.random.uniform(-5, 105, 40000),
+        np.random.uniform(-5, 55, 40000),
+        np.random.uniform(0, 1000, 40000)
+    ), axis=-1)
+
+    assert np.array_equal(
+        interpolate_columns((xs, ys), heights, values, points, fill_value=np.nan, sort_points=True),
+        interpolate_columns((xs, ys), heights, values, points, fill_value=np.nan),
+        equal_nan=True
+    )
+
+
+@pytest.mark.parametrize('nz', [2, 3, 10])
+def test_pchip_slopes(nz):
+    zs = np.cumsum(np.random.uniform(0.1, 1, nz))
+    values = np.random.uniform(-1, 1, (3, 4, nz))
+    # flat and monotone columns
+    values[0, 0] = 1
+    values[0, 1] = np.sort(values[0, 1])
+
+    ans = pchip_slopes(zs, values)
+    heights = np.broadcast_to(zs, values.shape).copy()
+
+    assert np.allclose(ans, PchipInterpolator(zs, values, axis=2).derivative()(zs))
+    assert np.array_equal(pchip_slopes(heights, values), ans)
+
+    with pytest.raises(TypeError):
+        pchip_slopes(zs[:-1], values)
+
+
+def test_pchip():
+    xs = np.linspace(0, 10, 11)
+    ys = np.linspace(0, 5, 6)
+    zs = np.cumsum(np.random.uniform(10, 100, 20))
+    values = np.random.uniform(0, 1, (11, 6, 20))
+    points = np.stack((
+        np.random.uniform(0, 10, 1000),
+        np.random.uniform(0, 5, 1000),
+        np.random.uniform(zs[0], zs[-1], 1000)
+    ), axis=-1)
+
+    # monotone cubic in z, then bilinear in x and y
+    columns = PchipInterpolator(zs, values, axis=2)(points[:, 2])
+    expected = np.array([
+        RegularGridInterpolator((xs, ys), columns[..., i])(points[i, :2])[0]
+        for i in range(len(points))
+    ])
+
+    slopes = pchip_slopes(zs, values)
+    heights = np.broadcast_to(zs, values.shape).copy()
+
+    assert np.allclose(interpolate((xs, ys, zs), values, points, slopes=slopes), expected)
+    assert np.allclose(
+        interpolate_columns((xs, ys), heights, values, points, slopes=slopes),
+        expected
+    )
+    assert np.allclose(
+        Interpolator((xs, ys, zs), values, method='pchip')(points),
+        expected
+    )
+    assert np.allclose(
+        ColumnGridInterpolator((xs, ys), heights, values, method='pchip')(points),
+        expected
+    )
+
+    with pytest.raises(TypeError):
+        interpolate((xs, ys, zs), values, points, slopes=slopes[..., 1:])
+    with pytest.raises(ValueError):
+        Interpolator((xs, ys, zs), values, method='cubic')
+    with pytest.raises(ValueError):
+        Interpolator((xs, ys), values[..., 0], method='pchip')
+
+
+def test_pchip_no_overshoot():
+    xs = np.array([0., 1.])
+    ys = np.array([0., 1.])
+    # A sharp step, like an inversion
+    zs = np.arange(10.)
+    values = np.broadcast_to(np.where(zs < 5, 1., 0.), (2, 2, 10)).copy()
+
+    points = (np.full(1000, 0.5), np.full(1000, 0.5), np.linspace(0, 9, 1000))
+    ans = Interpolator((xs, ys, zs), values, method='pchip')(points)
+
+    assert ans.min() >= 0
+    assert ans.max() <= 1
+    assert np.all(np.diff(ans) <= 0)
+
+
+def _sampled_integral(fun, start, end, n=100001):
+    # Fine trapezoid reference for the integral along a straight line
+    t = np.linspace(0, 1, n)[:, np.newaxis]
+    values = np.nan_to_num(fun(start + t * (end - start)))
+    return np.trapezoid(values, dx=np.linalg.norm(end - start) / (n - 1))
+
+
+def test_integrate_rays():
+    xs = np.cumsum(np.random.uniform(0.5, 1.5, 12))
+    ys = np.cumsum(np.random.uniform(0.5, 1.5, 10))
+    zs = np.cumsum(np.random.uniform(0.5, 1.5, 8))
+    values = np.random.uniform(0, 1, (12, 10, 8))
+    heights = np.sort(np.random.uniform(0, 10, values.shape), axis=-1)
+    lo = np.array([xs[0], ys[0], 0])
+    hi = np.array([xs[-1], ys[-1], zs[-1]])
+
+    num_rays, num_samples = 10, 4
+    start = np.random.uniform(lo, hi, (num_rays, 3))
+    end = np.random.uniform(lo, hi, (num_rays, 3))
+    length = np.linalg.norm(end - start, axis=-1)
+    t = np.linspace(0, 1, num_samples)[:, np.newaxis]
+    rays = start[:, np.newaxis] + t * (end - start)[:, np.newaxis]
+    coords = tuple(np.moveaxis(rays, -1, 0))
+
+    ans = integrate_rays((xs, ys, zs), values, coords, 1.) * length / (num_samples - 1)
+    ans_columns = integrate_rays(
+        (xs, ys), values, coords, 1., heights=heights
+    ) * length / (num_samples - 1)
+
+    interp = Interpolator((xs, ys, zs), values, fill_value=np.nan)
+    interp_columns = ColumnGridInterpolator((xs, ys), heights, values, fill_value=np.nan)
+    for i in range(num_rays):
+        assert np.isclose(ans[i], _sampled_integral(interp, start[i], end[i]), atol=1e-4)
+        assert np.isclose(
+            ans_columns[i],
+            _sampled_integral(interp_columns, start[i], end[i]),
+            atol=1e-4
+        )
+
+    assert np.allclose(interp.integrate(coords, 2.), 2 * integrate_rays((xs, ys, zs), values, coords, 1.))
+    assert integrate_rays((xs, ys, zs), values, tuple(rays[0].T), 1.).shape == ()
+
+    with pytest.raises(TypeError):
+        integrate_rays((xs, ys), values, coords, 1.)
+    with pytest.raises(TypeError):
+        integrate_rays((xs, ys, zs), values, coords[:2], 1.)
+    with pytest.raises(ValueError):
+        Interpolator((xs, ys, zs), values, method='pchip').integrate(coords, 1.)
+
+
+def test_integrate_rays_linear():
+    # The integral of a linear field is exact with any number of samples
+    xs = np.linspace(0, 10, 11)
+    ys = np.linspace(0, 10, 6)
+    zs = np.linspace(0, 10, 21)
+    X, Y, Z = np.meshgrid(xs, ys, zs, indexing="ij")
+    values = 1 + X + 2 * Y - Z
+
+    coords = (np.array([1., 9.]), np.array([2., 8.]), np.array([0.5, 9.5]))
+    length = np.sqrt(8 ** 2 + 6 ** 2 + 9 ** 2)
+    mean = 1 + 5 + 2 * 5 - 5
+
+    assert np.isclose(integrate_rays((xs, ys, zs), values, coords, length), mean * length)
+    # Outside of the grid nothing is added
+    outside = (np.array([11., 20.]), np.array([2., 8.]), np.array([0.5, 9.5]))
+    assert integrate_rays((xs, ys, zs), values, outside, 1.) == 0
+
+
+def test_columns_wrapper():
+    xs = np.linspace(0, 10, 11)
+    ys = np.linspace(0, 5, 6)
+    levels = np.linspace(0, 1000, 11)
+
+    X, Y, L = np.meshgrid(xs, ys, levels, indexing="ij")
+    heights = L + 10 * X
+    values = X + Y + heights
+
+    points_x = np.linspace(1, 9, 5)
+    points_y = np.linspace(1, 4, 5)
+    points_z = np.linspace(200, 800, 5)
+
+    interp = ColumnGridInterpolator((xs, ys), heights, values)
+    ans = interp(np.stack((points_x, points_y, points_z), axis=-1))
+    ans2 = interp((points_x, points_y, points_z))
+
+    assert np.allclose(ans, points_x + points_y + points_z)
+    assert np.allclose(ans2, ans)
@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+
+from RAiDER.delayFcns import int_fcn
+from RAiDER.interpolator import RegularGridInterpolator as Interpolator
+from RAiDER.quadrature import (
+    adaptive_simpson, exponential_mapping, integrate_stretched, stretched_grid
+)
+
+
+def _profile(s):
+    # Refractivity-like: exponential decay with a bump near the ground
+    return 300 * np.exp(-s / 7000) + 50 * np.exp(-((s - 1500) / 500) ** 2)
+
+
+def _profile_integral(length):
+    from scipy.integrate import quad
+    return quad(_profile, 0, length, points=[1500], limit=200)[0]
+
+
+def test_stretched_grid():
+    s, weights, coarse = stretched_grid(30000, 15, scale=8000)
+
+    assert s[0] == 0
+    assert np.isclose(s[-1], 30000)
+    assert np.isclose(s[1], 15, rtol=0.1)
+    # The spacing grows with the distance along the ray
+    assert np.all(np.diff(s, 2) > 0)
+    assert len(s) < 30000 / 15 / 3
+    # Both sets of weights integrate constants exactly
+    assert np.isclose(weights.sum(), 30000)
+    assert np.isclose(coarse.sum(), 30000)
+    assert np.all(coarse[1::2] == 0)
+
+
+def test_integrate_stretched():
+    length = 40000
+
+    def fun(s):
+        return np.stack([_profile(s), 2 * _profile(s)])[:, np.newaxis, :].repeat(3, axis=1)
+
+    result = integrate_stretched(fun, 3, length, 15)
+    expected = _profile_integral(length)
+
+    assert result.integrals.shape == (2, 3)
+    assert np.allclose(result.integrals[0], expected, rtol=1e-6)
+    assert np.allclose(result.integrals[1], 2 * expected, rtol=1e-6)
+    assert np.all(result.evaluations == len(stretched_grid(length, 15)[0]))
+    assert np.all(result.filled == 0)
+
+    coarse = integrate_stretched(fun, 3, length, 500)
+    assert np.all(coarse.evaluations < result.evaluations)
+    # The error estimate is of the right size
+    actual = np.abs(coarse.integrals[0, 0] - expected)
+    assert actual / 10 < coarse.error[0, 0] < 10 * actual
+
+
+@pytest.mark.parametrize('top', [40000, 12345.6])
+def test_adaptive_simpson(top):
+    length = 40000
+    scales = np.array([1., 2., 0.5])
+
+    def fun(rays, s):
+        # NaN above the top, like above the weather model
+        values = scales[rays] * _profile(s)
+        values[s > top] = np.nan
+        return values
+
+    tol = 1e-2
+    result = adaptive_simpson(fun, 3, length, tol, min_step=1)
+    expected = scales * _profile_integral(top)
+
+    assert result.integrals.shape == (1, 3)
+    assert np.all(np.abs(result.integrals[0] - expected) <= np.maximum(result.error[0], tol))
+    # The ray with the largest values needs the most refinement
+    assert result.evaluations[1] >= result.evaluations[2]
+    assert np.all(result.evaluations < length)
+    # The samples above the top are reported
+    assert np.all((result.filled > 0) == (top < length))
+    assert np.all(result.filled < result.evaluations)
+
+
+def test_adaptive_simpson_min_step():
+    def fun(rays, s):
+        return np.sign(s - 1000.5)
+
+    coarse = adaptive_simpson(fun, 1, 2000, 1e-12, min_step=100)
+    fine = adaptive_simpson(fun, 1, 2000, 1e-12, min_step=1)
+
+    assert coarse.evaluations[0] < fine.evaluations[0]
+    assert np.abs(coarse.integrals[0, 0] + 1) <= coarse.error[0, 0]
+    assert np.abs(fine.integrals[0, 0] + 1) <= fine.error[0, 0]
+
+
+@pytest.mark.parametrize('depth', [np.inf, 7000])
+@pytest.mark.parametrize('elevation', [5, 20, 90])
+def test_exponential_mapping(elevation, depth):
+    from scipy.integrate import quad
+    radius, scale = 6.39e6, 8000
+    sin_el = np.sin(np.radians(elevation))
+
+    def refr(s):
+        # along the straight ray from radius at the given elevation
+        height = np.sqrt(radius ** 2 + s ** 2 + 2 * radius * s * sin_el) - radius
+        return np.exp(-height / scale)
+
+    # the length of the ray across the layer
+    cos_el = np.sqrt(1 - sin_el ** 2)
+    length = np.sqrt((radius + depth) ** 2 - (radius * cos_el) ** 2) - radius * sin_el
+    expected = quad(refr, 0, length, limit=200)[0] / (scale * -np.expm1(-depth / scale))
+    mapping = exponential_mapping(sin_el, radius, scale, depth)
+    assert np.isclose(mapping, expected, rtol=1e-8)
+    assert mapping <= 1 / sin_el + 1e-12
+
+
+@pytest.mark.parametrize('rule,order', [('rectangle', 1), ('trapezoid', 2), ('simpson', 4)])
+def test_quadrature_order(rule, order):
+    length = 24000
+    expected = 1e-6 * _profile_integral(length)
+    steps = np.array([120., 60., 30.])
+    errors = np.array([
+        np.abs(int_fcn(_profile(np.arange(0, length + step / 2, step)), step, rule=rule) - expected)
+        for step in steps
+    ])
+    # Halving the step divides the error by 2 ** order
+    assert np.allclose(np.log2(errors[:-1] / errors[1:]), order, atol=0.2)
+
+
+def test_pchip_coarse_step():
+    # A refractivity profile on 37 levels up to 30 km, closer near the
+    # ground, sampled along a vertical ray
+    length = 30000
+    levels = length * (np.arange(37) / 36) ** 2
+    grid = (np.array([0., 1.]), np.array([0., 1.]), levels)
+    values = np.broadcast_to(_profile(levels), (2, 2, len(levels)))
+    expected = 1e-6 * _profile_integral(length)
+
+    def delay(method, rule, step):
+        z = np.arange(0, length + step / 2, step)
+        points = np.stack([np.full_like(z, 0.5), np.full_like(z, 0.5), z], axis=-1)
+        refr = Interpolator(grid, values, fill_value=np.nan, method=method)(points)
+        return int_fcn(refr, step, rule=rule)
+
+    # Monotone cubic interpolation with Simpson's rule at eight times the
+    # step is still more accurate than linear interpolation and rectangles
+    default = np.abs(delay('linear', 'rectangle', 15.) - expected)
+    coarse = np.abs(delay('pchip', 'simpson', 120.) - expected)
+    assert coarse < default / 10
+    # and most of the gain comes from the interpolation
+    assert np.abs(delay('linear', 'simpson', 120.) - expected) > default / 10
@@ -0,0 +1,189 @@
+import csv
+import datetime
+import logging
+import os
+import threading
+import urllib.request
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from test import pushd
+
+import pytest
+
+from RAiDER.scheduler import (
+    WeatherModelPrefetcher, get_num_jobs, run_dates, write_summary
+)
+
+
+def _fake_run(t, wfn, hfn):
+    if t.day == 2:
+        raise RuntimeError('Weather model not available')
+    with open(wfn, 'w') as f:
+        f.write('wet')
+
+
+# Held by the test process while the dates run, like the locks of a download
+# in progress in a prefetch thread
+_LOCK = threading.Lock()
+
+
+def _locking_run(t, wfn, hfn):
+    # A forked process would inherit the lock in its held state
+    if not _LOCK.acquire(timeout=5):
+        raise RuntimeError('Lock inherited from the parent process')
+    with open(wfn, 'w') as f:
+        f.write('wet')
+
+
+@pytest.fixture
+def dates(tmp_path):
+    times = [datetime.datetime(2020, 1, d) for d in range(1, 5)]
+    wetNames = [str(tmp_path / 'wet_{}.txt'.format(t.day)) for t in times]
+    hydroNames = [str(tmp_path / 'hydro_{}.txt'.format(t.day)) for t in times]
+    return times, wetNames, hydroNames
+
+
+def test_get_num_jobs():
+    assert get_num_jobs(1, 8) == (1, 8)
+    assert get_num_jobs(3, 8) == (3, 2)
+    assert get_num_jobs(16, 4) == (4, 1)
+    # each date needs 1 unit per cpu plus 10 units of overhead
+    assert get_num_jobs(4, 8, max_memory=30, memory_fcn=lambda c: 10 + c) == (2, 4)
+    assert get_num_jobs(4, 8, max_memory=1, memory_fcn=lambda c: 10 + c) == (1, 8)
+
+
+@pytest.mark.parametrize('njobs', [1, 2])
+def test_run_dates(tmp_path, dates, njobs):
+    times, wetNames, hydroNames = dates
+    results = run_dates(_fake_run, times, wetNames, hydroNames, njobs=njobs)
+
+    assert [r['date'] for r in results] == [t.strftime('%Y-%m-%dT%H:%M:%S') for t in times]
+    assert [r['status'] for r in results] == ['success', 'failed', 'success', 'success']
+    assert 'Weather model not available' in results[1]['message']
+    assert [os.path.exists(wfn) for wfn in wetNames] == [True, False, True, True]
+
+    summary = str(tmp_path / 'summary.csv')
+    write_summary(results, summary)
+    with open(summary) as f:
+        rows = list(csv.DictReader(f))
+    assert [row['status'] for row in rows] == ['success', 'failed', 'success', 'success']
+
+
+def test_run_dates_not_forked(dates):
+    times, wetNames, hydroNames = dates
+    with _LOCK:
+        results = run_dates(_locking_run, times, wetNames, hydroNames, njobs=2)
+    assert [r['status'] for r in results] == ['success'] * len(times)
+
+
+@pytest.mark.parametrize('njobs', [1, 2])
+def test_run_dates_duplicates(dates, njobs):
+    times, wetNames, hydroNames = dates
+    results = run_dates(
+        _fake_run, times + times[:1], wetNames + wetNames[:1], hydroNames + hydroNames[:1],
+        njobs=njobs
+    )
+    assert [r['date'] for r in results] == [t.strftime('%Y-%m-%dT%H:%M:%S') for t in times]
+
+
+def _log_level_run(t, wfn, hfn):
+    with open(wfn, 'w') as f:
+        f.write(str(logging.getLogger('RAiDER').getEffectiveLevel()))
+
+
+def test_run_dates_log_level(dates):
+    times, wetNames, hydroNames = dates
+    logger = logging.getLogger('RAiDER')
+    level = logger.level
+    logger.setLevel(logging.DEBUG)
+    try:
+        run_dates(_log_level_run, times, wetNames, hydroNames, njobs=2)
+    finally:
+        logger.setLevel(level)
+
+    for wfn in wetNames:
+        with open(wfn) as f:
+            assert int(f.read()) == logging.DEBUG
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def archive(tmp_path):
+    '''
+    Serve a local directory over http as a stand-in for a remote archive
+    '''
+    root = tmp_path / 'archive'
+    root.mkdir()
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0), partial(_QuietHandler, directory=str(root))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+class _ArchiveModel(object):
+    '''
+    Minimal weather model that downloads one file per date from an archive
+    '''
+    started = {}
+
+    def __init__(self, url):
+        self._url = url
+        self._time = None
+
+    def Model(self):
+        return 'FAKE'
+
+    def fetch(self, lats, lons, time, out):
+        self._time = time
+        self.started[time].set()
+        name = time.strftime('%Y%m%d.nc')
+        with urllib.request.urlopen('{}/{}'.format(self._url, name)) as r, open(out, 'wb') as f:
+            f.write(r.read())
+
+
+def test_prefetch(tmp_path, archive, dates):
+    root, url = archive
+    times, wetNames, hydroNames = dates
+    for t in times:
+        if t.day != 3:
+            (root / t.strftime('%Y%m%d.nc')).write_bytes(t.strftime('%Y%m%d').encode())
+
+    wmLoc = tmp_path / 'weather_files'
+    wmLoc.mkdir()
+    model = _ArchiveModel(url)
+    # Stored on the class so that the copies of the model made for each
+    # download share them
+    _ArchiveModel.started = {t: threading.Event() for t in times}
+
+    def compute(t, wfn, hfn):
+        # The download of the next date must be able to run while this date
+        # is being computed
+        i = times.index(t)
+        if i + 1 < len(times):
+            assert model.started[times[i + 1]].wait(timeout=10)
+        wm_file = os.path.join(str(wmLoc), 'FAKE_{}.nc'.format(t.strftime('%Y_%m_%d_T%H_%M_%S')))
+        with open(wm_file) as f:
+            assert f.read() == t.strftime('%Y%m%d')
+
+    with pushd(str(tmp_path)), \
+            WeatherModelPrefetcher(model, times, str(wmLoc), depth=2) as prefetcher:
+        results = run_dates(compute, times, wetNames, hydroNames, prefetcher=prefetcher)
+
+    # The third date is missing from the archive, so its partial download is
+    # removed and the date fails on its own
+    assert [r['status'] for r in results] == ['success', 'success', 'failed', 'success']
+    assert sorted(f for f in os.listdir(str(wmLoc)) if f.endswith('.nc')) == [
+        'FAKE_2020_01_01_T00_00_00.nc',
+        'FAKE_2020_01_02_T00_00_00.nc',
+        'FAKE_2020_01_04_T00_00_00.nc',
+    ]
+    # the original object is never used for downloading
+    assert model._time is None
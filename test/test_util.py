@@ -1,5 +1,5 @@
 import os
-from datetime import time
+from datetime import datetime, time, timedelta
 from test import TEST_DIR
 
 import h5py
@@ -7,9 +7,10 @@ import numpy as np
 import pytest
 from osgeo import gdal
 
+from RAiDER.constants import Zenith
 from RAiDER.utilFcns import (
-    _least_nonzero, cosd, gdal_open, makeDelayFileNames, sind,
-    writeArrayToRaster, writeResultsToHDF5
+    _least_nonzero, cosd, gdal_open, get_bracketing_times, make_geom_hash,
+    makeDelayFileNames, sind, writeArrayToRaster, writeResultsToHDF5
 )
 
 
@@ -238,3 +239,42 @@ def test_least_nonzero_2():
         atol=1e-16,
         equal_nan=True
     )
+
+
+def test_make_geom_hash(tmp_path):
+    lats = np.linspace(30, 31, 12).reshape(3, 4)
+    lons = np.linspace(-120, -119, 12).reshape(3, 4)
+    hgts = np.zeros((3, 4))
+
+    ref = make_geom_hash(lats, lons, hgts, Zenith, 15000.)
+    assert make_geom_hash(lats.copy(), lons.copy(), hgts.copy(), Zenith, 15000) == ref
+
+    # Any change to the inputs must change the key
+    assert make_geom_hash(lats, lons, hgts + 1, Zenith, 15000.) != ref
+    assert make_geom_hash(lats, lons, hgts, Zenith, 20000.) != ref
+    assert make_geom_hash(lats.reshape(4, 3), lons.reshape(4, 3), hgts.reshape(4, 3), Zenith, 15000.) != ref
+
+    # Changing the contents of the LOS file must change the key
+    los_file = str(tmp_path / 'los.rdr')
+    with open(los_file, 'wb') as f:
+        f.write(b'\x00' * 16)
+    key1 = make_geom_hash(lats, lons, hgts, ('los', los_file), 15000.)
+    with open(los_file, 'wb') as f:
+        f.write(b'\x01' * 16)
+    key2 = make_geom_hash(lats, lons, hgts, ('los', los_file), 15000.)
+    assert key1 != ref
+    assert key1 != key2
+    assert make_geom_hash(lats, lons, hgts, ('sv', los_file), 15000.) != key2
+
+
+def test_get_bracketing_times():
+    t1, t2, w = get_bracketing_times(datetime(2020, 1, 1, 13, 45), timedelta(hours=1))
+    assert (t1, t2) == (datetime(2020, 1, 1, 13), datetime(2020, 1, 1, 14))
+    assert w == 0.75
+
+    t1, t2, w = get_bracketing_times(datetime(2020, 1, 1, 23, 30), timedelta(hours=6))
+    assert (t1, t2) == (datetime(2020, 1, 1, 18), datetime(2020, 1, 2))
+    assert np.isclose(w, 5.5 / 6)
+
+    t = datetime(2020, 1, 1, 12)
+    assert get_bracketing_times(t, timedelta(hours=3)) == (t, t, 0.)
@@ -0,0 +1,58 @@
+"""
+Testing the windowed reading of ERA5 pressure-level files
+"""
+import numpy as np
+import pytest
+from scipy.io import netcdf_file
+
+from RAiDER.models.era5 import ERA5
+
+
+@pytest.fixture
+def era5_file(tmp_path):
+    '''
+    Write a small ERA5 pressure-level file laid out like the CDS downloads:
+    latitudes from north to south, longitudes on 0-360 and levels from the
+    top of the atmosphere down
+    '''
+    lats = np.arange(50., 29., -1.)
+    lons = np.arange(240., 271., 1.)
+    levels = np.array([100., 500., 850., 1000.])
+    shape = (1, len(levels), len(lats), len(lons))
+
+    # geopotential decreasing with pressure, plus a signature of the position
+    _, lev, la, lo = np.meshgrid([0], levels, lats, lons, indexing='ij')
+    z = 9.80665 * (16000. - 16 * lev) + la + lo / 1000.
+
+    filename = str(tmp_path / 'era5.nc')
+    with netcdf_file(filename, 'w') as f:
+        for name, data in (('time', [0]), ('level', levels), ('latitude', lats), ('longitude', lons)):
+            f.createDimension(name, len(data))
+            f.createVariable(name, 'f4', (name,))[:] = data
+        dims = ('time', 'level', 'latitude', 'longitude')
+        for name, data in (('z', z), ('t', lev / 4 + 50), ('q', lev / 1e6), ('r', lev / 20)):
+            var = f.createVariable(name, 'f4', dims)
+            var[:] = data.reshape(shape)
+    return filename
+
+
+def test_load_pressure_level_window(era5_file):
+    full = ERA5()
+    full.load_weather(era5_file)
+
+    model = ERA5()
+    model._bounds = (35., 40., -110., -105.)
+    model.load_weather(era5_file)
+
+    # data cube is (lats, lons, heights), from the bottom up
+    assert np.allclose(model._lats[:, 0, 0], np.arange(33., 43.))
+    assert np.allclose(model._lons[0, :, 0], np.arange(-112., -102.))
+    assert np.all(np.diff(model._zs, axis=2) > 0)
+    assert np.allclose(model._p[0, 0, :], [100000., 85000., 50000., 10000.])
+    assert np.allclose(model._t[0, 0, :], [300., 262.5, 175., 75.])
+
+    # the window is exactly the matching part of the whole grid
+    rows = slice(3, 13)
+    cols = slice(8, 18)
+    for name in ('_p', '_t', '_q', '_rh', '_zs', '_xs', '_ys'):
+        assert np.allclose(getattr(model, name), getattr(full, name)[rows, cols]), name
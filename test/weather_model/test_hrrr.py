@@ -0,0 +1,160 @@
+"""
+Testing the HRRR download and grid helpers
+"""
+import os
+import re
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from pyproj import CRS, Transformer
+
+from RAiDER.models.hrrr import (
+    _HRRR_GRID, HRRR, download_grib_fields, hrrr_index_window, parse_grib_idx
+)
+
+# (field, level, size in bytes) of the messages in the fake GRIB2 file
+_MESSAGES = [
+    ('REFC', 'entire atmosphere', 50),
+    ('HGT', '500 mb', 30),
+    ('TMP', '500 mb', 40),
+    ('RH', '500 mb', 20),
+    ('SPFH', '500 mb', 35),
+    ('HGT', '1000 mb', 25),
+    ('TMP', '2 m above ground', 15),
+    ('SPFH', '1000 mb', 45),
+]
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class _RangeHandler(_QuietHandler):
+    '''
+    Serve files with support for single byte-range requests
+    '''
+    def do_GET(self):
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().do_GET()
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(data) - 1
+        self.send_response(206)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+
+def _serve(root, handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=str(root)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def grib(tmp_path):
+    '''
+    Write a fake GRIB2 file where each message is filled with its own byte,
+    together with its .idx inventory
+    '''
+    root = tmp_path / 'archive'
+    root.mkdir()
+    data, lines, expected = b'', [], b''
+    for k, (field, level, size) in enumerate(_MESSAGES):
+        lines.append('{}:{}:d=2020010100:{}:{}:anl:'.format(k + 1, len(data), field, level))
+        message = bytes([k + 1]) * size
+        data += message
+        if field in ('TMP', 'HGT', 'SPFH') and level.endswith(' mb'):
+            expected += message
+    (root / 'hrrr.grib2').write_bytes(data)
+    (root / 'hrrr.grib2.idx').write_text('\n'.join(lines) + '\n')
+    return root, data, expected
+
+
+def test_parse_grib_idx():
+    text = (
+        '1:0:d=2020010100:REFC:entire atmosphere:anl:\n'
+        '2:50:d=2020010100:HGT:500 mb:anl:\n'
+        '3:80:d=2020010100:TMP:500 mb:anl:\n'
+        '4:120:d=2020010100:RH:500 mb:anl:\n'
+        '5:140:d=2020010100:SPFH:500 mb:anl:\n'
+        '6:175:d=2020010100:TMP:2 m above ground:anl:\n'
+        '7:190:d=2020010100:SPFH:1000 mb:anl:\n'
+    )
+    assert parse_grib_idx(text) == [(50, 119), (140, 174), (190, None)]
+    assert parse_grib_idx(text, fields=('TMP',)) == [(80, 119)]
+    assert parse_grib_idx('') == []
+
+
+@pytest.mark.parametrize('handler', [_RangeHandler, _QuietHandler])
+def test_download_grib_fields(tmp_path, grib, handler):
+    root, data, expected = grib
+    server = _serve(root, handler)
+    try:
+        url = 'http://127.0.0.1:{}/hrrr.grib2'.format(server.server_address[1])
+        out = str(tmp_path / 'out.grib2')
+        download_grib_fields(url, out, max_workers=3)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with open(out, 'rb') as f:
+        result = f.read()
+    if handler is _RangeHandler:
+        assert result == expected
+    else:
+        # range requests are not supported, so the whole file is downloaded
+        assert result == data
+    assert sorted(os.listdir(str(tmp_path))) == ['archive', 'out.grib2']
+
+
+def test_download_grib_fields_no_idx(tmp_path, grib):
+    root, data, _ = grib
+    os.remove(str(root / 'hrrr.grib2.idx'))
+    server = _serve(root, _RangeHandler)
+    try:
+        url = 'http://127.0.0.1:{}/hrrr.grib2'.format(server.server_address[1])
+        out = str(tmp_path / 'out.grib2')
+        download_grib_fields(url, out)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with open(out, 'rb') as f:
+        assert f.read() == data
+
+
+def test_hrrr_index_window():
+    proj = HRRR()._proj
+    t = Transformer.from_crs(CRS.from_epsg(4326), proj, always_xy=True)
+    x0, y0 = t.transform(_HRRR_GRID['lon1'], _HRRR_GRID['lat1'])
+    grid = (x0, y0, _HRRR_GRID['dx'], _HRRR_GRID['dy'], _HRRR_GRID['nx'], _HRRR_GRID['ny'])
+
+    bounds = (36.5, 37.5, -77, -76)
+    j0, j1, i0, i1 = hrrr_index_window(proj, bounds, *grid)
+    assert (j1 - j0) * (i1 - i0) < 0.01 * _HRRR_GRID['nx'] * _HRRR_GRID['ny']
+
+    # every point of the box lies inside the window, with two cells to spare
+    lats, lons = np.meshgrid(np.linspace(36.5, 37.5, 11), np.linspace(-77, -76, 11))
+    xs, ys = t.transform(lons, lats)
+    cols = (xs - x0) / _HRRR_GRID['dx']
+    rows = (ys - y0) / _HRRR_GRID['dy']
+    assert cols.min() >= i0 + 2 and cols.max() <= i1 - 3
+    assert rows.min() >= j0 + 2 and rows.max() <= j1 - 3
+
+    # The first grid point is the south-west corner of the grid
+    assert hrrr_index_window(proj, (20, 55, -135, -60), *grid) == (
+        0, _HRRR_GRID['ny'], 0, _HRRR_GRID['nx']
+    )
+
+    with pytest.raises(RuntimeError):
+        hrrr_index_window(proj, (45, 46, 10, 11), *grid)
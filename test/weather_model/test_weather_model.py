@@ -2,12 +2,14 @@
 Testing the base WeatherModel class
 """
 import operator
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
 import numpy as np
 import pytest
 from numpy import nan
 
+from RAiDER.models import weatherModel
 from RAiDER.models.weatherModel import WeatherModel
 
 
@@ -71,6 +73,38 @@ def test_uniform_in_z_small(model):
     assert np.allclose(model._ys, np.array([2, 3]), rtol=0)
 
 
+def test_native_in_z(model):
+    lons, lats, zs = np.meshgrid(
+        np.arange(10., 14.), np.arange(20., 23.), np.arange(0., 5000., 1000.),
+        indexing='ij'
+    )
+    model._zs = zs + lats
+    model._xs, model._ys = lons, lats
+    model._p = np.arange(lons.size, dtype=float).reshape(lons.shape)
+
+    model._native_in_z()
+
+    # heights are kept per node and nothing is resampled
+    assert model._zs.shape == lons.shape
+    assert np.allclose(model._zs, zs + lats)
+    assert np.allclose(model._p, np.arange(lons.size).reshape(lons.shape))
+    assert np.allclose(model._xs, np.arange(10., 14.))
+    assert np.allclose(model._ys, np.arange(20., 23.))
+
+def test_horizontal_latlon(model):
+    lons, lats, _ = np.meshgrid(
+        np.arange(10., 14.), np.arange(20., 23.), np.arange(5.), indexing='ij'
+    )
+    model._lats, model._lons = lats, lons
+
+    model._horizontal_latlon()
+    assert model._lats.shape == model._lons.shape == (4, 3)
+    assert np.allclose(model._lats, lats[..., 0])
+
+    lats3d, lons3d = model._broadcast_latlon(lats.shape)
+    assert np.allclose(lats3d, lats)
+    assert np.allclose(lons3d, lons)
+
 def test_uniform_in_z_large(model):
     shape = (400, 500, 40)
     x, y, z = shape
@@ -98,3 +132,196 @@ def test_uniform_in_z_large(model):
                        interpolated * 3, equal_nan=True, rtol=0)
 
     assert np.allclose(model._zs, zlevels, atol=0.05, rtol=0)
+
+
+def test_crop_grid(model):
+    lats, lons, zs = np.meshgrid(
+        np.arange(0., 20.), np.arange(350., 370.), np.arange(0., 30000., 2000.),
+        indexing='ij'
+    )
+    model._lats, model._lons, model._zs = lats, lons, zs
+    model._xs, model._ys = lons, lats
+    model._p = zs + 1
+    model._t = zs + 2
+    model._q = zs + 3
+    model._zmax = 15000.
+
+    # longitudes of the query box are on -180-180, the grid on 0-360
+    model._bounds = (5., 8., 2., 4.)
+    model._crop_grid()
+
+    assert np.allclose(model._lats[:, 0, 0], np.arange(3., 11.))
+    assert np.allclose(model._lons[0, :, 0], np.arange(360., 367.))
+    # the first level above zmax is kept
+    assert np.allclose(model._zs[0, 0, :], np.arange(0., 18000., 2000.))
+    assert np.allclose(model._p, model._zs + 1)
+    assert np.allclose(model._q, model._zs + 3)
+
+
+def test_crop_grid_descending_z(model):
+    model._zs = np.broadcast_to(np.arange(30000., -1., -2000.), (4, 5, 16))
+    model._p = model._zs.copy()
+    model._lats = None
+    model._zmax = 15000.
+
+    model._crop_grid()
+    assert model._p.shape == (4, 5, 9)
+    assert np.allclose(model._p[0, 0, :], np.arange(16000., -1., -2000.))
+
+
+def test_crop_grid_outside(model):
+    lats, lons, zs = np.meshgrid(np.arange(0., 5.), np.arange(0., 5.), np.arange(0., 3.), indexing='ij')
+    model._lats, model._lons, model._zs, model._p = lats, lons, zs, zs
+    model._bounds = (50., 60., 50., 60.)
+
+    model._crop_grid()
+    assert model._p.shape == (5, 5, 3)
+
+
+def _calculategeoh_loop(model, z, lnsp):
+    '''
+    Level-by-level reference implementation of _calculategeoh
+    '''
+    geopotential = np.zeros_like(model._t)
+    pressurelvs = np.zeros_like(geopotential)
+    geoheight = np.zeros_like(geopotential)
+    sp = np.exp(lnsp)
+    levelSize = len(model._levels)
+    Ph_levplusone = model._a[levelSize] + (model._b[levelSize] * sp)
+    z_h = 0
+    for lev, t_level, q_level in zip(range(levelSize, 0, -1), model._t[::-1], model._q[::-1]):
+        ilevel = lev - 1
+        t_level = t_level * (1 + 0.609133 * q_level)
+        Ph_lev = model._a[lev - 1] + (model._b[lev - 1] * sp)
+        pressurelvs[ilevel] = Ph_lev
+        if lev == 1:
+            dlogP = np.log(Ph_levplusone / 0.1)
+            alpha = np.log(2)
+        else:
+            dlogP = np.log(Ph_levplusone / Ph_lev)
+            dP = Ph_levplusone - Ph_lev
+            alpha = 1 - ((Ph_lev / dP) * dlogP)
+        TRd = t_level * model._R_d
+        z_f = z_h + TRd * alpha
+        geopotential[ilevel] = z_f + z
+        geoheight[ilevel] = geopotential[ilevel] / model._g0
+        z_h += TRd * dlogP
+        Ph_levplusone = Ph_lev
+    return geopotential, pressurelvs, geoheight
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_calculategeoh(model, monkeypatch, threads):
+    # Split the columns between several threads even for a small grid
+    monkeypatch.setattr(weatherModel, '_GEOH_MIN_COLUMNS', 10)
+    monkeypatch.setattr(weatherModel.os, 'cpu_count', lambda: threads)
+
+    nlev, ny, nx = 20, 7, 9
+    rng = np.random.default_rng(0)
+    model._levels = np.arange(1, nlev + 1)
+    model._a = list(np.concatenate(([0.], np.linspace(2000., 0., nlev))))
+    model._b = list(np.linspace(0., 1., nlev + 1))
+    model._t = 300. - 60 * np.linspace(1, 0, nlev)[:, None, None] + rng.random((nlev, ny, nx))
+    model._q = 1e-2 * rng.random((nlev, ny, nx))
+    z = 1000 * rng.random((ny, nx))
+    lnsp = np.log(1e5 + 1e3 * rng.random((ny, nx)))
+
+    for result, expected in zip(
+        model._calculategeoh(z, lnsp), _calculategeoh_loop(model, z, lnsp)
+    ):
+        assert result.shape == (nlev, ny, nx)
+        assert np.allclose(result, expected, rtol=1e-12, atol=0)
+
+    model._a = model._a[1:]
+    with pytest.raises(ValueError):
+        model._calculategeoh(z, lnsp)
+
+
+def _refractivity_reference(model, t, p, humidity):
+    '''
+    Full-cube reference implementation of _get_refractivity
+    '''
+    t1, t2 = 273.15, 250.15
+    tref = t - t1
+    wgt = (t - t2) / (t1 - t2)
+    svpw = 6.1121 * np.exp((17.502 * tref) / (240.97 + tref))
+    svpi = 6.1121 * np.exp((22.587 * tref) / (273.86 + tref))
+    svp = svpi + (svpw - svpi) * wgt**2
+    svp[t > t1] = svpw[t > t1]
+    svp[t < t2] = svpi[t < t2]
+    svp = svp * 100
+
+    if model._humidityType == 'rh':
+        e = humidity / 100 * svp
+    else:
+        w = humidity / (1 - humidity)
+        e = w * model._R_v * (p - svp) / model._R_d
+    wet = model._k2 * e / t + model._k3 * e / t**2
+    hydro = model._k1 * p / t
+    return e, wet, hydro
+
+
+@pytest.mark.parametrize('humidityType', ['q', 'rh'])
+@pytest.mark.parametrize('threads', [1, 4])
+def test_get_refractivity(model, monkeypatch, humidityType, threads):
+    # Split the grid into several blocks even though it is small
+    monkeypatch.setattr(weatherModel, '_REFRACTIVITY_BLOCK_SIZE', 100)
+    monkeypatch.setattr(weatherModel.os, 'cpu_count', lambda: threads)
+
+    shape = (7, 9, 20)
+    rng = np.random.default_rng(0)
+    model._k1, model._k2, model._k3 = 0.776, 0.233, 3.75e3
+    model._humidityType = humidityType
+    # temperatures on both sides of the ice/water blending range
+    t = 220. + 80 * rng.random(shape)
+    p = np.broadcast_to(np.linspace(1e5, 1e4, shape[-1]), shape)
+    humidity = 1e-2 * rng.random(shape) if humidityType == 'q' else 100 * rng.random(shape)
+    model._t, model._p = t, p
+    model._q, model._rh = (humidity, None) if humidityType == 'q' else (None, humidity)
+    model._e = None
+
+    model._get_refractivity()
+
+    e, wet, hydro = _refractivity_reference(model, t, p, humidity)
+    assert np.allclose(model._e, e, rtol=1e-12, atol=0)
+    assert np.allclose(model._wet_refractivity, wet, rtol=1e-12, atol=0)
+    assert np.allclose(model._hydrostatic_refractivity, hydro, rtol=1e-12, atol=0)
+    assert model._q is None and model._rh is None
+
+    # with e known, only the refractivity is computed
+    model._e = 2 * e
+    model._get_refractivity()
+    assert np.allclose(model._wet_refractivity, 2 * wet, rtol=1e-12, atol=0)
+
+
+def test_thread_budget(model, monkeypatch):
+    # The number of threads given to load is used instead of one per core
+    monkeypatch.setattr(weatherModel, '_REFRACTIVITY_BLOCK_SIZE', 100)
+    monkeypatch.setattr(weatherModel, '_GEOH_MIN_COLUMNS', 10)
+    monkeypatch.setattr(weatherModel.os, 'cpu_count', lambda: 16)
+    workers = []
+
+    class Executor(ThreadPoolExecutor):
+        def __init__(self, max_workers):
+            workers.append(max_workers)
+            super().__init__(max_workers)
+
+    monkeypatch.setattr(weatherModel, 'ThreadPoolExecutor', Executor)
+    assert model._max_threads() == 16
+    model._nthreads = 3
+
+    nlev, ny, nx = 20, 7, 9
+    rng = np.random.default_rng(0)
+    model._levels = np.arange(1, nlev + 1)
+    model._a = list(np.concatenate(([0.], np.linspace(2000., 0., nlev))))
+    model._b = list(np.linspace(0., 1., nlev + 1))
+    model._t = 300. - 60 * np.linspace(1, 0, nlev)[:, None, None] + rng.random((nlev, ny, nx))
+    model._q = 1e-2 * rng.random((nlev, ny, nx))
+    model._calculategeoh(1000 * rng.random((ny, nx)), np.log(1e5 + 1e3 * rng.random((ny, nx))))
+
+    model._k1, model._k2, model._k3 = 0.776, 0.233, 3.75e3
+    model._p = np.broadcast_to(np.linspace(1e5, 1e4, nlev)[:, None, None], model._t.shape)
+    model._e = None
+    model._get_refractivity()
+
+    assert workers == [3, 3]
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# Author: Jeremy Maurer, Raymond Hogenson & David Bekaert
+# Copyright 2019, by the California Institute of Technology. ALL RIGHTS
+# RESERVED. United States Government Sponsorship acknowledged.
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+"""
+Managed cache of raw and processed weather model files.
+
+The files themselves stay where RAiDER has always written them (the weather
+model directory); an SQLite index next to them records what each file holds,
+how large it is and when it was last used. Entries are keyed by a hash of the
+product, time, bounds and kind of file, so a file is only re-used for exactly
+the same content. When a size cap is set, the least recently used files are
+removed to stay below it.
+
+The index is safe to share between several raiderDelay processes: every
+operation uses its own connection and write transactions take the database
+lock up front. Filling an entry (downloading or processing a file) can be
+serialized with a per-key file lock so that two processes do not write the
+same file at the same time, and files that are being read are held with a
+shared lock on the same key, which keeps them from being evicted.
+"""
+import argparse
+import contextlib
+import datetime
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from textwrap import dedent
+
+log = logging.getLogger(__name__)
+
+_INDEX_NAME = 'raider_cache.sqlite'
+_LOCK_DIR = '.locks'
+_DB_TIMEOUT = 60.
+# Number of times WeatherModelCache.use gets a file again that was evicted
+# before it could be locked
+_USE_ATTEMPTS = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    model TEXT,
+    time TEXT,
+    south REAL,
+    north REAL,
+    west REAL,
+    east REAL,
+    zref REAL,
+    los TEXT,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_product ON entries (kind, model, time);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+# Columns added to the entries table since it was first created, which are
+# NULL for older entries
+_NEW_COLUMNS = (('zref', 'REAL'), ('los', 'TEXT'))
+
+
+def make_cache_key(kind, model_name, time, ll_bounds=None):
+    '''
+    Return a hex digest identifying the content of a cached file
+
+    Inputs:
+        kind        - kind of file, e.g. 'raw' or 'processed'
+        model_name  - name of the weather model product
+        time        - datetime of the weather model
+        ll_bounds   - optional SNWE bounds of the file
+    '''
+    h = hashlib.sha1()
+    h.update('kind={};model={};time={}'.format(
+        kind, model_name, time.strftime('%Y-%m-%dT%H:%M:%S')).encode()
+    )
+    if ll_bounds is not None:
+        h.update('bounds={}'.format(
+            ','.join('{:.6f}'.format(b) for b in ll_bounds)).encode()
+        )
+    return h.hexdigest()
+
+
+class WeatherModelCache(object):
+    '''
+    Index of the weather model files in a directory
+
+    Inputs:
+        cache_dir  - directory holding the weather model files and the index
+        max_size   - size cap in bytes. If None, the cap stored in the index
+                     (if any) is used
+    '''
+    def __init__(self, cache_dir, max_size=None):
+        self._dir = cache_dir
+        self._db = os.path.join(cache_dir, _INDEX_NAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as con:
+            con.executescript(_SCHEMA)
+        with self._connect(write=True) as con:
+            columns = {row[1] for row in con.execute('PRAGMA table_info(entries)')}
+            for name, sql_type in _NEW_COLUMNS:
+                if name not in columns:
+                    con.execute('ALTER TABLE entries ADD COLUMN {} {}'.format(name, sql_type))
+        self._max_size = max_size
+
+    @contextlib.contextmanager
+    def _connect(self, write=False):
+        '''
+        Open a connection to the index; write connections hold the database
+        lock for the whole transaction
+        '''
+        con = sqlite3.connect(self._db, timeout=_DB_TIMEOUT, isolation_level=None)
+        try:
+            if write:
+                con.execute('BEGIN IMMEDIATE')
+            yield con
+            if write:
+                con.execute('COMMIT')
+        except BaseException:
+            if write and con.in_transaction:
+                con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+
+    @property
+    def max_size(self):
+        '''
+        Size cap in bytes, or None for no cap
+        '''
+        if self._max_size is not None:
+            return self._max_size
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT value FROM settings WHERE name = 'max_size'"
+            ).fetchone()
+        return None if row is None or row[0] is None else int(row[0])
+
+    def set_max_size(self, max_size):
+        '''
+        Store the size cap (in bytes, None to remove it) in the index, so
+        that every process using this cache applies it
+        '''
+        with self._connect(write=True) as con:
+            con.execute(
+                "INSERT OR REPLACE INTO settings (name, value) VALUES ('max_size', ?)",
+                (None if max_size is None else str(int(max_size)),)
+            )
+
+    def lookup(self, key):
+        '''
+        Return the path of the cached file for key and mark it as used, or
+        None if there is no such file
+        '''
+        with self._connect(write=True) as con:
+            row = con.execute('SELECT path FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                log.debug('Cached file %s has been removed, dropping it from the index', row[0])
+                con.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            con.execute(
+                'UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key)
+            )
+        return row[0]
+
+    def find_superset(self, kind, model_name, dt, ll_bounds, zref=None, los=None):
+        '''
+        Return the path of the smallest cached file of the given kind for the
+        same product and time whose bounds contain ll_bounds (SNWE), and mark
+        it as used. If zref is given, only files whose delays are integrated
+        up to zref or higher qualify, and if los is given, only files with
+        that kind of delays (see add). Returns None if there is no such file.
+        '''
+        south, north, west, east = ll_bounds
+        query = (
+            'SELECT key, path FROM entries '
+            'WHERE kind = ? AND model = ? AND time = ? '
+            'AND south <= ? AND north >= ? AND west <= ? AND east >= ? '
+        )
+        args = (
+            kind, model_name, dt.strftime('%Y-%m-%dT%H:%M:%S'),
+            float(south), float(north), float(west), float(east)
+        )
+        if zref is not None:
+            query += 'AND zref >= ? '
+            args += (float(zref),)
+        if los is not None:
+            query += 'AND los = ? '
+            args += (los,)
+        with self._connect(write=True) as con:
+            rows = con.execute(query + 'ORDER BY size ASC', args).fetchall()
+            for key, path in rows:
+                if os.path.exists(path):
+                    con.execute(
+                        'UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key)
+                    )
+                    return path
+                con.execute('DELETE FROM entries WHERE key = ?', (key,))
+        return None
+
+    def _find_key(self, path):
+        '''
+        Return the key of the entry for the file path, or None if it is not
+        in the cache
+        '''
+        with self._connect() as con:
+            row = con.execute(
+                'SELECT key FROM entries WHERE path = ?', (os.path.abspath(path),)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    @contextlib.contextmanager
+    def use(self, get_file):
+        '''
+        Hold a shared lock on a cached file while it is being read, so that
+        other processes do not evict it. get_file() returns the path of the
+        file, creating and adding it to the cache if needed (e.g.
+        fetchWeatherModel); it is called again if the file is evicted before
+        the lock is taken. Yields the path, which may also be None or a file
+        that is not in the cache, in which case no lock is held.
+        '''
+        for _ in range(_USE_ATTEMPTS):
+            path = get_file()
+            if path is None:
+                break
+            key = self._find_key(path)
+            if key is None and os.path.exists(path):
+                break
+            if key is not None:
+                with self.lock(key, shared=True):
+                    if self.lookup(key) is not None:
+                        yield path
+                        return
+            log.debug('Cached file %s was evicted before it could be used', path)
+        yield path
+
+    def add(self, key, path, kind, model_name=None, dt=None, ll_bounds=None, zref=None,
+            los=None):
+        '''
+        Register a file in the cache and evict older files if the cache is
+        now over its size cap. The new file is never evicted.
+
+        For processed weather models, zref is the height up to which the
+        delays at the nodes are integrated and los the kind of delays, e.g.
+        'zenith'; find_superset only re-uses files that match them.
+        '''
+        now = time.time()
+        south, north, west, east = (
+            [float(b) for b in ll_bounds] if ll_bounds is not None else (None,) * 4
+        )
+        with self._connect(write=True) as con:
+            con.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(key, path, kind, model, time, south, north, west, east, zref, los, size, '
+                'created, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    key, os.path.abspath(path), kind, model_name,
+                    None if dt is None else dt.strftime('%Y-%m-%dT%H:%M:%S'),
+                    south, north, west, east, None if zref is None else float(zref), los,
+                    os.path.getsize(path), now, now
+                )
+            )
+        self.evict(keep=(key,))
+
+    def remove(self, key):
+        '''
+        Remove a file and its entry from the cache
+        '''
+        with self._connect(write=True) as con:
+            row = con.execute('SELECT path FROM entries WHERE key = ?', (key,)).fetchone()
+            con.execute('DELETE FROM entries WHERE key = ?', (key,))
+        if row is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(row[0])
+
+    def evict(self, max_size=None, keep=()):
+        '''
+        Remove the least recently used files until the cache is no larger
+        than max_size bytes (the cache's own cap by default). Files that are
+        locked, i.e. being written or read, are skipped. Returns the number
+        of bytes freed.
+        '''
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+
+        freed = 0
+        with self._connect(write=True) as con:
+            total = con.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= max_size:
+                return 0
+            rows = con.execute(
+                'SELECT key, path, size FROM entries ORDER BY last_access ASC'
+            ).fetchall()
+            for key, path, size in rows:
+                if total - freed <= max_size:
+                    break
+                if key in keep:
+                    continue
+                with self.lock(key, blocking=False) as locked:
+                    if not locked:
+                        log.debug('Not evicting %s, which is in use', path)
+                        continue
+                    log.info('Evicting %s from the weather model cache', path)
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                    con.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    freed += size
+        return freed
+
+    def clear(self):
+        '''
+        Remove every file in the cache
+        '''
+        return self.evict(max_size=0)
+
+    def entries(self, kind=None):
+        '''
+        Return the index entries as a list of dictionaries, most recently
+        used first
+        '''
+        query = 'SELECT * FROM entries'
+        args = ()
+        if kind is not None:
+            query += ' WHERE kind = ?'
+            args = (kind,)
+        with self._connect() as con:
+            con.row_factory = sqlite3.Row
+            rows = con.execute(query + ' ORDER BY last_access DESC', args).fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self):
+        '''
+        Return the number of files and bytes per kind of file, the total
+        size and the size cap
+        '''
+        with self._connect() as con:
+            rows = con.execute(
+                'SELECT kind, COUNT(*), SUM(size), MIN(last_access), MAX(last_access) '
+                'FROM entries GROUP BY kind'
+            ).fetchall()
+        kinds = {
+            kind: {'count': count, 'size': size, 'oldest_access': oldest, 'newest_access': newest}
+            for kind, count, size, oldest, newest in rows
+        }
+        return {
+            'directory': self._dir,
+            'kinds': kinds,
+            'count': sum(k['count'] for k in kinds.values()),
+            'size': sum(k['size'] for k in kinds.values()),
+            'max_size': self.max_size,
+        }
+
+    @contextlib.contextmanager
+    def lock(self, key, shared=False, blocking=True):
+        '''
+        Hold an exclusive lock on key while its file is being written, so
+        that concurrent processes wait for each other instead of writing
+        the same file, or a shared lock while it is being read, so that it
+        is not evicted. Locks are per open file, so they also exclude each
+        other within a process.
+
+        Yields whether the lock was taken, which is only False if blocking
+        is False and the key is already locked. A no-op on platforms
+        without fcntl.
+        '''
+        try:
+            import fcntl
+        except ImportError:
+            yield True
+            return
+
+        lock_dir = os.path.join(self._dir, _LOCK_DIR)
+        os.makedirs(lock_dir, exist_ok=True)
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            mode |= fcntl.LOCK_NB
+        with open(os.path.join(lock_dir, '{}.lock'.format(key)), 'w') as f:
+            try:
+                fcntl.flock(f, mode)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def create_parser():
+    """Parse command line arguments using argparse."""
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=dedent("""\
+            Show statistics for, and manage, a RAiDER weather model cache.
+            Usage examples:
+            raiderCache.py weather_files
+            raiderCache.py weather_files --list
+            raiderCache.py weather_files --max_size 50
+            raiderCache.py weather_files --clear
+            """)
+    )
+    p.add_argument(
+        'cache_dir', nargs='?', default='weather_files',
+        help='Weather model directory (default: weather_files)')
+    p.add_argument(
+        '--list', action='store_true', default=False,
+        help='List every file in the cache, most recently used first')
+    p.add_argument(
+        '--max_size', type=float, default=None,
+        help='Set the size cap of the cache in GB and evict files to meet it. '
+             'A negative value removes the cap')
+    p.add_argument(
+        '--clear', action='store_true', default=False,
+        help='Remove every file in the cache')
+    return p
+
+
+def _fmt_size(nbytes):
+    return '{:.2f} GB'.format(nbytes / 1e9)
+
+
+def _fmt_time(t):
+    if t is None:
+        return '-'
+    return datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def parseCMD():
+    """
+    Parse command-line arguments and report on the cache
+    """
+    args = create_parser().parse_args()
+    if not os.path.exists(os.path.join(args.cache_dir, _INDEX_NAME)):
+        raise RuntimeError('No weather model cache found in {}'.format(args.cache_dir))
+    cache = WeatherModelCache(args.cache_dir)
+
+    if args.max_size is not None:
+        cache.set_max_size(None if args.max_size < 0 else args.max_size * 1e9)
+        freed = cache.evict()
+        print('Freed {}'.format(_fmt_size(freed)))
+    if args.clear:
+        freed = cache.clear()
+        print('Freed {}'.format(_fmt_size(freed)))
+
+    stats = cache.stats()
+    print('Cache directory: {}'.format(stats['directory']))
+    print('Files:           {}'.format(stats['count']))
+    print('Total size:      {}'.format(_fmt_size(stats['size'])))
+    print('Size cap:        {}'.format(
+        'none' if stats['max_size'] is None else _fmt_size(stats['max_size'])))
+    for kind, k in sorted(stats['kinds'].items()):
+        print('  {:<10s} {:>5d} files {:>10s}  last used {}'.format(
+            kind, k['count'], _fmt_size(k['size']), _fmt_time(k['newest_access'])))
+
+    if args.list:
+        for e in cache.entries():
+            print('{} {:<10s} {:>10s} {}'.format(
+                _fmt_time(e['last_access']), e['kind'], _fmt_size(e['size']), e['path']))
@@ -3,13 +3,13 @@ import os
 from RAiDER.cli.validators import BBoxAction, IntegerMappingType
 
 
-def add_cpus(parser):
+def add_cpus(parser, default=8):
     parser.add_argument(
         '--cpus',
         help='The number of cpus to be used for multiprocessing or "all" for '
-             'all available cpus.',
+             'all available cpus. Default %(default)s',
         type=IntegerMappingType(0, all=os.cpu_count()),
-        default=8,
+        default=default,
     )
 
 
@@ -11,6 +11,9 @@ import numpy as np
 _ZMIN = np.float64(-100)   # minimum required height
 _ZREF = np.float64(15000)  # maximum requierd height
 _STEP = np.float64(15.0)     # integration step size in meters
+_STRETCH = np.float64(8000.)  # growth length of the stretched integration grid in meters
+_QUAD_TOL = np.float64(1e-4)  # adaptive integration tolerance in meters of delay
+_H_SCALE = np.float64(8000.)  # scale height of the hydrostatic refractivity in meters
 
 _g0 = np.float64(9.80665)
 
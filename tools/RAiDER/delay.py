@@ -6,20 +6,28 @@
 # RESERVED. United States Government Sponsorship acknowledged.
 #
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+import contextlib
+import copy
+import datetime
 import logging
 import os
+from functools import partial
 
 import h5py
 import numpy as np
 
 import RAiDER.delayFcns
-from RAiDER.constants import _STEP, _ZREF, Zenith
+from RAiDER.cache import WeatherModelCache, make_cache_key
+from RAiDER.constants import _QUAD_TOL, _STEP, _ZREF, Zenith
 from RAiDER.interpolator import interp_along_axis
 from RAiDER.llreader import getHeights
 from RAiDER.losreader import getLookVectors
-from RAiDER.processWM import prepareWeatherModel
+from RAiDER.processWM import (
+    cropWeatherModelFile, interpolateWeatherModelFilesInTime, prepareWeatherModel
+)
 from RAiDER.utilFcns import (
-    make_weather_model_filename, writeDelays, writePnts2HDF5
+    get_bracketing_times, make_geom_hash, make_weather_model_filename, writeDelays,
+    writePnts2HDF5
 )
 
 log = logging.getLogger(__name__)
@@ -28,7 +36,8 @@ log = logging.getLogger(__name__)
 def interpolateDelay(weather_model_file_name, pnts_file_name,
                      zlevels=None, zref=_ZREF, stepSize=_STEP,
                      interpType='rgi', nproc=8,
-                     useDask=False, delayType="Zenith"):
+                     useDask=False, delayType="Zenith", cpu_num=0,
+                     quadrature='rectangle', tol=_QUAD_TOL, zcut=None):
     """
     This function calculates the line-of-sight vectors, estimates the point-wise refractivity
     index for each one, and then integrates to get the total delay in meters. The point-wise
@@ -42,9 +51,22 @@ def interpolateDelay(weather_model_file_name, pnts_file_name,
      look_vecs  - Grid of look vectors streching from ground point to sensor (cut off at zref)
      stepSize   - Integration step size in meters
      intpType   - Can be one of 'scipy': LinearNDInterpolator, or 'sane': _sane_interpolate.
+                  'pchip' interpolates with a monotone cubic spline in height.
                   Any other string will use the RegularGridInterpolate method
      nproc      - Number of parallel processes to use if useDask is True
      useDask    - use Dask to parallelize ray calculation
+     cpu_num    - Number of processes to use for the ray integration (0 for all)
+     quadrature - Integration rule along the rays, one of
+                  RAiDER.delayFcns.RAY_QUADRATURES. With 'pchip' and 'simpson'
+                  the stepSize can be several times larger at the same
+                  accuracy. 'stretched' samples every stepSize at the ground
+                  and more sparsely aloft, 'adaptive' refines down to tol.
+                  'exact' integrates the linear interpolant cell by cell, so
+                  the stepSize only needs to be small enough to follow the ray
+     tol        - Target error of the 'adaptive' rule in meters of delay
+     zcut       - Optional height in meters above which the delay is not
+                  integrated numerically but mapped from the weather model's
+                  zenith delay, assuming an exponential refractivity profile
 
     Outputs:
      delays     - A list containing the wet and hydrostatic delays for each ground point in
@@ -54,16 +76,19 @@ def interpolateDelay(weather_model_file_name, pnts_file_name,
     log.debug('ZREF = %s', zref)
     log.debug('stepSize = %f', stepSize)
 
-    RAiDER.delayFcns.calculate_rays(pnts_file_name, stepSize)
+    if not RAiDER.delayFcns.rays_computed(pnts_file_name):
+        RAiDER.delayFcns.calculate_rays(pnts_file_name, stepSize)
     return RAiDER.delayFcns.get_delays(
         stepSize, pnts_file_name, weather_model_file_name,
-        interpType=interpType, delayType=delayType
+        interpType=interpType, delayType=delayType, cpu_num=cpu_num,
+        quadrature=quadrature, tol=tol, zcut=zcut
     )
 
 
 def computeDelay(weather_model_file_name, pnts_file_name, useWeatherNodes=False,
                  zlevels=None, zref=_ZREF, out=None, parallel=False,
-                 delayType="Zenith"):
+                 delayType="Zenith", cpu_num=0, stepSize=_STEP,
+                 quadrature='rectangle', tol=_QUAD_TOL, zcut=None):
     """Calculate troposphere delay from command-line arguments.
 
     We do a little bit of preprocessing, then call
@@ -91,22 +116,318 @@ def computeDelay(weather_model_file_name, pnts_file_name, useWeatherNodes=False,
         if zlevels is None:
             return total_wet, total_hydro
         else:
+            if zs_wm.ndim == 3:
+                # native model levels; resample every column to zlevels
+                zlevels = np.broadcast_to(zlevels, zs_wm.shape[:2] + (len(zlevels),))
             wet_delays = interp_along_axis(zs_wm, zlevels, total_wet, axis=-1)
             hydro_delays = interp_along_axis(zs_wm, zlevels, total_hydro, axis=-1)
             return wet_delays, hydro_delays
     else:
         wet, hydro = interpolateDelay(weather_model_file_name, pnts_file_name, zlevels=zlevels,
                                       zref=zref, nproc=nproc, useDask=useDask,
-                                      delayType=delayType)
+                                      delayType=delayType, cpu_num=cpu_num,
+                                      stepSize=stepSize, quadrature=quadrature, tol=tol,
+                                      zcut=zcut)
         log.debug('Finished delay calculation')
 
         return wet, hydro
 
 
+def prepare_geometry(lats, lons, hgts, los, zref, out):
+    '''
+    Compute the look vectors, ray start points and unit look vectors for a set
+    of query points and write them to an HDF5 file under <out>/geom. Files are
+    named by a hash of the inputs, so a file that already exists for the same
+    lats/lons/hgts, zref and LOS source is re-used as-is.
+    '''
+    geom_hash = make_geom_hash(lats, lons, hgts, los, zref)
+    pnts_file = os.path.join(out, 'geom', 'query_points_{}.h5'.format(geom_hash))
+
+    if os.path.exists(pnts_file):
+        if _checkGeomCache(pnts_file, geom_hash):
+            log.info('Re-using cached geometry file %s', pnts_file)
+            return pnts_file
+        log.warning('Geometry file %s is stale or incomplete, re-creating it', pnts_file)
+        os.remove(pnts_file)
+
+    # Convert the line-of-sight inputs to look vectors
+    log.debug('Lats shape is %s', lats.shape)
+    log.debug(
+        'lat/lon box is %f/%f/%f/%f (SNWE)',
+        np.nanmin(lats), np.nanmax(lats), np.nanmin(lons), np.nanmax(lons)
+    )
+    log.debug(
+        'DEM height range is %.2f-%.2f m',
+        np.nanmin(hgts), np.nanmax(hgts)
+    )
+    log.debug('Beginning line-of-sight calculation')
+    look_vecs = getLookVectors(los, lats, lons, hgts, zref)
+
+    # Write to a temporary file first so that an interrupted run never leaves
+    # a partial file behind under the final name
+    tmp_file = '{}.{}.tmp'.format(pnts_file, os.getpid())
+    writePnts2HDF5(lats, lons, hgts, look_vecs, outName=tmp_file)
+    RAiDER.delayFcns.calculate_rays(tmp_file)
+    with h5py.File(tmp_file, 'r+') as f:
+        f.attrs['GeomHash'] = geom_hash
+    os.replace(tmp_file, pnts_file)
+
+    return pnts_file
+
+
+def _checkGeomCache(pnts_file, geom_hash):
+    '''
+    Check that a cached geometry file matches the expected hash and holds
+    fully computed rays
+    '''
+    try:
+        with h5py.File(pnts_file, 'r') as f:
+            return (
+                f.attrs.get('GeomHash') == geom_hash and
+                bool(f.attrs.get('RaysComputed', False))
+            )
+    except OSError:
+        return False
+
+
+def prepare_query_points(los, lats, lons, heights, useWeatherNodes, zref, out):
+    '''
+    Get the heights for a set of lats/lons and set up the query point file.
+    The outputs only depend on the area of interest, so they can be shared
+    between all of the dates of a run.
+
+    Returns:
+        lats, lons, hgts - query point locations
+        pnts_file        - HDF5 file with the rays, or None if the weather
+                           model nodes are used directly
+    '''
+    log.debug('Beginning DEM calculation')
+    lats, lons, hgts = getHeights(lats, lons, heights, useWeatherNodes)
+
+    pnts_file = None
+    if not useWeatherNodes:
+        pnts_file = prepare_geometry(lats, lons, hgts, los, zref, out)
+
+    return lats, lons, hgts, pnts_file
+
+
+def delay_kind(los):
+    '''
+    Kind of delays at the nodes of a processed weather model for los: zenith
+    delays, unless they are the slant delays along a state vector file
+    '''
+    if los is Zenith or los[0] != 'sv':
+        return 'zenith'
+    return 'sv:{}'.format(os.path.abspath(los[1]))
+
+
+def getWeatherModelFile(weather_model, wmLoc, out, lats, lons, ll_bounds, los, zref,
+                        time, download_only=False, cpu_num=0, full_model=False):
+    '''
+    Return the processed weather model file for a date and area, creating
+    it if needed. The file is registered in the weather model cache, and
+    created under the cache lock so that concurrent runs for the same date
+    and area do not both create it.
+
+    A cached processed model for the same date that covers the area, with
+    the same kind of delays integrated at least up to zref, is cropped
+    instead of processing the weather model again. With full_model,
+    and unless the delays at the weather model nodes depend on the orbit,
+    the weather model is processed over its full extent first (see
+    getFullWeatherModelFile), so that it is processed once for all of the
+    areas it covers. That pays off for many overlapping areas, but costs
+    the processing of the whole raw model (e.g. all of CONUS for HRRR) for
+    a single small one, so the model is otherwise only processed for the
+    area of interest. cpu_num limits the number of threads used to process
+    the weather model, 0 for one per core.
+    '''
+    weather_model_name = weather_model['name']
+    wm_filename = make_weather_model_filename(weather_model_name, time, ll_bounds)
+    weather_model_file = os.path.join(wmLoc, wm_filename)
+    cache = WeatherModelCache(wmLoc)
+    cache_key = make_cache_key('processed', weather_model_name, time, ll_bounds)
+    zmax = _ZREF if zref is None else zref
+    kind = delay_kind(los)
+    shared = full_model and kind == 'zenith' and zmax <= _ZREF
+    # Files in the cache are complete. The lock is only needed to create
+    # one, and waits for the processes that are reading it.
+    if cache.lookup(cache_key) is not None:
+        return weather_model_file
+
+    find_superset = partial(
+        cache.find_superset, 'processed', weather_model_name, time, ll_bounds, zref=zmax, los=kind
+    )
+    with cache.lock(cache_key):
+        exists = os.path.exists(weather_model_file)
+        if not exists and shared and find_superset() is None:
+            full_file = getFullWeatherModelFile(
+                weather_model, wmLoc, out, lats, lons, time, download_only, cpu_num
+            )
+            if full_file is None:
+                return None
+
+        if not exists:
+            # A processed model for the same product and time that covers a
+            # larger area, such as the full model if the raw weather model
+            # covers the area of interest, is cropped instead of downloading
+            # and processing the weather model again
+            with cache.use(find_superset) as superset_file:
+                if superset_file is not None:
+                    log.info(
+                        'Cropping the cached weather model %s to the area of interest',
+                        superset_file
+                    )
+                    cropWeatherModelFile(superset_file, weather_model_file, ll_bounds)
+
+        if not os.path.exists(weather_model_file):
+            weather_model, lats, lons = prepareWeatherModel(
+                weather_model, wmLoc, out, lats=lats, lons=lons, los=los, zref=zref,
+                time=time, download_only=download_only, nthreads=cpu_num
+            )
+            try:
+                weather_model.write2HDF5(weather_model_file)
+            except Exception:
+                log.exception("Unable to save weathermodel to file")
+
+            del weather_model
+        elif exists:
+            log.warning(
+                'Weather model already exists, please remove it ("%s") if you want '
+                'to create a new one.', weather_model_file
+            )
+
+        if os.path.exists(weather_model_file) and cache.lookup(cache_key) is None:
+            cache.add(
+                cache_key, weather_model_file, 'processed', weather_model_name,
+                time, ll_bounds, zref=zmax, los=kind
+            )
+
+    return weather_model_file
+
+
+def getFullWeatherModelFile(weather_model, wmLoc, out, lats, lons, time,
+                            download_only=False, cpu_num=0):
+    '''
+    Return the processed weather model file for a date over the full extent
+    of the raw weather model, creating it if needed. It does not depend on
+    the area of interest (lats/lons are only used to download the raw model
+    if it is not there yet) and is registered in the cache with its own
+    bounds, so that getWeatherModelFile crops every area it covers from it.
+    The delays at the nodes are zenith delays up to _ZREF. Returns None if
+    download_only.
+    '''
+    weather_model_name = weather_model['name']
+    weather_model_file = os.path.join(
+        wmLoc, make_weather_model_filename(weather_model_name, time)
+    )
+    cache = WeatherModelCache(wmLoc)
+    cache_key = make_cache_key('processed', weather_model_name, time)
+    if cache.lookup(cache_key) is not None:
+        return weather_model_file
+
+    with cache.lock(cache_key):
+        if cache.lookup(cache_key) is not None:
+            return weather_model_file
+
+        weather_model, _, _ = prepareWeatherModel(
+            weather_model, wmLoc, out, lats=lats, lons=lons, los=Zenith, zref=None,
+            time=time, download_only=download_only, crop=False, nthreads=cpu_num
+        )
+        if download_only:
+            return None
+        weather_model.write2HDF5(weather_model_file)
+
+        with h5py.File(weather_model_file, 'r') as f:
+            wm_lats, wm_lons = f['lat'][()], f['lon'][()]
+        wm_bounds = (
+            np.nanmin(wm_lats), np.nanmax(wm_lats), np.nanmin(wm_lons), np.nanmax(wm_lons)
+        )
+        cache.add(
+            cache_key, weather_model_file, 'processed', weather_model_name, time, wm_bounds,
+            zref=_ZREF, los=delay_kind(Zenith)
+        )
+
+    return weather_model_file
+
+
+def interpolateWeatherModelInTime(weather_model, wmLoc, out, lats, lons, ll_bounds,
+                                  los, zref, time, time_res, download_only=False, cpu_num=0,
+                                  full_model=False):
+    '''
+    Return a processed weather model file linearly interpolated in time
+    between the two model epochs on either side of time. Each epoch is
+    prepared (and cached) like a normal run; the blended file is then used
+    for a single ray-tracing pass.
+
+    time_res   - time resolution of the weather model in hours
+    cpu_num    - number of threads to process the weather model with, 0 for all
+    full_model - process each epoch over the full extent of the weather
+                 model, see getWeatherModelFile
+    '''
+    time1, time2, weight = get_bracketing_times(time, datetime.timedelta(hours=time_res))
+    if weight == 0:
+        return getWeatherModelFile(
+            weather_model, wmLoc, out, lats, lons, ll_bounds, los, zref, time, download_only,
+            cpu_num, full_model
+        )
+
+    log.info(
+        'Interpolating the weather model between %s and %s (weight %.3f)',
+        time1, time2, weight
+    )
+    weather_model_name = '{}_interp'.format(weather_model['name'])
+    weather_model_file = os.path.join(
+        wmLoc, make_weather_model_filename(weather_model_name, time, ll_bounds)
+    )
+    cache = WeatherModelCache(wmLoc)
+    cache_key = make_cache_key('interpolated', weather_model_name, time, ll_bounds)
+    if not download_only and cache.lookup(cache_key) is not None:
+        return weather_model_file
+
+    with contextlib.ExitStack() as stack:
+        # The weather model object keeps per-date state, so each epoch gets
+        # its own copy. Both epochs are kept in the cache until they have
+        # been blended.
+        epoch_files = [
+            stack.enter_context(cache.use(partial(
+                getWeatherModelFile,
+                dict(weather_model, type=copy.deepcopy(weather_model['type'])),
+                wmLoc, out, lats, lons, ll_bounds, los, zref, t, download_only, cpu_num,
+                full_model
+            ))) for t in (time1, time2)
+        ]
+        if download_only:
+            return None
+
+        with cache.lock(cache_key):
+            if cache.lookup(cache_key) is None:
+                interpolateWeatherModelFilesInTime(
+                    *epoch_files, weight, weather_model_file, max_threads=cpu_num
+                )
+                cache.add(
+                    cache_key, weather_model_file, 'interpolated', weather_model_name,
+                    time, ll_bounds
+                )
+
+    return weather_model_file
+
+
 def tropo_delay(los, lats, lons, ll_bounds, heights, flag, weather_model, wmLoc, zref,
-                outformat, time, out, download_only, wetFilename, hydroFilename):
+                outformat, time, out, download_only, wetFilename, hydroFilename,
+                geometry=None, cpu_num=0, interp_time=False, stepSize=_STEP,
+                quadrature='rectangle', tol=_QUAD_TOL, zcut=None, full_model=False):
     """
     raiderDelay main function.
+
+    geometry    - optional output of prepare_query_points, to re-use the heights
+                  and query points across several dates
+    cpu_num     - number of threads to process the weather model with and of
+                  processes to use for the delay integration (0 for all)
+    interp_time - interpolate the weather model linearly in time between the
+                  two model epochs on either side of time
+    stepSize, quadrature, tol, zcut - integration along the rays, see interpolateDelay
+    full_model  - process the weather model over its full extent and crop the
+                  area of interest from it, see getWeatherModelFile
     """
 
     log.debug('Starting to run the weather model calculation')
@@ -119,6 +440,12 @@ def tropo_delay(los, lats, lons, ll_bounds, heights, flag, weather_model, wmLoc,
     useWeatherNodes = flag == 'bounding_box'
     delayType = ["Zenith" if los is Zenith else "LOS"]
 
+    if zcut is not None and los is not Zenith and los[0] == 'sv':
+        # The weather model then holds the slant delays above its nodes
+        # instead of the zenith delays that the correction above zcut maps
+        log.warning('zcut is not supported with state vectors; integrating up to zref')
+        zcut = None
+
     # location of the weather model files
     log.debug('Beginning weather model pre-processing')
     log.debug('Download-only is %s', download_only)
@@ -126,58 +453,42 @@ def tropo_delay(los, lats, lons, ll_bounds, heights, flag, weather_model, wmLoc,
         wmLoc = os.path.join(out, 'weather_files')
 
     # weather model calculation
-    wm_filename = make_weather_model_filename(weather_model['name'], time, ll_bounds)
-    weather_model_file = os.path.join(wmLoc, wm_filename)
-    if not os.path.exists(weather_model_file):
-        weather_model, lats, lons = prepareWeatherModel(
-            weather_model, wmLoc, out, lats=lats, lons=lons, los=los, zref=zref,
-            time=time, download_only=download_only
+    time_res = getattr(weather_model['type'], '_time_res', None)
+    if interp_time and (weather_model['files'] is not None or time_res is None):
+        log.warning(
+            'Cannot interpolate %s in time; using the weather model closest '
+            'to %s instead', weather_model['name'], time
         )
-        try:
-            weather_model.write2HDF5(weather_model_file)
-        except Exception:
-            log.exception("Unable to save weathermodel to file")
+        interp_time = False
 
-        del weather_model
+    if interp_time:
+        get_file = partial(
+            interpolateWeatherModelInTime, weather_model, wmLoc, out, lats, lons, ll_bounds,
+            los, zref, time, time_res, download_only, cpu_num, full_model
+        )
     else:
-        log.warning(
-            'Weather model already exists, please remove it ("%s") if you want '
-            'to create a new one.', weather_model_file
+        get_file = partial(
+            getWeatherModelFile, weather_model, wmLoc, out, lats, lons, ll_bounds, los, zref,
+            time, download_only, cpu_num, full_model
         )
 
-    if download_only:
-        return None, None
-
-    # Pull the DEM.
-    log.debug('Beginning DEM calculation')
-    in_shape = lats.shape
-    lats, lons, hgts = getHeights(lats, lons, heights, useWeatherNodes)
+    # The processed weather model stays in the cache until the delays have
+    # been computed
+    with WeatherModelCache(wmLoc).use(get_file) as weather_model_file:
+        if download_only:
+            return None, None
 
-    pnts_file = None
-    if not useWeatherNodes:
-        pnts_file = os.path.join(out, 'geom', 'query_points.h5')
-        if not os.path.exists(pnts_file):
-
-            # Convert the line-of-sight inputs to look vectors
-            log.debug('Lats shape is %s', lats.shape)
-            log.debug(
-                'lat/lon box is %f/%f/%f/%f (SNWE)',
-                np.nanmin(lats), np.nanmax(lats), np.nanmin(lons), np.nanmax(lons)
-            )
-            log.debug(
-                'DEM height range is %.2f-%.2f m',
-                np.nanmin(hgts), np.nanmax(hgts)
-            )
-            log.debug('Beginning line-of-sight calculation')
-            los = getLookVectors(los, lats, lons, hgts, zref)
-
-            # write to an HDF5 file
-            writePnts2HDF5(lats, lons, hgts, los, outName=pnts_file)
+        # Pull the DEM and set up the query points, unless this has already been
+        # done for us (e.g. once for a whole stack of dates)
+        if geometry is None:
+            geometry = prepare_query_points(los, lats, lons, heights, useWeatherNodes, zref, out)
+        lats, lons, hgts, pnts_file = geometry
 
-    wetDelay, hydroDelay = computeDelay(
-        weather_model_file, pnts_file, useWeatherNodes, zref, out,
-        delayType=delayType
-    )
+        wetDelay, hydroDelay = computeDelay(
+            weather_model_file, pnts_file, useWeatherNodes, zref, out,
+            delayType=delayType, cpu_num=cpu_num, stepSize=stepSize,
+            quadrature=quadrature, tol=tol, zcut=zcut
+        )
 
     if heights[0] == 'lvs':
         outName = wetFilename.replace('wet', 'delays')
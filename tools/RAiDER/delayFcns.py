@@ -16,9 +16,14 @@ import numpy as np
 from pyproj import CRS, Transformer
 from scipy.interpolate import RegularGridInterpolator
 
-from RAiDER.constants import _STEP
+from RAiDER.constants import _H_SCALE, _QUAD_TOL, _STEP, _STRETCH
+from RAiDER.interpolator import ColumnGridInterpolator
 from RAiDER.interpolator import RegularGridInterpolator as Interpolator
 from RAiDER.makePoints import makePoints1D
+from RAiDER.processWM import readWeatherModelFile
+from RAiDER.quadrature import (
+    QuadratureResult, adaptive_simpson, exponential_mapping, integrate_stretched
+)
 
 log = logging.getLogger(__name__)
 
@@ -38,6 +43,18 @@ def calculate_rays(pnts_file, stepSize=_STEP):
     # system and sorts by position
     lla2ecef(pnts_file)
 
+    with h5py.File(pnts_file, 'r+') as f:
+        f.attrs['RaysComputed'] = True
+
+
+def rays_computed(pnts_file):
+    '''
+    Check whether the ray start points and look vectors have already been
+    computed for a query point file
+    '''
+    with h5py.File(pnts_file, 'r') as f:
+        return bool(f.attrs.get('RaysComputed', False))
+
 
 def getUnitLVs(pnts_file):
     '''
@@ -89,44 +106,125 @@ def lla2ecef(pnts_file):
 
 
 def get_delays(stepSize, pnts_file, wm_file, interpType='3D',
-               delayType="Zenith", cpu_num=0):
+               delayType="Zenith", cpu_num=0, quadrature='rectangle', tol=_QUAD_TOL,
+               zcut=None, return_counts=False):
     '''
     Create the integration points for each ray path.
+
+    interpType 'pchip' interpolates the refractivity with a monotone cubic
+    spline in height instead of linearly, and quadrature is one of
+    RAY_QUADRATURES. For the rules in _QUADRATURE_RULES the rays are sampled
+    every stepSize meters; with 'pchip' and 'simpson' stepSize can be
+    several times larger. The other rules are:
+
+      'stretched' - Simpson's rule on samples spaced stepSize apart at the
+                    ground, further apart aloft as refractivity decays
+      'adaptive'  - adaptive Simpson down to tol meters of delay per ray,
+                    refining no finer than stepSize
+      'exact'     - integrates the linear interpolant exactly in every grid
+                    cell the ray crosses, so that stepSize only has to
+                    resolve the bending of the ray in the weather model
+                    projection
+
+    If zcut is given, the rays are only integrated up to that height and the
+    delay of the rest of each ray is added analytically, see
+    _add_top_correction. The refractivity there is mostly
+    hydrostatic and smooth; for a zcut of 8 km this halves the number of
+    samples compared to the default zref of 15 km, and is accurate to about
+    0.1 mm at 20 degrees and 1 mm at 5 degrees elevation.
+
+    Each ray ends at zref or at the top of the weather model, whichever is
+    lower. The number of refractivity evaluations and the estimated
+    integration error are logged, along with the rays that had samples
+    outside of the weather model, which count as zero, or that reach above
+    its top. With return_counts these are also returned per ray, as a
+    dictionary of arrays of the same shape as the delays with the keys
+    'evaluations', 'filled' and 'truncated'; the latter is the number of
+    samples of stepSize missing above the model top.
+
+    Pixels without data, whose start point or look vector is NaN, are left
+    out before any rays are generated and get the NoDataValue of the query
+    point file and zero counts.
     '''
+    if quadrature not in RAY_QUADRATURES:
+        raise ValueError("Unknown quadrature rule '{}'".format(quadrature))
+    if quadrature == 'exact' and interpType == 'pchip':
+        raise ValueError("quadrature='exact' requires linear interpolation")
+    if zcut is not None and zcut <= 0:
+        raise ValueError('zcut must be a positive height in meters')
 
     t0 = time.time()
 
-    # Get the weather model data
-    with h5py.File(wm_file, 'r') as f:
-        xs_wm = f['x'][()].copy()
-        ys_wm = f['y'][()].copy()
-        zs_wm = f['z'][()].copy()
-        wet = f['wet'][()].copy()
-        hydro = f['hydro'][()].copy()
-
-    ifWet = Interpolator((ys_wm, xs_wm, zs_wm), wet, fill_value=np.nan)
-    ifHydro = Interpolator((ys_wm, xs_wm, zs_wm), hydro, fill_value=np.nan)
-
     with h5py.File(pnts_file, 'r') as f:
-        Nrays = f.attrs['NumRays']
         chunkSize = f.attrs['ChunkSize']
-        in_shape = f['lon'].attrs['Shape']
-        arrSize = f['lon'].shape
+        ndv = f.attrs['NoDataValue']
+        in_shape = tuple(f['lon'].attrs['Shape'])
         max_len = np.nanmax(f['Rays_len'])
+        SP = np.array(f['Rays_SP']).reshape(-1, 3)
+        SLV = np.array(f['Rays_SLV']).reshape(-1, 3)
+        lengths = np.array(f['Rays_len']).ravel()
+
+    # Only the rays of valid pixels are generated and integrated; no-data
+    # pixels, e.g. water masked or in the gaps between bursts, start at NaN
+    valid = np.flatnonzero(np.all(np.isfinite(SP), axis=-1) & np.all(np.isfinite(SLV), axis=-1))
+    SP, SLV, lengths = SP[valid], SLV[valid], lengths[valid]
+    Nrays = len(valid)
+
+    # Get the part of the weather model data the rays go through
+    names = ('x', 'y', 'z', 'wet', 'hydro')
+    if zcut is not None:
+        names += ('wet_total', 'hydro_total')
+    xs_wm, ys_wm, zs_wm, wet, hydro, *totals = readWeatherModelFile(
+        wm_file, names, ll_bounds=get_ray_bounds(pnts_file, max_len)
+    )
 
-    CHUNKS = chunk(chunkSize, in_shape)
-    Nchunks = len(CHUNKS)
+    method = 'pchip' if interpType == 'pchip' else 'linear'
+    ifWet, ifHydro = _make_interpolators(xs_wm, ys_wm, zs_wm, (wet, hydro), method)
 
-    with h5py.File(pnts_file, 'r') as f:
-        chunk_inputs = [(kk, CHUNKS[kk], np.array(f['Rays_SP']), np.array(f['Rays_SLV']),
-                         chunkSize, stepSize, ifWet, ifHydro, max_len, wm_file) for kk in range(Nchunks)]
+    top = None
+    if zcut is not None:
+        # The zenith delays above each node decay exponentially, which the
+        # monotone spline follows much more closely between levels
+        top = (zcut,) + _make_interpolators(xs_wm, ys_wm, zs_wm, totals, 'pchip')
 
-        with mp.Pool() as pool:
-            individual_results = pool.starmap(process_chunk, chunk_inputs)
-        delays = np.concatenate(individual_results)
+    # The valid rays are chunked as a flat list, with as many rays per chunk
+    # as the chunks of the query point file
+    rays_per_chunk = (int(np.prod(chunkSize)),)
+    CHUNKS = chunk(rays_per_chunk, (Nrays,))
+    Nchunks = len(CHUNKS)
 
-    wet_delay = delays[0, ...].reshape(in_shape)
-    hydro_delay = delays[1, ...].reshape(in_shape)
+    chunk_inputs = [(kk, CHUNKS[kk], SP, SLV, rays_per_chunk, stepSize, ifWet, ifHydro, max_len,
+                     wm_file, quadrature, tol, top, lengths)
+                    for kk in range(Nchunks)]
+
+    with mp.Pool(cpu_num if cpu_num > 0 else None) as pool:
+        individual_results = pool.starmap(process_chunk, chunk_inputs)
+
+    # Put each chunk of rays back in its place; the no-data pixels get the
+    # no-data value and no samples
+    size = int(np.prod(in_shape))
+    wet_delay, hydro_delay = np.full(size, ndv, dtype=np.float64), np.full(size, ndv, dtype=np.float64)
+    counts = {name: np.zeros(size, dtype=int) for name in ('evaluations', 'filled', 'truncated')}
+    error = np.zeros((2, size))
+    for chunkInds, (result, truncated) in zip(CHUNKS, individual_results):
+        inds = valid[chunkInds[0]]
+        wet_delay[inds], hydro_delay[inds] = result.integrals
+        error[:, inds] = result.error
+        counts['evaluations'][inds] = result.evaluations
+        counts['filled'][inds] = result.filled
+        counts['truncated'][inds] = truncated
+    wet_delay, hydro_delay = wet_delay.reshape(in_shape), hydro_delay.reshape(in_shape)
+    counts = {name: count.reshape(in_shape) for name, count in counts.items()}
+
+    log.info(
+        'Integrated %d rays with the %s rule: %.1f refractivity samples per ray, '
+        'estimated error up to %.3g m wet and %.3g m hydrostatic',
+        Nrays, quadrature, np.mean(counts['evaluations'].ravel()[valid]) if Nrays else 0,
+        np.max(error[0], initial=0), np.max(error[1], initial=0)
+    )
+    if Nrays < size:
+        log.info('Skipped %d no-data pixels out of %d', size - Nrays, size)
+    _log_counts(counts, stepSize)
 
     time_elapse = (time.time() - t0)
     with open('get_delays_time_elapse.txt', 'w') as f:
@@ -138,13 +236,82 @@ def get_delays(stepSize, pnts_file, wm_file, interpType='3D',
         "Delay estimation cost %d hour(s) %d minute(s) %d second(s) using %d cpu threads",
         time_elapse_hr, time_elapse_min, time_elapse_sec, cpu_num
     )
+    if return_counts:
+        return wet_delay, hydro_delay, counts
     return wet_delay, hydro_delay
 
 
-def make_interpolator(xs, ys, zs, data):
+def _log_counts(counts, stepSize):
+    '''
+    Warn about the rays of get_delays that were not entirely inside the
+    weather model
+    '''
+    filled = counts['filled']
+    if np.any(filled):
+        log.warning(
+            '%d rays had %d samples outside of the weather model, e.g. below its '
+            'lowest level, which were counted as zero (up to %d per ray)',
+            np.count_nonzero(filled), np.sum(filled), np.max(filled)
+        )
+    truncated = counts['truncated']
+    if np.any(truncated):
+        log.warning(
+            '%d rays reach above the top of the weather model; up to %.0f m of '
+            'each of them is missing from the delays',
+            np.count_nonzero(truncated), np.max(truncated) * stepSize
+        )
+
+
+def _make_interpolators(xs, ys, zs, fields, method='linear'):
+    '''
+    Interpolators of each of the fields of a processed weather model, in the
+    (y, x, z) order of its grid. The chunks already run in parallel
+    processes, so each interpolator sticks to a single thread.
+    '''
+    if zs.ndim == 3:
+        # native model levels, each column with its own heights
+        return tuple(
+            ColumnGridInterpolator((ys, xs), zs, data, fill_value=np.nan, max_threads=1, method=method)
+            for data in fields
+        )
+    return tuple(
+        Interpolator((ys, xs, zs), data, fill_value=np.nan, max_threads=1, method=method)
+        for data in fields
+    )
+
+
+def get_ray_bounds(pnts_file, max_len):
     '''
-    Function to create and return an Interpolator object
+    Return the lat/lon bounds (SNWE) of the rays of a query point file, which
+    run from their start points along their look vectors for max_len meters;
+    or None if there are no valid rays.
     '''
+    with h5py.File(pnts_file, 'r') as f:
+        sp = f['Rays_SP'][()].reshape(-1, 3)
+        slv = f['Rays_SLV'][()].reshape(-1, 3)
+    ends = np.concatenate((sp, sp + max_len * slv))
+
+    t = Transformer.from_crs(4978, 4326, always_xy=True)
+    lon, lat, _ = t.transform(ends[:, 0], ends[:, 1], ends[:, 2])
+    if np.all(np.isnan(lat)) or np.all(np.isnan(lon)):
+        return None
+    return np.nanmin(lat), np.nanmax(lat), np.nanmin(lon), np.nanmax(lon)
+
+
+def make_interpolator(xs, ys, zs, data, max_threads=0):
+    '''
+    Function to create and return an Interpolator object. If zs is 3D, it
+    holds the height of every grid node and the grid is interpolated column
+    by column, using up to max_threads threads (0 for one per core).
+    '''
+    if np.ndim(zs) == 3:
+        return ColumnGridInterpolator(
+            (ys.ravel(), xs.ravel()),
+            zs,
+            data,
+            fill_value=np.nan,
+            max_threads=max_threads
+        )
     return RegularGridInterpolator(
         (ys.ravel(), xs.ravel(), zs.ravel()),
         data,
@@ -240,9 +407,25 @@ def makeChunksFromInds(startInd, chunkSize, in_shape):
     return chunks
 
 
-def process_chunk(k, chunkInds, SP, SLV, chunkSize, stepSize, ifWet, ifHydro, max_len, wm_file):
+def process_chunk(k, chunkInds, SP, SLV, chunkSize, stepSize, ifWet, ifHydro, max_len, wm_file,
+                  quadrature='rectangle', tol=_QUAD_TOL, top=None, lengths=None):
     """
-    Perform the interpolation and integration over a single chunk.
+    Perform the interpolation and integration over a single chunk. The start
+    points and look vectors of the rays must be finite; get_delays leaves out
+    the no-data pixels.
+
+    Each ray ends at its length in lengths, i.e. at zref, or at the top of
+    the weather model if that is lower; without lengths every ray is max_len
+    long. top is an optional tuple of a cutoff height and the interpolators
+    of the wet and hydrostatic zenith delays above each weather model node.
+    The rays are then integrated up to the cutoff and the rest of them is
+    added by _add_top_correction.
+
+    Returns a QuadratureResult of the wet and hydrostatic delays of each ray
+    in meters, the number of points sampled along each ray, the estimated
+    error of the delays and the number of samples outside of the weather
+    model, e.g. below its lowest level; and the number of samples of
+    stepSize that each ray is missing above the top of the weather model.
     """
     # Transformer from ECEF to weather model
     p1 = CRS.from_epsg(4978)
@@ -252,25 +435,179 @@ def process_chunk(k, chunkInds, SP, SLV, chunkSize, stepSize, ifWet, ifHydro, ma
     # datatype must be specific for the cython makePoints* function
     _DTYPE = np.float64
 
+    if lengths is None:
+        lengths = np.full(SP.shape[:-1], max_len)
+
     # H5PY does not support fancy indexing with tuples, hence this if/else check
     if len(chunkSize) == 1:
         row = chunkInds[0]
-        ray = makePoints1D(max_len, SP[row, :].astype(_DTYPE), SLV[row, :].astype(_DTYPE), stepSize)
+        sp, slv, ray_len = SP[row, :], SLV[row, :], lengths[row]
     elif len(chunkSize) == 2:
         row, col = chunkInds
-        ray = makePoints1D(max_len, SP[row, col, :].astype(_DTYPE), SLV[row, col, :].astype(_DTYPE), stepSize)
+        sp, slv, ray_len = SP[row, col, :], SLV[row, col, :], lengths[row, col]
     elif len(chunkSize) == 3:
         row, col, zind = chunkInds
-        ray = makePoints1D(max_len, SP[row, col, zind, :].astype(_DTYPE), SLV[row, col, zind, :].astype(_DTYPE), stepSize)
+        sp, slv, ray_len = SP[row, col, zind, :], SLV[row, col, zind, :], lengths[row, col, zind]
     else:
         raise RuntimeError('Data in more than 4 dimensions is not supported')
+    sp, slv = sp.astype(_DTYPE), slv.astype(_DTYPE)
+    num_rays = len(sp)
+
+    def refractivity(rays):
+        # rays[..., 3, N] are ECEF points along the rays
+        x, y, z = t.transform(rays[..., 0, :], rays[..., 1, :], rays[..., 2, :])
+        return np.stack([interpolate2(fun, x, y, z) for fun in (ifWet, ifHydro)])
+
+    # Stop each ray where it leaves the top of the weather model, above
+    # which the samples would all be NaN, or at the cutoff. The samples of
+    # rays that are cut short by the model are counted as truncated. The
+    # last sample is kept a centimeter below the top, inside of the grid
+    # despite rounding.
+    model_top = _model_top(ifWet)
+    top_len = np.nan_to_num(_length_to_height(t, sp, slv, ray_len, model_top - 0.01))
+    truncated = np.floor(np.maximum(ray_len - top_len, 0) / stepSize).astype(int)
+    length = top_len
+    if top is not None and top[0] < model_top:
+        length = np.nan_to_num(_length_to_height(t, sp, slv, top_len, top[0]))
+
+    if quadrature == 'stretched':
+        # Refractivity decays with height, which grows along each ray with
+        # the sine of its elevation angle
+        sin_elevation = np.sum(slv * sp, axis=-1) / np.linalg.norm(sp, axis=-1)
+        result = integrate_stretched(
+            lambda s: refractivity(sp[..., np.newaxis] + slv[..., np.newaxis] * s[:, np.newaxis, :]),
+            num_rays, length, stepSize, scale=_STRETCH / np.clip(sin_elevation, 0.05, 1)
+        )
+        result = result._replace(integrals=1e-6 * result.integrals, error=1e-6 * result.error)
+        end = length
+    elif quadrature == 'adaptive':
+        result = adaptive_simpson(
+            lambda rays, s: refractivity((sp[rays] + slv[rays] * s[:, np.newaxis]).T),
+            num_rays, length, 1e6 * tol, stepSize
+        )
+        result = result._replace(integrals=1e-6 * result.integrals, error=1e-6 * result.error)
+        end = length
+    else:
+        # Sample each ray every stepSize up to its end, and once more right
+        # at the end
+        Npts = np.floor(length / stepSize).astype(int) + 1
+        ray = makePoints1D((np.max(Npts) - 0.5) * stepSize, sp, slv, stepSize)
+        ray_x, ray_y, ray_z = t.transform(ray[..., 0, :], ray[..., 1, :], ray[..., 2, :])
+        end_values = refractivity((sp + slv * length[:, np.newaxis])[..., np.newaxis])[..., 0]
+
+        if quadrature == 'exact':
+            ray_x[np.arange(ray_x.shape[-1]) >= Npts[:, np.newaxis]] = np.nan
+            result = _integrateLOSExact(
+                stepSize, ifWet, ifHydro, ray_x, ray_y, ray_z, length=length, end_values=end_values
+            )
+        else:
+            delay_wet = interpolate2(ifWet, ray_x, ray_y, ray_z)
+            delay_hydro = interpolate2(ifHydro, ray_x, ray_y, ray_z)
+            result = _integrateLOSWithError(
+                stepSize, delay_wet, delay_hydro, Npts=Npts, rule=quadrature,
+                length=length, end_values=end_values
+            )
+
+    if top is not None:
+        result = _add_top_correction(result, t, sp, slv, length, top_len, (ifWet, ifHydro), top[1:])
+    return result, truncated
+
+
+def _add_top_correction(result, t, SP, SLV, distance, ray_len, refractivity, totals):
+    '''
+    Add the delay between distance and ray_len along each ray to a
+    QuadratureResult. It is the zenith delay of that layer times the
+    exponential_mapping of the ray across it, both for the wet and
+    hydrostatic part. refractivity and totals are their interpolators of the
+    refractivity and of the zenith delay above each weather model node.
+
+    The scale height of each part is fitted to its zenith delay and its
+    refractivity at the bottom of the layer, which holds exactly for an
+    exponential profile, or _H_SCALE where that is not defined. The error is
+    the change of the mapping with the scale height fitted halfway up the
+    layer instead.
+
+    Heights are above the ellipsoid, so the elevation angle is taken from
+    its normal rather than from the geocentric radius; the two differ by up
+    to 0.2 degrees, which is several percent of the mapping near the horizon.
+    '''
+    start = SP + SLV * distance[:, np.newaxis]
+    _, _, top = t.transform(*(SP + SLV * ray_len[:, np.newaxis]).T)
+    zenith, scale, depth = _fit_layer(t, start, top, refractivity, totals)
+
+    ellipsoid = CRS.from_epsg(4326).ellipsoid
+    normal = start / np.array([ellipsoid.semi_major_metre, ellipsoid.semi_major_metre, ellipsoid.semi_minor_metre]) ** 2
+    normal /= np.linalg.norm(normal, axis=-1, keepdims=True)
+    radius = np.linalg.norm(start, axis=-1)
+    sin_elevation = np.sum(SLV * normal, axis=-1)
+    mapping = exponential_mapping(sin_elevation, radius, scale, depth)
+
+    middle = SP + SLV * ((distance + ray_len) / 2)[:, np.newaxis]
+    _, scale_middle, _ = _fit_layer(t, middle, top, refractivity, totals)
+    error = np.abs(exponential_mapping(sin_elevation, radius, scale_middle, depth) - mapping)
+
+    return result._replace(
+        integrals=result.integrals + zenith * mapping,
+        evaluations=result.evaluations + 4,
+        error=result.error + zenith * error
+    )
 
-    ray_x, ray_y, ray_z = t.transform(ray[..., 0, :], ray[..., 1, :], ray[..., 2, :])
-    delay_wet = interpolate2(ifWet, ray_x, ray_y, ray_z)
-    delay_hydro = interpolate2(ifHydro, ray_x, ray_y, ray_z)
-    int_delays = _integrateLOS(stepSize, delay_wet, delay_hydro)
 
-    return int_delays
+def _fit_layer(t, points, top, refractivity, totals):
+    '''
+    Return the wet and hydrostatic zenith delays from the ECEF points up to
+    the heights top, the scale heights of the exponential profiles that fit
+    them and the refractivity at the points, and the depths of the layers
+    '''
+    x, y, z = t.transform(points[..., 0], points[..., 1], points[..., 2])
+    depth = np.maximum(np.nan_to_num(top - z), 0)
+    zenith = np.stack([
+        np.nan_to_num(interpolate2(fun, x, y, z)) - np.nan_to_num(interpolate2(fun, x, y, top))
+        for fun in totals
+    ])
+    refr = np.nan_to_num(np.stack([interpolate2(fun, x, y, z) for fun in refractivity]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = 1e6 * zenith / refr
+    ratio = np.where(np.isfinite(ratio) & (ratio > 0), ratio, np.nan)
+
+    # ratio = H * (1 - exp(-depth / H)) grows with the scale height H, so
+    # bisect for it between ratio and a thousand times that
+    lo, hi = np.log(ratio), np.log(1e3 * ratio)
+    for _ in range(40):
+        mid = (lo + hi) / 2
+        scale = np.exp(mid)
+        below = scale * -np.expm1(-depth / scale) < ratio
+        lo, hi = np.where(below, mid, lo), np.where(below, hi, mid)
+    scale = np.where(np.isnan(ratio), _H_SCALE, np.exp((lo + hi) / 2))
+    return zenith, scale, depth
+
+
+def _model_top(fun):
+    '''
+    Height of the top of the weather model grid of an interpolator, the
+    lowest one for native model levels
+    '''
+    if isinstance(fun, ColumnGridInterpolator):
+        return np.nanmin(fun.heights[..., -1])
+    return fun.grid[-1][-1]
+
+
+def _length_to_height(t, SP, SLV, max_len, height):
+    '''
+    Distance along each ray at which it reaches the given height in the
+    weather model projection of the transformer t, at most max_len, which
+    may be given per ray
+    '''
+    longest = np.max(max_len)
+    s = np.linspace(0, longest, max(int(np.ceil(longest / 1000)), 1) + 1)
+    rays = SP[..., np.newaxis] + SLV[..., np.newaxis] * s
+    _, _, z = t.transform(rays[..., 0, :], rays[..., 1, :], rays[..., 2, :])
+    # Heights increase along the rays, so interpolate linearly between the
+    # samples on either side
+    hi = np.clip(np.sum(z < height, axis=-1, keepdims=True), 1, len(s) - 1)
+    z0, z1 = np.take_along_axis(z, hi - 1, -1), np.take_along_axis(z, hi, -1)
+    frac = np.clip((height - z0) / (z1 - z0), 0, 1)
+    return np.minimum((s[hi - 1] + frac * (s[hi] - s[hi - 1]))[..., 0], max_len)
 
 
 def getProjFromWMFile(wm_file):
@@ -286,23 +623,105 @@ def interpolate2(fun, x, y, z):
     '''
     helper function to make the interpolation step cleaner
     '''
-    in_shape = x.shape
-    out = fun((y.ravel(), x.ravel(), z.ravel()))  # note that this re-ordering is on purpose to match the weather model
-    outData = out.reshape(in_shape)
-    return outData
+    # note that this re-ordering is on purpose to match the weather model
+    return fun((y, x, z))
 
 
-def _integrateLOS(stepSize, wet_pw, hydro_pw, Npts=None):
+def _integrateLOS(stepSize, wet_pw, hydro_pw, Npts=None, rule='rectangle'):
     delays = []
     for d in (wet_pw, hydro_pw):
         if d.ndim == 1:
-            delays.append(np.array([int_fcn(d, stepSize)]))
+            delays.append(np.array([int_fcn(d, stepSize, rule=rule)]))
         else:
-            delays.append(_integrate_delays(stepSize, d, Npts))
+            delays.append(_integrate_delays(stepSize, d, Npts, rule=rule))
     return np.stack(delays, axis=0)
 
 
-def _integrate_delays(stepSize, refr, Npts=None):
+def _integrateLOSWithError(stepSize, wet_pw, hydro_pw, Npts=None, rule='rectangle',
+                           length=None, end_values=None):
+    '''
+    Like _integrateLOS, but returns a QuadratureResult. The error is
+    estimated by comparing with the same rule on every other sample.
+
+    If length and end_values, the wet and hydrostatic refractivity at the
+    end of each ray, are given, the rays are integrated past the last of
+    their samples up to length, see _integrate_tail.
+    '''
+    delays = _integrateLOS(stepSize, wet_pw, hydro_pw, Npts, rule=rule)
+    coarse = _integrateLOS(
+        2 * stepSize, wet_pw[..., ::2], hydro_pw[..., ::2],
+        None if Npts is None else (Npts + 1) // 2, rule=rule
+    )
+    order = {'rectangle': 1, 'trapezoid': 2, 'simpson': 4}[rule]
+    if Npts is None:
+        Npts = np.full(delays.shape[1], wet_pw.shape[-1])
+    missing = np.isnan(wet_pw) | np.isnan(hydro_pw)
+    filled = np.sum(missing & (np.arange(missing.shape[-1]) < Npts[:, np.newaxis]), axis=-1)
+    evaluations = Npts
+
+    if length is not None:
+        values = np.stack((wet_pw, hydro_pw))
+        delays = delays + _integrate_tail(stepSize, values, Npts - 1, length, end_values, rule)
+        coarse = coarse + _integrate_tail(
+            2 * stepSize, values[..., ::2], (Npts + 1) // 2 - 1, length, end_values, rule
+        )
+        filled = filled + np.any(np.isnan(end_values), axis=0)
+        evaluations = evaluations + 1
+
+    return QuadratureResult(delays, evaluations, np.abs(delays - coarse) / (2 ** order - 1), filled)
+
+
+def _integrateLOSExact(stepSize, ifWet, ifHydro, x, y, z, length=None, end_values=None):
+    '''
+    Like _integrateLOS, but integrates the interpolated refractivity exactly
+    along the straight segments between the ray points. The remaining error
+    comes from the segments cutting the corners of the ray in the weather
+    model projection, and is estimated from the path through every other
+    point. Points with NaN coordinates end the rays; the refractivity is
+    interpolated at the others to count those outside of the weather model,
+    and to integrate up to length like _integrateLOSWithError.
+    '''
+    # note that this re-ordering is on purpose to match the weather model
+    rays = (y, x, z)
+    coarse_rays = tuple(c[..., ::2] for c in rays)
+    delays = np.stack([1e-6 * np.atleast_1d(fun.integrate(rays, stepSize)) for fun in (ifWet, ifHydro)])
+    coarse = np.stack([
+        1e-6 * np.atleast_1d(fun.integrate(coarse_rays, 2 * stepSize)) for fun in (ifWet, ifHydro)
+    ])
+    values = np.stack([interpolate2(fun, x, y, z) for fun in (ifWet, ifHydro)])
+    Npts = np.sum(np.isfinite(x), axis=-1)
+    filled = np.sum(np.isfinite(x) & np.any(np.isnan(values), axis=0), axis=-1)
+
+    if length is not None:
+        delays = delays + _integrate_tail(stepSize, values, Npts - 1, length, end_values)
+        coarse = coarse + _integrate_tail(2 * stepSize, values[..., ::2], (Npts + 1) // 2 - 1, length, end_values)
+        filled = filled + np.any(np.isnan(end_values), axis=0)
+        Npts = Npts + 1
+
+    return QuadratureResult(delays, Npts, np.abs(delays - coarse) / 3, filled)
+
+
+def _integrate_tail(stepSize, values, last, length, end_values, rule='exact'):
+    '''
+    Delay from the sample last of each ray, with its refractivity samples
+    spaced stepSize apart along the last axis of values, up to length along
+    the ray with a trapezoid to end_values, the refractivity there; less
+    what int_fcn has already counted past the last sample with the rule.
+    '''
+    last = np.maximum(last, 0)
+    f_last = np.nan_to_num(np.take_along_axis(values, last[np.newaxis, :, np.newaxis], axis=-1)[..., 0])
+    f_end = np.nan_to_num(end_values)
+    if rule == 'rectangle':
+        past = stepSize / 2
+    elif rule in _QUADRATURE_RULES:
+        # a single sample counts for a whole step
+        past = np.where(last == 0, stepSize, 0)
+    else:
+        past = 0
+    return 1e-6 * ((length - last * stepSize) * (f_last + f_end) / 2 - past * f_last)
+
+
+def _integrate_delays(stepSize, refr, Npts=None, rule='rectangle'):
     '''
     This function gets the actual delays by integrating the refractivity in
     each node. Refractivity is given in the 'refr' variable.
@@ -310,12 +729,37 @@ def _integrate_delays(stepSize, refr, Npts=None):
     delays = []
     if Npts is not None:
         for n, ray in zip(Npts, refr):
-            delays.append(int_fcn(ray, stepSize, n))
+            delays.append(int_fcn(ray, stepSize, n, rule=rule))
     else:
         for ray in refr:
-            delays.append(int_fcn(ray, stepSize))
+            delays.append(int_fcn(ray, stepSize, rule=rule))
     return np.array(delays)
 
 
-def int_fcn(y, dx, N=None):
-    return 1e-6 * dx * np.nansum(y[:N])
+_QUADRATURE_RULES = ('rectangle', 'trapezoid', 'simpson')
+RAY_QUADRATURES = _QUADRATURE_RULES + ('stretched', 'adaptive', 'exact')
+
+
+def int_fcn(y, dx, N=None, rule='rectangle'):
+    '''
+    Integrate the first N refractivity samples y, spaced dx apart, into a
+    delay with one of _QUADRATURE_RULES. NaN samples, e.g. above the weather
+    model top, count as zero.
+    '''
+    if rule == 'rectangle':
+        return 1e-6 * dx * np.nansum(y[:N])
+
+    y = np.nan_to_num(y[:N])
+    if len(y) < 2:
+        return 1e-6 * dx * np.sum(y)
+    if rule == 'trapezoid':
+        return 1e-6 * dx * (np.sum(y) - 0.5 * (y[0] + y[-1]))
+    if rule == 'simpson':
+        # Composite Simpson over an odd number of samples, with a trapezoid
+        # for the last interval if the number is even
+        n = len(y) if len(y) % 2 else len(y) - 1
+        total = (y[0] + y[n - 1] + 4 * np.sum(y[1:n - 1:2]) + 2 * np.sum(y[2:n - 1:2])) / 3
+        if n < len(y):
+            total += 0.5 * (y[-2] + y[-1])
+        return 1e-6 * dx * total
+    raise ValueError("Unknown quadrature rule '{}'".format(rule))
@@ -9,13 +9,22 @@
 import numpy as np
 from scipy.interpolate import interp1d
 
-from RAiDER.interpolate import interpolate
+from RAiDER.interpolate import (
+    integrate_rays,
+    interpolate,
+    interpolate_columns,
+    pchip_slopes
+)
 
 
 class RegularGridInterpolator(object):
     """
     Provides a wrapper around RAiDER.interpolate.interpolate with a similar
-    interface to scipy.interpolate.RegularGridInterpolator.
+    interface to scipy.interpolate.RegularGridInterpolator. max_threads=0
+    uses one thread per core. sort_points interpolates the points grouped by
+    grid tile, which pays off for large sets of points in no spatial order.
+    method='pchip' interpolates 3D grids with a monotone cubic spline along
+    the third axis; its coefficients are computed once here.
     """
 
     def __init__(
@@ -24,33 +33,116 @@ class RegularGridInterpolator(object):
         values,
         fill_value=None,
         assume_sorted=False,
-        max_threads=8
+        max_threads=0,
+        sort_points=False,
+        method='linear'
     ):
         self.grid = grid
         self.values = values
         self.fill_value = fill_value
         self.assume_sorted = assume_sorted
         self.max_threads = max_threads
+        self.sort_points = sort_points
+        if method != 'linear' and len(grid) != 3:
+            raise ValueError("method='{}' is only supported on 3D grids".format(method))
+        self.slopes = _get_slopes(method, grid[-1], values, max_threads)
 
-    def __call__(self, points):
-        if isinstance(points, tuple):
-            shape = points[0].shape
-            for arr in points:
-                assert arr.shape == shape, "All dimensions must contain the same number of points!"
-            interp_points = np.stack(points, axis=-1)
-        else:
-            interp_points = points
-
+    def __call__(self, points, out=None):
+        # A tuple of coordinate arrays is read in place, without stacking
         return interpolate(
             self.grid,
             self.values,
-            interp_points,
+            points,
             fill_value=self.fill_value,
             assume_sorted=self.assume_sorted,
+            max_threads=self.max_threads,
+            sort_points=self.sort_points,
+            out=out,
+            slopes=self.slopes
+        )
+
+    def integrate(self, rays, step):
+        """
+        Exact integral of the linear interpolant along paths of points
+        spaced 'step' apart, see RAiDER.interpolate.integrate_rays. rays is a
+        tuple of coordinate arrays whose last axis runs along each path.
+        """
+        if len(self.grid) != 3 or self.slopes is not None:
+            raise ValueError("Only linear interpolation on 3D grids can be integrated")
+        return integrate_rays(
+            self.grid,
+            self.values,
+            rays,
+            step,
+            max_threads=self.max_threads
+        )
+
+
+class ColumnGridInterpolator(object):
+    """
+    Like RegularGridInterpolator, but each column of the grid has its own
+    height profile, e.g. the native levels of a weather model. grid is a
+    tuple of the two horizontal axes and heights has the same shape as
+    values, increasing along the last axis.
+    """
+
+    def __init__(
+        self,
+        grid,
+        heights,
+        values,
+        fill_value=None,
+        max_threads=0,
+        sort_points=False,
+        method='linear'
+    ):
+        self.grid = grid
+        self.heights = heights
+        self.values = values
+        self.fill_value = fill_value
+        self.max_threads = max_threads
+        self.sort_points = sort_points
+        self.slopes = _get_slopes(method, heights, values, max_threads)
+
+    def __call__(self, points, out=None):
+        # A tuple of coordinate arrays is read in place, without stacking
+        return interpolate_columns(
+            self.grid,
+            self.heights,
+            self.values,
+            points,
+            fill_value=self.fill_value,
+            max_threads=self.max_threads,
+            sort_points=self.sort_points,
+            out=out,
+            slopes=self.slopes
+        )
+
+    def integrate(self, rays, step):
+        """
+        Exact integral of the linear interpolant along paths of points
+        spaced 'step' apart, see RegularGridInterpolator.integrate.
+        """
+        if self.slopes is not None:
+            raise ValueError("Only linear interpolation can be integrated")
+        return integrate_rays(
+            self.grid,
+            self.values,
+            rays,
+            step,
+            heights=self.heights,
             max_threads=self.max_threads
         )
 
 
+def _get_slopes(method, heights, values, max_threads):
+    if method == 'linear':
+        return None
+    if method == 'pchip':
+        return pchip_slopes(heights, values, max_threads=max_threads)
+    raise ValueError("Unknown interpolation method '{}'".format(method))
+
+
 def interp_along_axis(oldCoord, newCoord, data, axis=2, pad=False):
     '''
     DEPRECATED: Use RAiDER.interpolate.interpolate_along_axis instead (it is
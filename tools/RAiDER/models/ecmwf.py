@@ -23,6 +23,7 @@ class ECMWF(WeatherModel):
 
         self._lon_res = 0.2
         self._lat_res = 0.2
+        self._time_res = 1  # Time resolution in hours
 
     def load_weather(self, filename):
         '''
@@ -33,40 +34,66 @@ class ECMWF(WeatherModel):
         '''
         self._load_model_level(filename)
 
+    def _get_ll_window(self, lats, lons, Nextra=2):
+        '''
+        Return the (row, column) slices of a regular lat/lon grid that cover
+        self._bounds plus Nextra cells. The whole grid is used if no bounds
+        are set, or if the bounds are not a single contiguous window of the
+        grid.
+        '''
+        if getattr(self, '_bounds', None) is None:
+            return slice(None), slice(None)
+
+        lat_min, lat_max, lon_min, lon_max = self._bounds
+        rows = np.flatnonzero((lats >= lat_min) & (lats <= lat_max))
+        cols = np.flatnonzero(np.mod(lons - lon_min, 360) <= lon_max - lon_min)
+        if len(rows) == 0 or len(cols) == 0:
+            return slice(None), slice(None)
+
+        return (
+            slice(max(rows[0] - Nextra, 0), min(rows[-1] + Nextra + 1, len(lats))),
+            slice(max(cols[0] - Nextra, 0), min(cols[-1] + Nextra + 1, len(lons))),
+        )
+
     def _load_model_level(self, fname):
         from scipy.io import netcdf as nc
-        with nc.netcdf_file(fname, 'r', maskandscale=True) as f:
-            # 0,0 to get first time and first level
-            z = f.variables['z'][0][0].copy()
-            lnsp = f.variables['lnsp'][0][0].copy()
-            t = f.variables['t'][0].copy()
-            qq = f.variables['q'][0].copy()
-            lats = f.variables['latitude'][:].copy()
-            lons = f.variables['longitude'][:].copy()
-            self._levels = f.variables['level'][:].copy()
+        # The file is memory-mapped, so only the window that is indexed is
+        # actually read (and unpacked) from disk
+        with nc.netcdf_file(fname, 'r', mmap=True, maskandscale=True) as f:
+            lats = np.array(f.variables['latitude'][:])
+            lons = np.array(f.variables['longitude'][:])
+            rows, cols = self._get_ll_window(lats, lons)
+            lats, lons = lats[rows], lons[cols]
+
+            # first time and first level
+            z = np.array(f.variables['z'][0, 0, rows, cols])
+            lnsp = np.array(f.variables['lnsp'][0, 0, rows, cols])
+            t = np.array(f.variables['t'][0, :, rows, cols])
+            q = np.array(f.variables['q'][0, :, rows, cols])
+            self._levels = np.array(f.variables['level'][:])
 
         # ECMWF appears to give me this backwards
         if lats[0] > lats[1]:
             z = z[::-1]
             lnsp = lnsp[::-1]
             t = t[:, ::-1]
-            Q = qq[:, ::-1]
+            q = q[:, ::-1]
             lats = lats[::-1]
         # Lons is usually ok, but we'll throw in a check to be safe
         if lons[0] > lons[1]:
             z = z[..., ::-1]
             lnsp = lnsp[..., ::-1]
             t = t[..., ::-1]
-            Q = qq[..., ::-1]
+            q = q[..., ::-1]
             lons = lons[::-1]
         # pyproj gets fussy if the latitude is wrong, plus our
         # interpolator isn't clever enough to pick up on the fact that
         # they are the same
-        lons[lons > 180] -= 360
+        lons = np.where(lons > 180, lons - 360, lons)
         self._proj = CRS.from_epsg(4326)
 
         self._t = t
-        self._q = Q
+        self._q = q
 
         geo_hgt, pres, hgt = self._calculategeoh(z, lnsp)
 
@@ -87,21 +114,16 @@ class ECMWF(WeatherModel):
         else:
             self._p = pres
 
-        # Re-structure everything from (heights, lats, lons) to (lons, lats, heights)
-        self._p = np.transpose(self._p)
-        self._t = np.transpose(self._t)
-        self._q = np.transpose(self._q)
-        self._lats = np.transpose(_lats)
-        self._lons = np.transpose(_lons)
-        self._zs = np.transpose(self._zs)
-        self._ys = self._lats.copy()
-        self._xs = self._lons.copy()
-
-        # Flip all the axis so that zs are in order from bottom to top
-        self._p = np.flip(self._p, axis=2)
-        self._t = np.flip(self._t, axis=2)
-        self._q = np.flip(self._q, axis=2)
-        self._zs = np.flip(self._zs, axis=2)
+        # Re-structure everything from (heights, lats, lons) to (lons, lats,
+        # heights), with zs in order from bottom to top. These are all views.
+        self._p = self._p.T[..., ::-1]
+        self._t = self._t.T[..., ::-1]
+        self._q = self._q.T[..., ::-1]
+        self._zs = self._zs.T[..., ::-1]
+        self._lats = _lats.T
+        self._lons = _lons.T
+        self._ys = self._lats
+        self._xs = self._lons
 
     def _fetch(self, lats, lons, time, out, Nextra=2):
         '''
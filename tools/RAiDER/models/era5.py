@@ -96,19 +96,24 @@ class ERA5(ECMWF):
 
     def _load_pressure_level(self, filename):
         from scipy.io import netcdf as nc
+        # The file is memory-mapped, so only the window that is indexed is
+        # actually read (and unpacked) from disk
         with nc.netcdf_file(
-                filename, 'r', maskandscale=True) as f:
-            lats = f.variables['latitude'][:].copy()
-            lons = f.variables['longitude'][:].copy()
-            t = f.variables['t'][0].copy()
-            q = f.variables['q'][0].copy()
-            r = f.variables['r'][0].copy()
-            z = f.variables['z'][0].copy()
-            levels = f.variables['level'][:].copy() * 100
+                filename, 'r', mmap=True, maskandscale=True) as f:
+            lats = np.array(f.variables['latitude'][:])
+            lons = np.array(f.variables['longitude'][:])
+            rows, cols = self._get_ll_window(lats, lons)
+            lats, lons = lats[rows], lons[cols]
+
+            t = np.array(f.variables['t'][0, :, rows, cols])
+            q = np.array(f.variables['q'][0, :, rows, cols])
+            r = np.array(f.variables['r'][0, :, rows, cols])
+            z = np.array(f.variables['z'][0, :, rows, cols])
+            levels = np.array(f.variables['level'][:]) * 100
 
         # ECMWF appears to give me this backwards
         if lats[0] > lats[1]:
-            z = z[::-1]
+            z = z[:, ::-1]
             t = t[:, ::-1]
             q = q[:, ::-1]
             r = r[:, ::-1]
@@ -123,7 +128,7 @@ class ERA5(ECMWF):
         # pyproj gets fussy if the latitude is wrong, plus our
         # interpolator isn't clever enough to pick up on the fact that
         # they are the same
-        lons[lons > 180] -= 360
+        lons = np.where(lons > 180, lons - 360, lons)
         self._proj = CRS.from_epsg(4326)
 
         self._t = t
@@ -144,31 +149,18 @@ class ERA5(ECMWF):
         self._p = np.broadcast_to(levels[:, np.newaxis, np.newaxis],
                                   self._zs.shape)
 
-        # Re-structure everything from (heights, lats, lons) to (lons, lats, heights)
-        self._p = np.transpose(self._p)
-        self._t = np.transpose(self._t)
-        self._q = np.transpose(self._q)
-        self._rh = np.transpose(self._rh)
-        self._lats = np.transpose(_lats)
-        self._lons = np.transpose(_lons)
-        self._ys = self._lats.copy()
-        self._xs = self._lons.copy()
-        self._zs = np.transpose(self._zs)
-
-        # check this
-        # data cube format should be lats,lons,heights
-        self._lats = self._lats.swapaxes(0, 1)
-        self._lons = self._lons.swapaxes(0, 1)
-        self._xs = self._xs.swapaxes(0, 1)
-        self._ys = self._ys.swapaxes(0, 1)
-        self._zs = self._zs.swapaxes(0, 1)
-        self._rh = self._rh.swapaxes(0, 1)
-        self._p = self._p.swapaxes(0, 1)
-        self._q = self._q.swapaxes(0, 1)
-        self._t = self._t.swapaxes(0, 1)
-
-        # For some reason z is opposite the others
-        self._p = np.flip(self._p, axis=2)
-        self._t = np.flip(self._t, axis=2)
-        self._q = np.flip(self._q, axis=2)
-        self._rh = np.flip(self._rh, axis=2)
+        # Re-structure everything from (heights, lats, lons) to (lats, lons,
+        # heights), with zs in order from bottom to top. Every variable
+        # (including the heights) shares the order of the pressure levels,
+        # so all of them are flipped together. These are all views.
+        order = (1, 2, 0)
+        up = slice(None, None, -1) if levels[0] < levels[-1] else slice(None)
+        self._p = self._p.transpose(order)[..., up]
+        self._t = self._t.transpose(order)[..., up]
+        self._q = self._q.transpose(order)[..., up]
+        self._rh = self._rh.transpose(order)[..., up]
+        self._zs = self._zs.transpose(order)[..., up]
+        self._lats = _lats.transpose(order)
+        self._lons = _lons.transpose(order)
+        self._ys = self._lats
+        self._xs = self._lons
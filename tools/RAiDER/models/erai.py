@@ -18,6 +18,7 @@ class ERAI(ECMWF):
             datetime.datetime(2018, 1, 1)
         )  # Tuple of min/max years where data is available.
         self._lag_time = datetime.timedelta(days=30)  # Availability lag time in days
+        self._time_res = 6  # Time resolution in hours
 
         self._a = [
             0.0000000000e+000, 2.0000000000e+001, 3.8425338745e+001,
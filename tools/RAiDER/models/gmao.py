@@ -20,6 +20,7 @@ class GMAO(WeatherModel):
         # Tuple of min/max years where data is available.
         self._valid_range = (dt.datetime(2017, 12, 1), "Present")
         self._lag_time = dt.timedelta(hours=24.0)  # Availability lag time in hours
+        self._time_res = 3  # Time resolution in hours
 
         # model constants
         self._k1 = 0.776  # [K/Pa]
@@ -35,6 +36,8 @@ class GMAO(WeatherModel):
         self._Name = 'GMAO'
         self._files = None
         self._bounds = None
+        # area read from the server, see _fetch
+        self._download_bounds = None
 
         # Projection
         self._proj = CRS.from_epsg(4326)
@@ -45,7 +48,7 @@ class GMAO(WeatherModel):
         '''
         # bounding box plus a buffer
         lat_min, lat_max, lon_min, lon_max = self._get_ll_bounds(lats, lons, Nextra)
-        self._bounds = (lat_min, lat_max, lon_min, lon_max)
+        self._download_bounds = (lat_min, lat_max, lon_min, lon_max)
 
     def load_weather(self, f):
         '''
@@ -65,10 +68,10 @@ class GMAO(WeatherModel):
         import pydap.client
 
         # calculate the array indices for slicing the GMAO variable arrays
-        lat_min_ind = int((self._bounds[0] - (-90.0)) / self._lat_res)
-        lat_max_ind = int((self._bounds[1] - (-90.0)) / self._lat_res)
-        lon_min_ind = int((self._bounds[2] - (-180.0)) / self._lon_res)
-        lon_max_ind = int((self._bounds[3] - (-180.0)) / self._lon_res)
+        lat_min_ind = int((self._download_bounds[0] - (-90.0)) / self._lat_res)
+        lat_max_ind = int((self._download_bounds[1] - (-90.0)) / self._lat_res)
+        lon_min_ind = int((self._download_bounds[2] - (-180.0)) / self._lon_res)
+        lon_max_ind = int((self._download_bounds[3] - (-180.0)) / self._lon_res)
 
         T0 = dt.datetime(2017, 12, 1, 0, 0, 0)
         DT = self._time - T0
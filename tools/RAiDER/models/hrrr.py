@@ -1,14 +1,35 @@
 import datetime
 import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import requests
-from pyproj import CRS
+from pyproj import CRS, Transformer
 
 from RAiDER.models.weatherModel import WeatherModel
 
 log = logging.getLogger(__name__)
 
+# Fields used by _pull_hrrr_data (temperature, geopotential height and
+# specific humidity), as named in the GRIB2 .idx inventory
+_HRRR_IDX_FIELDS = ('TMP', 'HGT', 'SPFH')
+_CHUNK_SIZE = 2**20
+_TIMEOUT = 60
+
+# HRRR CONUS grid: longitude/latitude of the first (south-west) grid point,
+# grid spacing in meters and number of points. Used when the GRIB file does
+# not describe the grid itself.
+_HRRR_GRID = {
+    'lon1': 237.280472,
+    'lat1': 21.138123,
+    'dx': 3000.,
+    'dy': 3000.,
+    'nx': 1799,
+    'ny': 1059,
+}
+
 
 class HRRR(WeatherModel):
     # I took this from
@@ -26,6 +47,7 @@ class HRRR(WeatherModel):
         # Tuple of min/max years where data is available.
         self._valid_range = (datetime.datetime(2016, 7, 15), "Present")
         self._lag_time = datetime.timedelta(hours=3)  # Availability lag time in days
+        self._time_res = 1  # Time resolution in hours
 
         # model constants: TODO: need to update/double-check these
         self._k1 = 0.776  # [K/Pa]
@@ -61,11 +83,9 @@ class HRRR(WeatherModel):
 
     def _fetch(self, lats, lons, time, out, Nextra=2):
         '''
-        Fetch weather model data from HRRR
+        Fetch weather model data from HRRR. The whole grid is downloaded;
+        load decodes the part of it covering the area of interest.
         '''
-        # bounding box plus a buffer
-        lat_min, lat_max, lon_min, lon_max = self._get_ll_bounds(lats, lons, Nextra)
-        self._bounds = (lat_min, lat_max, lon_min, lon_max)
         self._files = self._download_hrrr_file(time, 'hrrr', out=out,
                                                field='prs', verbose=True)
 
@@ -125,23 +145,54 @@ class HRRR(WeatherModel):
 
         return xArr, yArr, lats.T, lons.T, np.moveaxis(t, [0, 1, 2], [2, 1, 0]), np.moveaxis(q, [0, 1, 2], [2, 1, 0]), np.moveaxis(z, [0, 1, 2], [2, 1, 0]), pl
 
-    def _pull_hrrr_data(self, filename, verbose=False):
+    def _pull_hrrr_data(self, filename, verbose=False, Nextra=2):
         '''
-        Get the variables from a HRRR grib2 file
+        Get the variables from a HRRR grib2 file. If the bounds of the area of
+        interest are known, only the part of the grid covering them (plus
+        Nextra cells on each side) is kept.
         '''
         from cfgrib.xarray_store import open_dataset
 
-        # Pull the native grid
-        xArr, yArr = self.getXY_gdal(filename)
-
-        # open the dataset and pull the data
+        # open the dataset
         ds = open_dataset(filename,
                           backend_kwargs={'filter_by_keys': {'typeOfLevel': 'isobaricInhPa'}})
-        t = ds['t'].values.copy()
-        z = ds['gh'].values.copy()
-        q = ds['q'].values.copy()
-        lats = ds['t'].latitude.values.copy()
-        lons = ds['t'].longitude.values.copy()
+
+        # Pull the native grid from the GRIB grid definition
+        attrs = ds['t'].attrs
+        ny, nx = ds['t'].shape[-2:]
+        lon1 = attrs.get('GRIB_longitudeOfFirstGridPointInDegrees', _HRRR_GRID['lon1'])
+        lat1 = attrs.get('GRIB_latitudeOfFirstGridPointInDegrees', _HRRR_GRID['lat1'])
+        dx = attrs.get('GRIB_DxInMetres', _HRRR_GRID['dx'])
+        dy = attrs.get('GRIB_DyInMetres', _HRRR_GRID['dy'])
+        x0, y0 = Transformer.from_crs(
+            CRS.from_epsg(4326), self._proj, always_xy=True
+        ).transform(lon1, lat1)
+
+        # window of the grid to keep, counting rows from the south
+        if self._bounds is not None:
+            j0, j1, i0, i1 = hrrr_index_window(
+                self._proj, self._bounds, x0, y0, dx, dy, nx, ny, Nextra=Nextra
+            )
+        else:
+            j0, j1, i0, i1 = 0, ny, 0, nx
+        xArr = x0 + dx * np.arange(i0, i1)
+        yArr = y0 + dy * np.arange(j0, j1)
+
+        # Rows are stored from the south unless the grid scans southwards
+        if attrs.get('GRIB_jScansPositively', 1):
+            rows = slice(j0, j1)
+        else:
+            rows = slice(ny - j1, ny - j0)
+            yArr = yArr[::-1]
+        ds = ds.isel(y=rows, x=slice(i0, i1))
+        log.debug('Keeping %d x %d of the %d x %d HRRR grid', j1 - j0, i1 - i0, ny, nx)
+
+        # pull the data for the window only
+        t = ds['t'].values
+        z = ds['gh'].values
+        q = ds['q'].values
+        lats = ds['t'].latitude.values
+        lons = ds['t'].longitude.values
 
         return t, z, q, xArr, yArr, lats, lons
 
@@ -161,10 +212,149 @@ class HRRR(WeatherModel):
 
         log.debug('Downloading %s to %s', grib2file, out)
 
-        r = requests.get(grib2file)
-        with open(out, 'wb') as f:
-            f.write(r.content)
+        download_grib_fields(grib2file, out)
 
         log.debug('Success!')
 
         return out
+
+
+def hrrr_index_window(proj, bounds, x0, y0, dx, dy, nx, ny, Nextra=2, Nedge=50):
+    '''
+    Return the index window (j0, j1, i0, i1) of a projected grid that covers
+    a lat/lon bounding box, plus Nextra cells on each side. Rows (j) count
+    from y0 and columns (i) from x0; the upper indices are exclusive and the
+    window is clipped to the grid.
+
+    Inputs:
+        proj     - CRS of the grid
+        bounds   - SNWE bounding box in degrees
+        x0, y0   - projected coordinates of the first grid point
+        dx, dy   - grid spacing
+        nx, ny   - grid size
+        Nedge    - number of points sampled along each edge of the box, since
+                   the edges are curved in the projection
+    '''
+    south, north, west, east = bounds
+    edge_lats = np.linspace(south, north, Nedge)
+    edge_lons = np.linspace(west, east, Nedge)
+    lats = np.concatenate([edge_lats, edge_lats, np.full(Nedge, south), np.full(Nedge, north)])
+    lons = np.concatenate([np.full(Nedge, west), np.full(Nedge, east), edge_lons, edge_lons])
+    xs, ys = Transformer.from_crs(CRS.from_epsg(4326), proj, always_xy=True).transform(lons, lats)
+
+    i0 = int(np.floor((np.min(xs) - x0) / dx)) - Nextra
+    i1 = int(np.ceil((np.max(xs) - x0) / dx)) + Nextra + 1
+    j0 = int(np.floor((np.min(ys) - y0) / dy)) - Nextra
+    j1 = int(np.ceil((np.max(ys) - y0) / dy)) + Nextra + 1
+
+    i0, i1 = np.clip([i0, i1], 0, nx)
+    j0, j1 = np.clip([j0, j1], 0, ny)
+    if i0 >= i1 or j0 >= j1:
+        raise RuntimeError('The bounds {} are outside of the weather model grid'.format(bounds))
+    return int(j0), int(j1), int(i0), int(i1)
+
+
+def parse_grib_idx(text, fields=_HRRR_IDX_FIELDS, level_suffix=' mb'):
+    '''
+    Parse a GRIB2 .idx inventory and return the byte ranges of the messages
+    for the requested fields on levels ending in level_suffix (isobaric
+    levels by default), in file order. Adjacent messages are merged into a
+    single range.
+
+    Each inventory line looks like
+        12:4873236:d=2020010100:TMP:500 mb:anl:
+    i.e. message number, byte offset, date, field, level and forecast time.
+    Returns a list of (start, end) tuples; end is inclusive, or None for a
+    message that runs to the end of the file.
+    '''
+    entries = []
+    for line in text.splitlines():
+        parts = line.split(':')
+        if len(parts) < 5:
+            continue
+        entries.append((int(parts[1]), parts[3], parts[4]))
+
+    ranges = []
+    for k, (offset, field, level) in enumerate(entries):
+        if field not in fields or not level.endswith(level_suffix):
+            continue
+        end = entries[k + 1][0] - 1 if k + 1 < len(entries) else None
+        if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 == offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((offset, end))
+    return ranges
+
+
+def download_grib_fields(url, out, fields=_HRRR_IDX_FIELDS, max_workers=8):
+    '''
+    Download only the messages for the requested fields from a GRIB2 file,
+    using the byte offsets in its .idx inventory. The byte ranges are fetched
+    concurrently, streamed to disk and joined in file order. Falls back to
+    downloading the whole file if there is no inventory or the server does
+    not support range requests.
+    '''
+    try:
+        r = requests.get(url + '.idx', timeout=_TIMEOUT)
+        r.raise_for_status()
+        ranges = parse_grib_idx(r.text, fields=fields)
+    except requests.RequestException:
+        log.warning('No inventory found for %s, downloading the whole file', url)
+        ranges = []
+
+    if ranges:
+        try:
+            _download_byte_ranges(url, ranges, out, max_workers=max_workers)
+            return out
+        except (requests.RequestException, RuntimeError) as e:
+            log.warning('Byte-range download of %s failed (%s), downloading the whole file', url, e)
+
+    download_file(url, out)
+    return out
+
+
+def download_file(url, out):
+    '''
+    Stream a file to disk without holding it in memory
+    '''
+    with requests.get(url, stream=True, timeout=_TIMEOUT) as r:
+        r.raise_for_status()
+        with open(out, 'wb') as f:
+            for block in r.iter_content(chunk_size=_CHUNK_SIZE):
+                f.write(block)
+    return out
+
+
+def _download_byte_ranges(url, ranges, out, max_workers=8):
+    '''
+    Fetch each byte range of url into its own part file concurrently, then
+    join the parts in order into out
+    '''
+    parts = ['{}.part{}'.format(out, k) for k in range(len(ranges))]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ranges)))) as pool:
+            list(pool.map(_download_byte_range, [url] * len(ranges), ranges, parts))
+
+        with open(out, 'wb') as f:
+            for part in parts:
+                with open(part, 'rb') as p:
+                    shutil.copyfileobj(p, f, _CHUNK_SIZE)
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+
+
+def _download_byte_range(url, byte_range, out):
+    '''
+    Stream a single byte range of url to out
+    '''
+    start, end = byte_range
+    headers = {'Range': 'bytes={}-{}'.format(start, '' if end is None else end)}
+    with requests.get(url, headers=headers, stream=True, timeout=_TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise RuntimeError('server does not support range requests')
+        with open(out, 'wb') as f:
+            for block in r.iter_content(chunk_size=_CHUNK_SIZE):
+                f.write(block)
@@ -30,6 +30,7 @@ class MERRA2(WeatherModel):
         self._valid_range = (dt.datetime(1980, 1, 1), "Present")
         lag_time = utcnow - enddate
         self._lag_time = dt.timedelta(days=lag_time.days)  # Availability lag time in days
+        self._time_res = 3  # Time resolution in hours
 
         # model constants
         self._k1 = 0.776  # [K/Pa]
@@ -45,6 +46,8 @@ class MERRA2(WeatherModel):
         self._Name = 'MERRA2'
         self._files = None
         self._bounds = None
+        # area read from the server, see _fetch
+        self._download_bounds = None
 
         # Projection
         self._proj = CRS.from_epsg(4326)
@@ -55,7 +58,7 @@ class MERRA2(WeatherModel):
         '''
         # bounding box plus a buffer
         lat_min, lat_max, lon_min, lon_max = self._get_ll_bounds(lats, lons, Nextra)
-        self._bounds = (lat_min, lat_max, lon_min, lon_max)
+        self._download_bounds = (lat_min, lat_max, lon_min, lon_max)
 
     def load_weather(self, f):
         '''
@@ -75,10 +78,10 @@ class MERRA2(WeatherModel):
         import pydap.cas.urs
         
         # calculate the array indices for slicing the GMAO variable arrays
-        lat_min_ind = int((self._bounds[0] - (-90.0)) / self._lat_res)
-        lat_max_ind = int((self._bounds[1] - (-90.0)) / self._lat_res)
-        lon_min_ind = int((self._bounds[2] - (-180.0)) / self._lon_res)
-        lon_max_ind = int((self._bounds[3] - (-180.0)) / self._lon_res)
+        lat_min_ind = int((self._download_bounds[0] - (-90.0)) / self._lat_res)
+        lat_max_ind = int((self._download_bounds[1] - (-90.0)) / self._lat_res)
+        lon_min_ind = int((self._download_bounds[2] - (-180.0)) / self._lon_res)
+        lon_max_ind = int((self._download_bounds[3] - (-180.0)) / self._lon_res)
         
         if self._time.year < 1992:
             url_sub = 100
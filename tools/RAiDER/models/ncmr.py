@@ -51,13 +51,13 @@ class NCMR(WeatherModel):
         '''
         # bounding box plus a buffer
         lat_min, lat_max, lon_min, lon_max = self._get_ll_bounds(lats, lons, Nextra)
-        self._bounds = (lat_min, lat_max, lon_min, lon_max)
+        self._download_bounds = (lat_min, lat_max, lon_min, lon_max)
         
         # Auxillary function:
         '''
         download data of the NCMR model and save it in desired location
         '''
-        # self._files = self._download_ncmr_file(out,'ncmr',time,self._bounds)    
+        # self._files = self._download_ncmr_file(out,'ncmr',time,self._download_bounds)    
 
     def load_weather(self, filename):
         '''
@@ -2,6 +2,7 @@ import datetime
 import logging
 import os
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 import h5py
 import numpy as np
@@ -20,6 +21,151 @@ from RAiDER.utilFcns import lla2ecef, robmax, robmin
 
 log = logging.getLogger(__name__)
 
+# Minimum number of columns given to each thread by _calculategeoh
+_GEOH_MIN_COLUMNS = 10000
+
+# 3D variables that write2HDF5 can write, with the attributes holding them
+_HDF5_FIELDS = {
+    't': '_t',
+    'p': '_p',
+    'e': '_e',
+    'wet': '_wet_refractivity',
+    'hydro': '_hydrostatic_refractivity',
+    'wet_total': '_wet_total',
+    'hydro_total': '_hydrostatic_total',
+}
+
+# The variables written by default, which are those needed for delays
+_DELAY_FIELDS = ('wet', 'hydro', 'wet_total', 'hydro_total')
+
+# Number of grid nodes handled at a time by _get_refractivity; small enough
+# for the work arrays of a block to stay in cache
+_REFRACTIVITY_BLOCK_SIZE = 1 << 16
+
+
+def _calculategeoh_columns(a, b, sp, z, t, q, R_d, g0, geopotential, pressurelvs, geoheight):
+    '''
+    Integrate the hydrostatic equation up a set of model-level columns.
+    t, q and the outputs are (levels, columns), numbered from the top of the
+    atmosphere down, and sp and z are (columns,). The outputs are filled in
+    place, one level at a time, using a handful of work rows that are reused
+    for every level.
+    '''
+    levelSize = t.shape[0]
+
+    # pressure and log-pressure of the half-level below the current level
+    Ph_below = a[levelSize] + b[levelSize] * sp
+    logP_below = np.log(Ph_below)
+    Ph, logP = np.empty(sp.shape), np.empty(sp.shape)
+    dlogP, alpha, TRd = np.empty(sp.shape), np.empty(sp.shape), np.empty(sp.shape)
+
+    # Integrate up into the atmosphere from *lowest level*; z_h is the
+    # geopotential of the half-level below the current level
+    z_h = np.zeros(sp.shape)
+    for ilevel in range(levelSize - 1, -1, -1):
+        # compute the pressures (on half-levels)
+        np.multiply(b[ilevel], sp, out=Ph)
+        Ph += a[ilevel]
+        pressurelvs[ilevel] = Ph
+
+        if ilevel == 0:
+            np.subtract(logP_below, np.log(0.1), out=dlogP)
+            alpha.fill(np.log(2))
+        else:
+            np.log(Ph, out=logP)
+            np.subtract(logP_below, logP, out=dlogP)
+            # alpha = 1 - Ph / dP * dlogP
+            np.subtract(Ph_below, Ph, out=alpha)
+            np.divide(Ph, alpha, out=alpha)
+            alpha *= dlogP
+            np.subtract(1, alpha, out=alpha)
+
+        # moist temperature times R_d
+        np.multiply(q[ilevel], 0.609133 * R_d, out=TRd)
+        TRd += R_d
+        TRd *= t[ilevel]
+
+        # Geopotential of the full level, integrated from the half-level
+        # below, plus the surface geopotential
+        geo = geopotential[ilevel]
+        np.multiply(TRd, alpha, out=geo)
+        geo += z_h
+        geo += z
+        np.divide(geo, g0, out=geoheight[ilevel])
+
+        # integrate z_h to the next half-level
+        TRd *= dlogP
+        z_h += TRd
+
+        Ph, Ph_below = Ph_below, Ph
+        logP, logP_below = logP_below, logP
+
+
+def _refractivity_block(t, p, humidity, humidityType, R_v, R_d, k1, k2, k3, e, wet, hydro):
+    '''
+    Compute the partial pressure of water vapor and the wet and hydrostatic
+    refractivity for a block of grid nodes. All arrays are 1D. If humidity
+    is None, e is taken as given, otherwise it is computed from humidity
+    (q or rh, following humidityType). wet and hydro may be None to skip
+    them. The outputs are filled in place using two work arrays.
+    '''
+    w1, w2 = np.empty(t.shape), np.empty(t.shape)
+
+    if humidity is not None:
+        # Saturation vapor pressure: Buck (1981) over water above t1 and
+        # Alduchow and Eskridge (1996) over ice below t2, blended in between
+        # (see IFS documentation part 2, CY25R1). svpi is built in e and
+        # svpw in w2.
+        t1 = 273.15  # O Celsius
+        t2 = 250.15  # -23 Celsius
+        np.subtract(t, t1, out=w1)
+        np.add(w1, 240.97, out=w2)
+        np.divide(w1, w2, out=w2)
+        w2 *= 17.502
+        np.exp(w2, out=w2)
+        w2 *= 6.1121
+        np.add(w1, 273.86, out=e)
+        np.divide(w1, e, out=e)
+        e *= 22.587
+        np.exp(e, out=e)
+        e *= 6.1121
+
+        # svp = svpi + (svpw - svpi) * wgt**2, where clipping the weight
+        # gives svpw above t1 and svpi below t2
+        np.subtract(t, t2, out=w1)
+        w1 /= t1 - t2
+        np.clip(w1, 0, 1, out=w1)
+        np.square(w1, out=w1)
+        w2 -= e
+        w2 *= w1
+        e += w2
+        e *= 100
+
+        if humidityType == 'rh':
+            e *= humidity
+            e /= 100
+        elif humidityType == 'q':
+            # We have q = w/(w + 1), so w = q/(1 - q) and
+            # e = w * R_v * (p - svp) / R_d
+            np.subtract(p, e, out=e)
+            np.subtract(1, humidity, out=w1)
+            np.divide(humidity, w1, out=w1)
+            e *= w1
+            e *= R_v / R_d
+        else:
+            raise RuntimeError('Not a valid humidity type')
+
+    if wet is not None:
+        # k2 * e / t + k3 * e / t**2
+        np.divide(e, t, out=w1)
+        np.divide(k3, t, out=w2)
+        w2 += k2
+        np.multiply(w1, w2, out=wet)
+
+    if hydro is not None:
+        np.divide(p, t, out=hydro)
+        hydro *= k1
+
 
 class WeatherModel(ABC):
     '''
@@ -45,7 +191,9 @@ class WeatherModel(ABC):
         self._model_level_type = 'ml'
         self._valid_range = (datetime.date(1900, 1, 1),)  # Tuple of min/max years where data is available.
         self._lag_time = datetime.timedelta(days=30)  # Availability lag time in days
+        self._time_res = None  # Time resolution of the model in hours, None if unknown
         self._time = None
+        self._nthreads = 0  # threads used to process the model, 0 for one per core
 
         # Define fixed constants
         self._R_v = 461.524
@@ -73,7 +221,6 @@ class WeatherModel(ABC):
         self._hydrostatic_refractivity = None
         self._wet_total = None
         self._hydrostatic_total = None
-        self._svp = None
 
     def __str__(self):
         string = '\n'
@@ -123,24 +270,50 @@ class WeatherModel(ABC):
         '''
         pass
 
-    def load(self, *args, outLats=None, outLons=None, los=None, _zlevels=None, zref=None, **kwargs):
+    def load(self, *args, outLats=None, outLons=None, los=None, _zlevels=None, zref=None,
+             nthreads=0, **kwargs):
         '''
         Calls the load_weather method. Each model class should define a load_weather
         method appropriate for that class. 'args' should be one or more filenames.
+        nthreads limits the number of threads used to process the model, 0
+        for one per core.
+
+        The model is cropped to outLats/outLons plus a buffer, if given, and
+        otherwise processed in full. The area that _fetch downloaded, which
+        may be larger, does not matter here.
         '''
+        self._nthreads = nthreads
         if zref is not None:
             self._zmax = zref
+        if outLats is not None and outLons is not None:
+            self._bounds = self._get_ll_bounds(outLats, outLons, Nextra=2)
+        else:
+            self._bounds = None
         self.load_weather(*args, **kwargs)
-        self._find_e()
+        self._horizontal_latlon()
+        self._crop_grid()
         self._checkNotMaskedArrays()
-        self._uniform_in_z(_zlevels=_zlevels)
+        # e is found from the humidity of the data just loaded, either here
+        # or together with the refractivity
+        self._e = None
+        if _zlevels is None:
+            self._native_in_z()
+        else:
+            # e is resampled along with t and p
+            self._find_e()
+            self._uniform_in_z(_zlevels=_zlevels)
         self._checkForNans()
-        self._get_wet_refractivity()
-        self._get_hydro_refractivity()
+        self._get_refractivity()
         self._adjust_grid(lats=outLats, lons=outLons)
         los_flag = self._checkLOS(los)
         self._runLOS(los, zref, los_flag)
 
+    def _max_threads(self):
+        '''
+        Number of threads that the processing of the model may use
+        '''
+        return self._nthreads or os.cpu_count() or 1
+
     def _checkLOS(self, los):
         '''
         I will check to see if a state vector has been supplied. If so, I will calculate the integrated
@@ -162,8 +335,12 @@ class WeatherModel(ABC):
         if zref is None:
             zref = const._ZREF
 
-        hgts = np.tile(self._zs.copy(), self._lats.shape[:2] + (1,))
-        los = getLookVectors(los, self._lats, self._lons, hgts, self._zmax)
+        if self._zs.ndim == 3:
+            hgts = self._zs.copy()
+        else:
+            hgts = np.tile(self._zs.copy(), self._lats.shape[:2] + (1,))
+        lats, lons = self._broadcast_latlon(hgts.shape)
+        los = getLookVectors(los, lats, lons, hgts, self._zmax)
         wet = self.getWetRefractivity()
         hydro = self.getHydroRefractivity()
 
@@ -180,11 +357,11 @@ class WeatherModel(ABC):
             los_slv = los / lengths[..., np.newaxis]
 
             # Transform each point to ECEF
-            rays_ecef = np.stack(lla2ecef(self._lats, self._lons, hgts), axis=-1)
+            rays_ecef = np.stack(lla2ecef(lats, lons, hgts), axis=-1)
 
             # Calculate the integrated delays
-            ifWet = make_interpolator(self._xs, self._ys, self._zs, wet)
-            ifHydro = make_interpolator(self._xs, self._ys, self._zs, hydro)
+            ifWet = make_interpolator(self._xs, self._ys, self._zs, wet, max_threads=self._max_threads())
+            ifHydro = make_interpolator(self._xs, self._ys, self._zs, hydro, max_threads=self._max_threads())
 
             # Create the rays
             ray = makePoints3D(max_len, rays_ecef, los_slv, _STEP)
@@ -209,8 +386,8 @@ class WeatherModel(ABC):
             # TODO: This returns zero for the last level because of the way trapz handles single points.
             # Should probably try to re-implement the integral function
             for level in range(wet.shape[2]):
-                wet_total[..., level] = 1e-6 * np.trapz(wet[..., level:], x=self._zs[level:], axis=2)
-                hydro_total[..., level] = 1e-6 * np.trapz(hydro[..., level:], x=self._zs[level:], axis=2)
+                wet_total[..., level] = 1e-6 * np.trapz(wet[..., level:], x=self._zs[..., level:], axis=2)
+                hydro_total[..., level] = 1e-6 * np.trapz(hydro[..., level:], x=self._zs[..., level:], axis=2)
             self._hydrostatic_total = hydro_total
             self._wet_total = wet_total
 
@@ -265,39 +442,63 @@ class WeatherModel(ABC):
         self._zs = util._geo_to_ht(lats, geo_ht_fix, self._g0)
 
     def _find_e(self):
-        """Check the type of e-calculation needed"""
-        if self._humidityType == 'rh':
-            self._find_e_from_rh()
-        elif self._humidityType == 'q':
-            self._find_e_from_q()
-        else:
-            raise RuntimeError('Not a valid humidity type')
-        self._rh = None
-        self._q = None
+        """Calculate e, the partial pressure of water vapor"""
+        self._run_refractivity(find_e=True, refractivity=False)
 
-    def _find_e_from_q(self):
-        """Calculate e, partial pressure of water vapor."""
-        self._find_svp()
-        # We have q = w/(w + 1), so w = q/(1 - q)
-        w = self._q / (1 - self._q)
-        self._e = w * self._R_v * (self._p - self._svp) / self._R_d
-
-    def _find_e_from_rh(self):
-        """Calculate partial pressure of water vapor."""
-        self._find_svp()
-        self._e = self._rh / 100 * self._svp
-
-    def _get_wet_refractivity(self):
+    def _get_refractivity(self):
         '''
-        Calculate the wet delay from pressure, temperature, and e
+        Calculate the wet and hydrostatic refractivity from pressure,
+        temperature and e, computing e first if it has not been yet
         '''
-        self._wet_refractivity = self._k2 * self._e / self._t + self._k3 * self._e / self._t**2
+        self._run_refractivity(find_e=self._e is None, refractivity=True)
 
-    def _get_hydro_refractivity(self):
+    def _run_refractivity(self, find_e=True, refractivity=True):
         '''
-        Calculate the hydrostatic delay from pressure and temperature
+        Compute e from the humidity if find_e and, if refractivity, the wet
+        and hydrostatic refractivity in a single pass over the grid. The grid
+        is handled in blocks of _REFRACTIVITY_BLOCK_SIZE nodes that are split
+        between threads (numpy releases the GIL), so that only a few
+        block-sized temporaries exist at any time.
         '''
-        self._hydrostatic_refractivity = self._k1 * self._p / self._t
+        if find_e:
+            if self._humidityType not in ('q', 'rh'):
+                raise RuntimeError('Not a valid humidity type')
+            humidity = self._rh if self._humidityType == 'rh' else self._q
+            humidity = np.ascontiguousarray(humidity, dtype=np.float64).ravel()
+            self._e = np.empty(self._t.shape)
+        else:
+            humidity = None
+            self._e = np.ascontiguousarray(self._e, dtype=np.float64)
+
+        shape = self._t.shape
+        t = np.ascontiguousarray(self._t, dtype=np.float64).ravel()
+        p = np.ascontiguousarray(np.broadcast_to(self._p, shape), dtype=np.float64).ravel()
+        e = self._e.ravel()
+        if refractivity:
+            self._wet_refractivity = np.empty(shape)
+            self._hydrostatic_refractivity = np.empty(shape)
+            wet = self._wet_refractivity.ravel()
+            hydro = self._hydrostatic_refractivity.ravel()
+
+        def run(block):
+            _refractivity_block(
+                t[block], p[block],
+                None if humidity is None else humidity[block],
+                self._humidityType, self._R_v, self._R_d, self._k1, self._k2, self._k3,
+                e[block],
+                wet[block] if refractivity else None,
+                hydro[block] if refractivity else None
+            )
+
+        blocks = [slice(i, i + _REFRACTIVITY_BLOCK_SIZE) for i in range(0, t.size, _REFRACTIVITY_BLOCK_SIZE)]
+        if len(blocks) == 1:
+            run(blocks[0])
+        else:
+            with ThreadPoolExecutor(max_workers=min(self._max_threads(), len(blocks))) as pool:
+                list(pool.map(run, blocks))
+
+        self._rh = None
+        self._q = None
 
     def getWetRefractivity(self):
         return self._wet_refractivity
@@ -315,10 +516,15 @@ class WeatherModel(ABC):
 
         if self._zmin < np.nanmin(self._zs):
             # first add in a new layer at zmin
-            self._zs = np.insert(self._zs, 0, self._zmin)
+            if self._zs.ndim == 3:
+                zmin = np.full(self._zs.shape[:2] + (1,), self._zmin)
+                self._zs = np.concatenate((zmin, self._zs), axis=2)
+            else:
+                self._zs = np.insert(self._zs, 0, self._zmin)
 
-            self._lons = np.concatenate((self._lons[:, :, 0][..., np.newaxis], self._lons), axis=2)
-            self._lats = np.concatenate((self._lats[:, :, 0][..., np.newaxis], self._lats), axis=2)
+            if self._lats.ndim == 3:
+                self._lons = np.concatenate((self._lons[:, :, 0][..., np.newaxis], self._lons), axis=2)
+                self._lats = np.concatenate((self._lats[:, :, 0][..., np.newaxis], self._lats), axis=2)
 
             self._p = util.padLower(self._p)
             self._t = util.padLower(self._t)
@@ -367,12 +573,63 @@ class WeatherModel(ABC):
             return True
         return False
 
+    def _crop_grid(self, Nextra=2):
+        '''
+        Cut the freshly loaded grid down to what is needed before any further
+        processing: horizontally to self._bounds (if known) plus Nextra
+        cells, and vertically to the levels up to and including the first
+        level entirely above self._zmax.
+        '''
+        shape = self._p.shape
+        rows, cols, levels = slice(None), slice(None), slice(None)
+
+        if getattr(self, '_bounds', None) is not None and self._lats is not None:
+            lat_min, lat_max, lon_min, lon_max = self._bounds
+            lats = self._lats if self._lats.ndim == 2 else self._lats[..., 0]
+            lons = self._lons if self._lons.ndim == 2 else self._lons[..., 0]
+            # Compare longitudes modulo 360 so that models on 0-360 grids work
+            mask = (lats >= lat_min) & (lats <= lat_max) & \
+                   (np.mod(lons - lon_min, 360) <= lon_max - lon_min)
+            # If nothing is inside, leave the grid alone and let
+            # _adjust_grid report that the model does not cover the points
+            if np.any(mask):
+                ind1 = np.flatnonzero(np.any(mask, axis=1))
+                ind2 = np.flatnonzero(np.any(mask, axis=0))
+                rows = slice(max(ind1[0] - Nextra, 0), min(ind1[-1] + Nextra + 1, shape[0]))
+                cols = slice(max(ind2[0] - Nextra, 0), min(ind2[-1] + Nextra + 1, shape[1]))
+
+        if self._zs is not None and np.ndim(self._zs) == 3 and self._zs.shape == shape:
+            # levels with at least one node at or below zmax
+            zmin = np.nanmin(self._zs[rows, cols, :], axis=(0, 1))
+            below = zmin <= self._zmax
+            if np.any(below) and not np.all(below):
+                if zmin[0] < zmin[-1]:
+                    # heights increase along the axis
+                    levels = slice(0, min(np.flatnonzero(below)[-1] + 2, shape[2]))
+                else:
+                    levels = slice(max(np.flatnonzero(below)[0] - 1, 0), None)
+
+        if (rows, cols, levels) == (slice(None),) * 3:
+            return
+
+        for name in ('_p', '_t', '_q', '_rh', '_e', '_zs', '_xs', '_ys', '_lats', '_lons'):
+            value = getattr(self, name, None)
+            if not isinstance(value, np.ndarray):
+                continue
+            if value.shape == shape:
+                setattr(self, name, value[rows, cols, levels])
+            elif value.shape == shape[:2]:
+                setattr(self, name, value[rows, cols])
+        log.debug('Cropped the weather model from %s to %s', shape, self._p.shape)
+
     def _trimExtent(self, extent):
         '''
         get the bounding box around a set of lats/lons
         '''
-        mask = (self._lats[:, :, 0] > extent[0]) & (self._lats[:, :, 0] < extent[1]) & \
-               (self._lons[:, :, 0] > extent[2]) & (self._lons[:, :, 0] < extent[3])
+        lats = self._lats if self._lats.ndim == 2 else self._lats[:, :, 0]
+        lons = self._lons if self._lons.ndim == 2 else self._lons[:, :, 0]
+        mask = (lats > extent[0]) & (lats < extent[1]) & \
+               (lons > extent[2]) & (lons < extent[3])
         ma1 = np.sum(mask, axis=1).astype('bool')
         ma2 = np.sum(mask, axis=0).astype('bool')
 
@@ -384,10 +641,12 @@ class WeatherModel(ABC):
         index4 = min(np.arange(len(ma2))[ma2][-1] + 2, nx)
 
         # subset around points of interest
-        self._lons = self._lons[index1:index2, index3:index4, :]
+        self._lons = self._lons[index1:index2, index3:index4, ...]
         self._lats = self._lats[index1:index2, index3:index4, ...]
         self._xs = self._xs[index3:index4]
         self._ys = self._ys[index1:index2]
+        if self._zs.ndim == 3:
+            self._zs = self._zs[index1:index2, index3:index4, :]
         self._p = self._p[index1:index2, index3:index4, ...]
         self._t = self._t[index1:index2, index3:index4, ...]
         self._e = self._e[index1:index2, index3:index4, ...]
@@ -395,39 +654,6 @@ class WeatherModel(ABC):
         self._wet_refractivity = self._wet_refractivity[index1:index2, index3:index4, ...]
         self._hydrostatic_refractivity = self._hydrostatic_refractivity[index1:index2, index3:index4, :]
 
-    def _find_svp(self):
-        """
-        Calculate standard vapor presure. Should be model-specific
-        """
-        # From TRAIN:
-        # Could not find the wrf used equation as they appear to be
-        # mixed with latent heat etc. Istead I used the equations used
-        # in ERA-I (see IFS documentation part 2: Data assimilation
-        # (CY25R1)). Calculate saturated water vapour pressure (svp) for
-        # water (svpw) using Buck 1881 and for ice (swpi) from Alduchow
-        # and Eskridge (1996) euation AERKi
-
-        # TODO: figure out the sources of all these magic numbers and move
-        # them somewhere more visible.
-        # TODO: (Jeremy) - Need to fix/get the equation for the other
-        # weather model types. Right now this will be used for all models,
-        # except WRF, which is yet to be implemented in my new structure.
-        t1 = 273.15  # O Celsius
-        t2 = 250.15  # -23 Celsius
-
-        tref = self._t - t1
-        wgt = (self._t - t2) / (t1 - t2)
-        svpw = (6.1121 * np.exp((17.502 * tref) / (240.97 + tref)))
-        svpi = (6.1121 * np.exp((22.587 * tref) / (273.86 + tref)))
-
-        svp = svpi + (svpw - svpi) * wgt**2
-        ix_bound1 = self._t > t1
-        svp[ix_bound1] = svpw[ix_bound1]
-        ix_bound2 = self._t < t2
-        svp[ix_bound2] = svpi[ix_bound2]
-
-        self._svp = svp * 100
-
     def _calculategeoh(self, z, lnsp):
         '''
         Function to calculate pressure, geopotential, and geopotential height
@@ -443,12 +669,7 @@ class WeatherModel(ABC):
                            the input points
             geoheight    - The geopotential heights
         '''
-        geopotential = np.zeros_like(self._t)
-        pressurelvs = np.zeros_like(geopotential)
-        geoheight = np.zeros_like(geopotential)
-
         # surface pressure: pressure at the surface!
-        # Note that we integrate from the ground up, so from the largest model level to 0
         sp = np.exp(lnsp)
 
         # t should be structured [z, y, x]
@@ -460,52 +681,40 @@ class WeatherModel(ABC):
                 'and b have lengths {} and {} respectively. Of '.format(len(self._a), len(self._b)) +
                 'course, these three numbers should be equal.')
 
-        Ph_levplusone = self._a[levelSize] + (self._b[levelSize] * sp)
-
-        # Integrate up into the atmosphere from *lowest level*
-        z_h = 0  # initial value
-        for lev, t_level, q_level in zip(
-                range(levelSize, 0, -1), self._t[::-1], self._q[::-1]):
-
-            # lev is the level number 1-60, we need a corresponding index
-            # into ts and qs
-            # ilevel = levelSize - lev # << this was Ray's original, but is a typo
-            # because indexing like that results in pressure and height arrays that
-            # are in the opposite orientation to the t/q arrays.
-            ilevel = lev - 1
-
-            # compute moist temperature
-            t_level = t_level * (1 + 0.609133 * q_level)
-
-            # compute the pressures (on half-levels)
-            Ph_lev = self._a[lev - 1] + (self._b[lev - 1] * sp)
-
-            pressurelvs[ilevel] = Ph_lev
-
-            if lev == 1:
-                dlogP = np.log(Ph_levplusone / 0.1)
-                alpha = np.log(2)
-            else:
-                dlogP = np.log(Ph_levplusone / Ph_lev)
-                dP = Ph_levplusone - Ph_lev
-                alpha = 1 - ((Ph_lev / dP) * dlogP)
-
-            TRd = t_level * self._R_d
-
-            # z_f is the geopotential of this full level
-            # integrate from previous (lower) half-level z_h to the full level
-            z_f = z_h + TRd * alpha
-            # geoheight[ilevel] = z_f/self._g0
-
-            # Geopotential (add in surface geopotential)
-            geopotential[ilevel] = z_f + z
-            geoheight[ilevel] = geopotential[ilevel] / self._g0
+        a = np.asarray(self._a, dtype=np.float64)
+        b = np.asarray(self._b, dtype=np.float64)
+        shape = self._t.shape
+        sp = np.broadcast_to(sp, shape[1:]).ravel()
+        z = np.broadcast_to(z, shape[1:]).ravel()
+        t = self._t.reshape(shape[0], -1)
+        q = self._q.reshape(shape[0], -1)
+
+        geopotential = np.empty(t.shape)
+        pressurelvs = np.empty(t.shape)
+        geoheight = np.empty(t.shape)
+
+        # The columns are independent, so they are split between threads
+        # (numpy releases the GIL)
+        ncols = t.shape[1]
+        nthreads = max(1, min(self._max_threads(), ncols // _GEOH_MIN_COLUMNS))
+        step = -(-ncols // nthreads)
+
+        def run(cols):
+            _calculategeoh_columns(
+                a, b, sp[cols], z[cols], t[:, cols], q[:, cols], self._R_d, self._g0,
+                geopotential[:, cols], pressurelvs[:, cols], geoheight[:, cols]
+            )
 
-            # z_h is the geopotential of 'half-levels'
-            # integrate z_h to next half level
-            z_h += TRd * dlogP
+        blocks = [slice(i, i + step) for i in range(0, ncols, step)]
+        if len(blocks) == 1:
+            run(blocks[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(blocks)) as pool:
+                list(pool.map(run, blocks))
 
-            Ph_levplusone = Ph_lev
+        geopotential = geopotential.reshape(shape)
+        pressurelvs = pressurelvs.reshape(shape)
+        geoheight = geoheight.reshape(shape)
 
         return geopotential, pressurelvs, geoheight
 
@@ -520,6 +729,25 @@ class WeatherModel(ABC):
 
         return lat_min, lat_max, lon_min, lon_max
 
+    def _horizontal_latlon(self):
+        '''
+        Lats and lons are the same on every level, so only keep them over the
+        horizontal grid. Use _broadcast_latlon where a 3D version is needed.
+        '''
+        if np.ndim(self._lats) == 3:
+            self._lats = np.ascontiguousarray(self._lats[..., 0])
+        if np.ndim(self._lons) == 3:
+            self._lons = np.ascontiguousarray(self._lons[..., 0])
+
+    def _broadcast_latlon(self, shape):
+        '''
+        Return read-only views of the lats and lons with the given 3D shape
+        '''
+        lats, lons = self._lats, self._lons
+        if lats.ndim == 2:
+            lats, lons = lats[..., np.newaxis], lons[..., np.newaxis]
+        return np.broadcast_to(lats, shape), np.broadcast_to(lons, shape)
+
     def getProjection(self):
         '''
         Returns the native weather projection, which should be a pyproj object
@@ -549,6 +777,16 @@ class WeatherModel(ABC):
 
         return xArray, yArray
 
+    def _native_in_z(self):
+        '''
+        Keep all variables on the native model levels. self._zs keeps the
+        height of every grid node, which must increase along each column,
+        and x and y are reduced to the axes of the horizontal grid.
+        '''
+        self._zs = np.ascontiguousarray(self._zs, dtype=np.float64)
+        self._xs = np.unique(self._xs[..., 0] if np.ndim(self._xs) == 3 else self._xs)
+        self._ys = np.unique(self._ys[..., 0] if np.ndim(self._ys) == 3 else self._ys)
+
     def _uniform_in_z(self, _zlevels=None):
         '''
         Interpolate all variables to a regular grid in z
@@ -562,9 +800,15 @@ class WeatherModel(ABC):
 
         # re-assign values to the uniform z
         # new variables
-        self._t = interpolate_along_axis(self._zs, self._t, new_zs, axis=2, fill_value=np.nan)
-        self._p = interpolate_along_axis(self._zs, self._p, new_zs, axis=2, fill_value=np.nan)
-        self._e = interpolate_along_axis(self._zs, self._e, new_zs, axis=2, fill_value=np.nan)
+        self._t = interpolate_along_axis(
+            self._zs, self._t, new_zs, axis=2, fill_value=np.nan, max_threads=self._max_threads()
+        )
+        self._p = interpolate_along_axis(
+            self._zs, self._p, new_zs, axis=2, fill_value=np.nan, max_threads=self._max_threads()
+        )
+        self._e = interpolate_along_axis(
+            self._zs, self._e, new_zs, axis=2, fill_value=np.nan, max_threads=self._max_threads()
+        )
         self._zs = _zlevels
         self._xs = np.unique(self._xs)
         self._ys = np.unique(self._ys)
@@ -582,6 +826,14 @@ class WeatherModel(ABC):
             self._e = self._e.filled(fill_value=np.nan)
         except:
             pass
+        try:
+            self._q = self._q.filled(fill_value=np.nan)
+        except:
+            pass
+        try:
+            self._rh = self._rh.filled(fill_value=np.nan)
+        except:
+            pass
         try:
             self._wet_refractivity = self._wet_refractivity.filled(fill_value=np.nan)
         except:
@@ -597,16 +849,27 @@ class WeatherModel(ABC):
         '''
         self._p = fillna3D(self._p)
         self._t = fillna3D(self._t)
-        self._e = fillna3D(self._e)
+        if self._e is not None:
+            self._e = fillna3D(self._e)
+        elif self._humidityType == 'rh':
+            self._rh = fillna3D(self._rh)
+        else:
+            self._q = fillna3D(self._q)
 
-    def write2HDF5(self, outName=None):
+    def write2HDF5(self, outName=None, fields=_DELAY_FIELDS):
         '''
         Write the main (i.e., needed for external calculations) data to an HDF5 file
         that can be accessed by external programs.
 
         The point of doing this is to alleviate some of the memory load of keeping
         the full model in memory and make it easier to scale up the program.
+
+        fields lists the 3D variables written besides the coordinates; by
+        default only those needed to compute delays. See _HDF5_FIELDS for the
+        names available. Gridded datasets are chunked and compressed so that
+        readers can fetch only the part of the grid they need.
         '''
+        from RAiDER.processWM import getDatasetOptions
 
         if outName is None:
             outName = os.path.join(
@@ -616,56 +879,32 @@ class WeatherModel(ABC):
                 ) + '.h5'
             )
 
+        def create(name, data):
+            data = np.asarray(data, dtype=np.float64)
+            return f.create_dataset(name, data=data, **getDatasetOptions(data.shape))
+
         with h5py.File(outName, 'w') as f:
-            x = f.create_dataset('x', data=self._xs.astype(np.float64))
-            y = f.create_dataset('y', data=self._ys.astype(np.float64))
-            z = f.create_dataset('z', data=self._zs.astype(np.float64))
+            x = create('x', self._xs)
+            y = create('y', self._ys)
+            z = create('z', self._zs)
             x.make_scale('x - weather model native')
             y.make_scale('y - weather model native')
-            z.make_scale('z - weather model native')
-
-            lats = f.create_dataset('lat', data=self._lats.astype(np.float64))
-            lons = f.create_dataset('lon', data=self._lons.astype(np.float64))
-            lats.dims[0].attach_scale(x)
-            lats.dims[1].attach_scale(y)
-            lats.dims[2].attach_scale(z)
-            lons.dims[0].attach_scale(x)
-            lons.dims[1].attach_scale(y)
-            lons.dims[2].attach_scale(z)
-
-            t = f.create_dataset('t', data=self._t)
-            t.dims[0].attach_scale(x)
-            t.dims[1].attach_scale(y)
-            t.dims[2].attach_scale(z)
-
-            p = f.create_dataset('p', data=self._p)
-            p.dims[0].attach_scale(x)
-            p.dims[1].attach_scale(y)
-            p.dims[2].attach_scale(z)
-
-            e = f.create_dataset('e', data=self._e)
-            e.dims[0].attach_scale(x)
-            e.dims[1].attach_scale(y)
-            e.dims[2].attach_scale(z)
-
-            wet = f.create_dataset('wet', data=self._wet_refractivity)
-            wet.dims[0].attach_scale(x)
-            wet.dims[1].attach_scale(y)
-            wet.dims[2].attach_scale(z)
-
-            wet_total = f.create_dataset('wet_total', data=self._wet_total)
-            wet_total.dims[0].attach_scale(x)
-            wet_total.dims[1].attach_scale(y)
-            wet_total.dims[2].attach_scale(z)
-
-            hydro = f.create_dataset('hydro', data=self._hydrostatic_refractivity)
-            hydro.dims[0].attach_scale(x)
-            hydro.dims[1].attach_scale(y)
-            hydro.dims[2].attach_scale(z)
-
-            hydro_total = f.create_dataset('hydro_total', data=self._hydrostatic_total)
-            hydro_total.dims[0].attach_scale(x)
-            hydro_total.dims[1].attach_scale(y)
-            hydro_total.dims[2].attach_scale(z)
+            # On native model levels z holds the height of every node and
+            # cannot be a dimension scale
+            if z.ndim == 1:
+                z.make_scale('z - weather model native')
+
+            # lats and lons do not change with height
+            for name, data in (('lat', self._lats), ('lon', self._lons)):
+                dset = create(name, data)
+                dset.dims[0].attach_scale(x)
+                dset.dims[1].attach_scale(y)
+
+            for name in fields:
+                dset = create(name, getattr(self, _HDF5_FIELDS[name]))
+                dset.dims[0].attach_scale(x)
+                dset.dims[1].attach_scale(y)
+                if z.is_scale:
+                    dset.dims[2].attach_scale(z)
 
             f.create_dataset('Projection', data=self._proj.to_json())
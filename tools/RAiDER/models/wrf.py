@@ -39,7 +39,7 @@ class WRF(WeatherModel):
             lons, lats = self._get_wm_nodes(file1)
             self._read_netcdf(file2)
         except KeyError:
-            self._get_wm_nodes(file2)
+            lons, lats = self._get_wm_nodes(file2)
             self._read_netcdf(file1)
 
         # WRF doesn't give us the coordinates of the points in the native projection,
@@ -67,6 +67,8 @@ class WRF(WeatherModel):
         self._ys = np.transpose(_ys)
         self._xs = np.transpose(_xs)
         self._zs = np.transpose(self._zs)
+        self._lats = np.broadcast_to(lats.T[..., np.newaxis], self._p.shape)
+        self._lons = np.broadcast_to(lons.T[..., np.newaxis], self._p.shape)
 
         # TODO: Not sure if WRF provides this
         self._levels = list(range(self._zs.shape[2]))
@@ -11,13 +11,20 @@ import logging
 import os
 import sys
 from datetime import datetime
+from functools import partial
 
+import h5py
 import numpy as np
 
+from RAiDER.cache import WeatherModelCache, make_cache_key
 from RAiDER.utilFcns import getTimeFromFile
 
 log = logging.getLogger(__name__)
 
+# Horizontal size of the chunks of gridded datasets in processed weather
+# model files
+_WM_CHUNK_SIZE = 64
+
 
 def getWMFilename(weather_model_name, time, outLoc):
     '''
@@ -45,46 +52,254 @@ def getWMFilename(weather_model_name, time, outLoc):
     return download_flag, f
 
 
+def fetchWeatherModel(weather_model, lats, lons, time, outLoc):
+    '''
+    Download the raw weather model for a date into outLoc unless it is
+    already there, and register the file in the weather model cache. The
+    download holds the cache lock for the file, so several processes asking
+    for the same date download it only once. Returns the filename, or None
+    for models that read their data from the server in load (e.g. GMAO).
+    '''
+    cache = WeatherModelCache(outLoc)
+    name = weather_model.Model()
+    key = make_cache_key('raw', name, time)
+    # A file in the cache is complete; the lock would wait for the processes
+    # that are reading it
+    if cache.lookup(key) is not None:
+        return getWMFilename(name, time, outLoc)[1]
+
+    with cache.lock(key):
+        download_flag, f = getWMFilename(name, time, outLoc)
+        if download_flag:
+            try:
+                weather_model.fetch(lats, lons, time, f)
+            except BaseException:
+                # never leave a partial download behind
+                if os.path.exists(f):
+                    os.remove(f)
+                raise
+
+        # OpenDAP models only store the area to read in fetch
+        if not os.path.exists(f):
+            return None
+
+        # Files downloaded before the cache existed are adopted here
+        if cache.lookup(key) is None:
+            cache.add(key, f, 'raw', name, time)
+
+    return f
+
+
+def cropWeatherModelFile(in_file, out_file, ll_bounds, Nextra=2):
+    '''
+    Write the part of a processed weather model HDF5 file that covers
+    ll_bounds (SNWE), plus Nextra grid cells on each side, to out_file. The
+    cells kept are chosen the same way as in WeatherModel._trimExtent.
+    '''
+    with h5py.File(in_file, 'r') as f:
+        window = _getGridWindow(f, ll_bounds, Nextra)
+        if window is None:
+            raise RuntimeError(
+                'Weather model {} does not cover the bounds {}'.format(in_file, ll_bounds)
+            )
+        _writeWeatherModelFile(f, out_file, lambda name, dset: _readWindow(name, dset, *window))
+
+
+def readWeatherModelFile(filename, names, ll_bounds=None, Nextra=2):
+    '''
+    Read the datasets names from a processed weather model HDF5 file. If
+    ll_bounds (SNWE) is given, only the part of the grid covering it plus
+    Nextra cells on each side is read, so only the chunks of the file
+    intersecting the bounds are fetched. The whole grid is read if none of
+    it is inside ll_bounds.
+    '''
+    with h5py.File(filename, 'r') as f:
+        window = None if ll_bounds is None else _getGridWindow(f, ll_bounds, Nextra)
+        if window is None:
+            return [f[name][()] for name in names]
+        return [_readWindow(name, f[name], *window) for name in names]
+
+
+def _getGridWindow(f, ll_bounds, Nextra=2):
+    '''
+    Return the rows and columns of the grid of the open processed weather
+    model file f that cover ll_bounds (SNWE), plus Nextra cells on each side,
+    along with the horizontal shape of the grid; or None if no grid node is
+    inside ll_bounds. Longitudes are compared modulo 360.
+    '''
+    # lats and lons are 2D in newer files and 3D in older ones
+    lats = f['lat'][()] if f['lat'].ndim == 2 else f['lat'][:, :, 0]
+    lons = f['lon'][()] if f['lon'].ndim == 2 else f['lon'][:, :, 0]
+    lat_min, lat_max, lon_min, lon_max = ll_bounds
+    mask = (lats >= lat_min) & (lats <= lat_max) & \
+           (np.mod(lons - lon_min, 360) <= lon_max - lon_min)
+    if not np.any(mask):
+        return None
+
+    ny, nx = mask.shape
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    rows = slice(max(rows[0] - Nextra, 0), min(rows[-1] + Nextra + 1, ny))
+    cols = slice(max(cols[0] - Nextra, 0), min(cols[-1] + Nextra + 1, nx))
+    return rows, cols, (ny, nx)
+
+
+def _readWindow(name, dset, rows, cols, shape):
+    '''
+    Read the part of dataset dset within the given rows and columns of the
+    horizontal grid
+    '''
+    if name == 'x' and dset.ndim == 1:
+        return dset[cols]
+    elif name == 'y' and dset.ndim == 1:
+        return dset[rows]
+    elif dset.ndim >= 2 and dset.shape[:2] == shape:
+        return dset[rows, cols, ...]
+    return dset[()]
+
+
+def interpolateWeatherModelFilesInTime(file1, file2, weight, out_file, max_threads=0):
+    '''
+    Linearly interpolate two processed weather model HDF5 files for the same
+    area to a time between them, and write the result to out_file.
+
+    Inputs:
+        file1, file2 - processed weather models for the two epochs
+        weight       - fraction of the way from the first to the second
+                       epoch, between 0 and 1
+        out_file     - output file name
+        max_threads  - number of threads to use, 0 for one per core
+
+    Both files must share the same horizontal grid. The heights of each
+    epoch are set from its own data, so the second epoch is resampled to the
+    heights of the first one where they differ, column by column for native
+    model levels; above and below the heights of the second epoch the first
+    epoch's values are used.
+    '''
+    from RAiDER.interpolate import interpolate_along_axis
+
+    with h5py.File(file1, 'r') as f1, h5py.File(file2, 'r') as f2:
+        for name in ('x', 'y'):
+            if f1[name].shape != f2[name].shape or not np.allclose(f1[name][()], f2[name][()]):
+                raise RuntimeError(
+                    'Weather models {} and {} are not on the same grid'.format(file1, file2)
+                )
+
+        z1 = f1['z'][()]
+        z2 = f2['z'][()]
+        same_z = z1.shape == z2.shape and np.allclose(z1, z2)
+        shape = f1['wet'].shape
+
+        def blend(name, dset):
+            data1 = dset[()]
+            if name in ('x', 'y', 'z', 'lat', 'lon') or dset.shape != shape or name not in f2:
+                return data1
+
+            data2 = f2[name][()]
+            if not same_z:
+                data2 = interpolate_along_axis(
+                    np.ascontiguousarray(np.broadcast_to(z2, data2.shape), dtype=np.float64),
+                    np.ascontiguousarray(data2, dtype=np.float64),
+                    np.ascontiguousarray(np.broadcast_to(z1, shape), dtype=np.float64),
+                    axis=2, fill_value=np.nan, max_threads=max_threads
+                )
+                data2 = np.where(np.isnan(data2), data1, data2)
+            return (1 - weight) * data1 + weight * data2
+
+        _writeWeatherModelFile(f1, out_file, blend)
+
+
+def getDatasetOptions(shape):
+    '''
+    Return the h5py create_dataset options for a dataset of the given shape
+    in a processed weather model file: gridded datasets are chunked over
+    horizontal tiles of the full height and compressed with shuffle + lzf,
+    which is fast to decode. 1D axes and scalars are stored as they are.
+    '''
+    if len(shape) < 2:
+        return {}
+    chunks = tuple(max(min(n, _WM_CHUNK_SIZE), 1) for n in shape[:2]) + \
+        tuple(max(n, 1) for n in shape[2:])
+    return {'chunks': chunks, 'compression': 'lzf', 'shuffle': True}
+
+
+def _writeWeatherModelFile(f, out_file, get_data):
+    '''
+    Write a processed weather model HDF5 file laid out like the open file f,
+    with each dataset's values given by get_data(name, dataset). The file is
+    written to a temporary name first so that a partial file is never picked
+    up by another run.
+    '''
+    tmp_file = '{}.{}.tmp'.format(out_file, os.getpid())
+    with h5py.File(tmp_file, 'w') as fout:
+        for name, dset in f.items():
+            data = get_data(name, dset)
+            fout.create_dataset(name, data=data, **getDatasetOptions(np.shape(data)))
+            for attr, value in dset.attrs.items():
+                if attr not in ('CLASS', 'NAME', 'DIMENSION_LIST', 'REFERENCE_LIST'):
+                    fout[name].attrs[attr] = value
+        for attr, value in f.attrs.items():
+            fout.attrs[attr] = value
+
+        # z is only a dimension scale when the model is on uniform levels
+        scales = [name for name in ('x', 'y', 'z') if fout[name].ndim == 1]
+        for name in scales:
+            fout[name].make_scale('{} - weather model native'.format(name))
+        for dset in fout.values():
+            if dset.ndim >= 2 and not dset.is_scale:
+                for dim, name in enumerate(('x', 'y', 'z')[:dset.ndim]):
+                    if name in scales:
+                        dset.dims[dim].attach_scale(fout[name])
+
+    os.replace(tmp_file, out_file)
+
+
 def prepareWeatherModel(weatherDict, wmFileLoc, out, lats=None, lons=None,
                         los=None, zref=None, time=None,
-                        download_only=False, makePlots=False):
+                        download_only=False, makePlots=False, crop=True, nthreads=0):
     '''
-    Parse inputs to download and prepare a weather model grid for interpolation
+    Parse inputs to download and prepare a weather model grid for interpolation.
+    If crop is False, lats and lons are only used to download the weather
+    model and the whole of it is processed. nthreads limits the number of
+    threads used to process it, 0 for one per core.
     '''
 
     # Make weather
     weather_model, weather_files, weather_model_name = \
     weatherDict['type'], weatherDict['files'], weatherDict['name']
 
-    # check whether weather model files are supplied
-    if weather_files is None:
-        download_flag, f = getWMFilename(weather_model.Model(), time, wmFileLoc)
-    else:
-        download_flag = False
-        time = getTimeFromFile(weather_files[0])
-
     # if no weather model files supplied, check the standard location
-    if download_flag:
+    if weather_files is None:
+        fetch = partial(fetchWeatherModel, weather_model, lats, lons, time, wmFileLoc)
         try:
-            weather_model.fetch(lats, lons, time, f)
+            fetch()
         except Exception:
             log.exception('Unable to download weather data')
             # TODO: Is this really an appropriate place to be calling sys.exit?
             sys.exit(0)
+    else:
+        time = getTimeFromFile(weather_files[0])
 
-        # exit on download if download_only requested
-        if download_only:
-            log.warning(
-                'download_only flag selected. No further processing will happen.'
-            )
-            return None, None, None
+    # exit on download if download_only requested. The file may also have
+    # been downloaded already, e.g. by a background prefetch
+    if download_only:
+        log.warning(
+            'download_only flag selected. No further processing will happen.'
+        )
+        return None, None, None
 
     # Load the weather model data
+    outLats, outLons = (lats, lons) if crop else (None, None)
     if weather_files is not None:
-        weather_model.load(*weather_files, outLats=lats, outLons=lons, los=los, zref=zref)
-        download_flag = False
+        weather_model.load(
+            *weather_files, outLats=outLats, outLons=outLons, los=los, zref=zref, nthreads=nthreads
+        )
     else:
-        weather_model.load(f, outLats=lats, outLons=lons, los=los, zref=zref)
+        # Keep the raw file from being evicted from the cache while it is read
+        with WeatherModelCache(wmFileLoc).use(fetch) as f:
+            weather_model.load(
+                f, outLats=outLats, outLons=outLons, los=los, zref=zref, nthreads=nthreads
+            )
 
     log.debug('Number of weather model nodes: %d', np.prod(weather_model.getWetRefractivity().shape))
     log.debug('Shape of weather model: %s', weather_model.getWetRefractivity().shape)
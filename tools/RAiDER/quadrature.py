@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# Author: Jeremy Maurer, Raymond Hogenson & David Bekaert
+# Copyright 2019, by the California Institute of Technology. ALL RIGHTS
+# RESERVED. United States Government Sponsorship acknowledged.
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+"""
+Integration rules along the rays that place their samples non-uniformly.
+Refractivity decays roughly exponentially with height, so evenly spaced
+samples are wasted aloft.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from RAiDER.constants import _H_SCALE, _STRETCH
+
+# integrals: array of shape (number of integrands, number of rays)
+# evaluations: number of samples taken along each ray
+# error: estimated absolute error of each integral
+# filled: number of the samples along each ray that were NaN, e.g. outside of
+#         the weather model, and counted as zero
+QuadratureResult = namedtuple('QuadratureResult', ('integrals', 'evaluations', 'error', 'filled'))
+
+
+def stretched_grid(length, step, scale=_STRETCH):
+    '''
+    Samples and weights for integrating over [0, length] on a grid whose
+    spacing starts at step and grows as exp(s / scale) along the ray.
+
+    The grid is uniform in u = 1 - exp(-s / scale), where an exponentially
+    decaying integrand becomes constant, and the weights are those of
+    Simpson's rule in u. length and scale may be arrays with one value per
+    ray, e.g. the distance to the top of the weather model and the
+    refractivity scale height over the sine of the elevation angle, in which
+    case every ray gets the same number of samples.
+
+    Returns the sample distances s, the weights and the weights of Simpson's
+    rule on every other sample, whose difference from the first estimates
+    the error. They have shape (number of rays, number of samples) if length
+    or scale is an array.
+    '''
+    shared = np.ndim(length) == 0 and np.ndim(scale) == 0
+    length = np.asarray(length, dtype=np.float64).reshape(-1, 1)
+    scale = np.asarray(scale, dtype=np.float64).reshape(-1, 1)
+    u_max = -np.expm1(-length / scale)
+    # A multiple of 4 intervals, so that every other sample is also a
+    # Simpson grid
+    n = max(4, 4 * int(np.ceil(np.max(u_max * scale) / step / 4)))
+    u = u_max * np.linspace(0, 1, n + 1)
+    s = -scale * np.log1p(-u)
+    # du * ds/du
+    ds = u_max / n * scale / (1 - u)
+
+    weights = _simpson_weights(n) * ds
+    coarse = np.zeros(n + 1)
+    coarse[::2] = 2 * _simpson_weights(n // 2)
+    coarse = coarse * ds
+    if shared:
+        return s[0], weights[0], coarse[0]
+    return s, weights, coarse
+
+
+def _simpson_weights(n):
+    '''
+    Weights of the composite Simpson's rule over n (even) unit intervals
+    '''
+    weights = np.full(n + 1, 2.)
+    weights[1::2] = 4
+    weights[[0, -1]] = 1
+    return weights / 3
+
+
+def integrate_stretched(fun, num_rays, length, step, scale=_STRETCH):
+    '''
+    Integrate fun along num_rays rays of the given length on a
+    stretched_grid. fun(s) takes the sample distances s, of shape
+    (num_rays, number of samples) if length or scale is an array and
+    otherwise shared by every ray, and returns the integrands of shape (..., num_rays,
+    number of samples). NaN samples count as zero.
+    '''
+    s, weights, coarse = stretched_grid(length, step, scale)
+    values = fun(s)
+    missing = np.isnan(values).reshape(-1, num_rays, s.shape[-1]).any(axis=0)
+    values = np.nan_to_num(values)
+    integrals = np.sum(values * weights, axis=-1)
+    return QuadratureResult(
+        integrals,
+        np.full(num_rays, s.shape[-1]),
+        np.abs(integrals - np.sum(values * coarse, axis=-1)) / 15,
+        np.sum(missing, axis=-1)
+    )
+
+
+def adaptive_simpson(fun, num_rays, length, tol, min_step, num_panels=64):
+    '''
+    Integrate fun along num_rays rays of the given length, which may differ
+    per ray, with adaptive Simpson quadrature. All of the rays are refined together, so that each
+    round evaluates fun once for every panel that still needs it.
+
+    fun(rays, s) takes matching arrays of ray indices and sample distances
+    and returns the integrands of shape (number of integrands, len(s)). NaN
+    samples count as zero. A panel is accepted once its estimated error is
+    below its share tol * width / length of the tolerance for every
+    integrand, or once it is narrower than 2 * min_step. Like any adaptive
+    rule it can be fooled by features narrower than the num_panels initial
+    panels, such as the levels of a weather model near the ground.
+    '''
+    filled = np.zeros(num_rays, dtype=int)
+
+    def f(rays, s):
+        values = np.atleast_2d(fun(rays, s))
+        np.add.at(filled, rays, np.isnan(values).any(axis=0))
+        return np.nan_to_num(values)
+
+    length = np.broadcast_to(length, (num_rays,))
+    nodes = length[:, np.newaxis] * np.linspace(0, 1, 2 * num_panels + 1)
+    values = f(np.repeat(np.arange(num_rays), nodes.shape[1]), nodes.ravel())
+    values = values.reshape(len(values), num_rays, nodes.shape[1])
+
+    rays = np.repeat(np.arange(num_rays), num_panels)
+    a = nodes[:, :-1:2].ravel()
+    b = nodes[:, 2::2].ravel()
+    fa = values[..., :-1:2].reshape(len(values), -1)
+    fm = values[..., 1::2].reshape(len(values), -1)
+    fb = values[..., 2::2].reshape(len(values), -1)
+
+    integrals = np.zeros((len(values), num_rays))
+    error = np.zeros((len(values), num_rays))
+    evaluations = np.full(num_rays, nodes.shape[1])
+    while len(rays):
+        width = b - a
+        m = len(rays)
+        quarters = f(
+            np.concatenate((rays, rays)),
+            np.concatenate((a + width / 4, a + 3 * width / 4))
+        )
+        fl, fr = quarters[:, :m], quarters[:, m:]
+        np.add.at(evaluations, rays, 2)
+
+        whole = width / 6 * (fa + 4 * fm + fb)
+        halves = width / 12 * (fa + 4 * fl + 2 * fm + 4 * fr + fb)
+        with np.errstate(invalid='ignore'):
+            # rays of zero length have a single panel of zero width
+            converged = np.all(np.abs(halves - whole) / 15 <= tol * width / length[rays], axis=0)
+        done = converged | (width <= 2 * min_step)
+
+        # Richardson extrapolation of the two estimates where the integrand
+        # is smooth; panels that hit min_step, e.g. across the top of the
+        # weather model, are not, and their error is estimated conservatively
+        scale = np.where(converged, 1 / 15, 1)
+        integral = halves + (halves - whole) * np.where(converged, 1 / 15, 0)
+        err = np.abs(halves - whole) * scale
+        for i in range(len(values)):
+            np.add.at(integrals[i], rays[done], integral[i, done])
+            np.add.at(error[i], rays[done], err[i, done])
+
+        split = ~done
+        mid = (a + b) / 2
+        rays = np.concatenate((rays[split], rays[split]))
+        a, b = np.concatenate((a[split], mid[split])), np.concatenate((mid[split], b[split]))
+        fa, fm, fb = (
+            np.concatenate((fa[:, split], fm[:, split]), axis=1),
+            np.concatenate((fl[:, split], fr[:, split]), axis=1),
+            np.concatenate((fm[:, split], fb[:, split]), axis=1),
+        )
+
+    return QuadratureResult(integrals, evaluations, error, filled)
+
+
+def exponential_mapping(sin_elevation, radius, scale_height=_H_SCALE, depth=np.inf, order=32):
+    '''
+    Ratio of the integral along a straight ray to the zenith integral of a
+    refractivity decaying as exp(-h / scale_height) over the height h above
+    the start of the ray, up to depth, at the given distance from the center
+    of the Earth and elevation angle. The curvature of the Earth makes it
+    smaller than 1 / sin_elevation, the more so the lower the ray. The
+    arguments broadcast against each other.
+
+    The path length per unit height is r / sqrt(r**2 - (radius *
+    cos(elevation))**2) with r = radius + h. It is integrated with
+    Gauss-Laguerre quadrature over an infinite depth, and otherwise with
+    Gauss-Legendre quadrature in u = 1 - exp(-h / scale_height), in which the
+    weight is constant. Rays within a few degrees of the horizon need a
+    higher order.
+    '''
+    sin_elevation, radius, scale_height, depth = (
+        np.asarray(a, dtype=np.float64)[..., np.newaxis]
+        for a in (sin_elevation, radius, scale_height, depth)
+    )
+
+    def slant(h):
+        r = radius + h
+        return r / np.sqrt(r ** 2 - (1 - sin_elevation ** 2) * radius ** 2)
+
+    x, w = np.polynomial.laguerre.laggauss(order)
+    infinite = np.sum(w * slant(scale_height * x), axis=-1)
+
+    u, w = np.polynomial.legendre.leggauss(order)
+    # share of the zenith integral inside the layer
+    frac = -np.expm1(-np.where(np.isinf(depth), 0, depth) / scale_height)
+    finite = np.sum(w / 2 * slant(-scale_height * np.log1p(-(u + 1) / 2 * frac)), axis=-1)
+    return np.where(np.isinf(depth[..., 0]), infinite, finite)
@@ -1,14 +1,24 @@
 import argparse
 import logging
+import os
+from datetime import timedelta
+from functools import partial
 from textwrap import dedent
 
+from RAiDER.cache import WeatherModelCache
 from RAiDER.checkArgs import checkArgs
-from RAiDER.cli.parser import add_bbox, add_out, add_verbose
+from RAiDER.cli.parser import add_bbox, add_cpus, add_out, add_verbose
 from RAiDER.cli.validators import DateListAction, date_type, time_type
-from RAiDER.constants import _ZREF
-from RAiDER.delay import tropo_delay
+from RAiDER.constants import _QUAD_TOL, _STEP, _ZREF
+from RAiDER.delay import delay_kind, prepare_query_points, tropo_delay
+from RAiDER.delayFcns import RAY_QUADRATURES
 from RAiDER.logger import logger
 from RAiDER.models.allowed import ALLOWED_MODELS
+from RAiDER.scheduler import (
+    WeatherModelPrefetcher, estimate_date_memory, get_num_jobs, run_dates,
+    write_summary
+)
+from RAiDER.utilFcns import get_bracketing_times, make_weather_model_filename
 
 log = logging.getLogger(__name__)
 
@@ -103,6 +113,12 @@ def create_parser():
         '--weatherFiles', '-w',
         help='Directory location of/to write weather model files',
         default=None, dest='wmLoc')
+    weather.add_argument(
+        '--interpolate_time',
+        help='Interpolate the weather model linearly in time between the two model '
+             'epochs on either side of the requested time, instead of using the '
+             'closest epoch. Default False',
+        action='store_true', dest='interpolate_time', default=False)
 
     misc = p.add_argument_group("Run parameters")
     misc.add_argument(
@@ -110,11 +126,48 @@ def create_parser():
         help='Height limit when integrating (meters) (default: {} km)'.format(_ZREF),
         type=float,
         default=_ZREF)
+    misc.add_argument(
+        '--step',
+        help='Integration step size along the rays in meters; for the stretched '
+             'rule the step at the ground and for the adaptive rule the finest '
+             'step (default: {} m)'.format(_STEP),
+        type=float,
+        default=_STEP)
+    misc.add_argument(
+        '--quadrature',
+        help='Integration rule along the rays. "stretched" samples more sparsely '
+             'aloft, "adaptive" refines until --tolerance is met and "exact" '
+             'integrates the interpolated weather model cell by cell. Default rectangle',
+        choices=RAY_QUADRATURES,
+        default='rectangle')
+    misc.add_argument(
+        '--tolerance',
+        help='Target error of the adaptive quadrature in meters of delay '
+             '(default: {} m)'.format(_QUAD_TOL),
+        type=float,
+        default=_QUAD_TOL)
+    misc.add_argument(
+        '--zcut',
+        help='Only integrate the rays up to this height in meters, e.g. 8000, '
+             'and map the weather model zenith delay above it onto each ray. '
+             'Accurate to about a millimeter down to 5 degrees elevation '
+             '(default: integrate up to --zref)',
+        type=float,
+        default=None)
     misc.add_argument(
         '--outformat',
         help='GDAL-compatible file format if surface delays are requested.',
         default=None)
 
+    misc.add_argument(
+        '--full_model',
+        help='Process the weather model over its full extent and crop the area '
+             'of interest from it, so that later runs over other areas it covers '
+             're-use it. Worthwhile for many overlapping areas; for a single small '
+             'area it processes much more than needed (e.g. all of CONUS for HRRR). '
+             'Default False',
+        action='store_true', default=False)
+
     add_out(misc)
 
     misc.add_argument(
@@ -122,6 +175,26 @@ def create_parser():
         help='Download weather model only without processing? Default False',
         action='store_true', dest='download_only', default=False)
 
+    misc.add_argument(
+        '--jobs', '-j',
+        help='Number of dates to process at the same time. Default 1',
+        type=int, default=1)
+
+    # Every core by default, which the delay calculation has always used
+    add_cpus(misc, default=os.cpu_count() or 1)
+
+    misc.add_argument(
+        '--prefetch',
+        help='Number of upcoming dates whose weather model is downloaded in the '
+             'background while the current date is processed. 0 to disable. Default 2',
+        type=int, default=2)
+
+    misc.add_argument(
+        '--max_memory',
+        help='Memory budget in GB shared by all of the dates that run at the '
+             'same time. Limits the number of concurrent dates. Default no limit',
+        type=float, default=None)
+
     add_verbose(misc)
 
     return p
@@ -144,12 +217,80 @@ def parseCMD():
     if verbose:
         logger.setLevel(logging.DEBUG)
 
+    # The heights and query points only depend on the area of interest, so
+    # compute them once for all of the dates
+    geometry = None
+    if not download_only:
+        geometry = prepare_query_points(
+            los, lats, lons, heights, flag == 'bounding_box', zref, out
+        )
+
+    max_memory = None if args.max_memory is None else args.max_memory * 1e9
+    njobs, cpus_each = get_num_jobs(
+        args.jobs, args.cpus, max_memory=max_memory,
+        memory_fcn=partial(estimate_date_memory, lats.size, zref, stepSize=args.step)
+    )
+    log.info('Running %d date(s) at a time using %d cpu(s) each', njobs, cpus_each)
+
+    run_fcn = partial(
+        _compute_date, los, lats, lons, ll_bounds, heights, flag, weather_model, wmLoc,
+        zref, outformat, out, download_only, geometry, cpus_each, args.interpolate_time,
+        args.step, args.quadrature, args.tolerance, args.zcut, args.full_model
+    )
+
+    # Download the weather models for the next dates while the current ones
+    # are being processed. Dates that already have a processed weather model
+    # file, or a cached one covering a larger area, do not need a download.
+    prefetcher = None
+    if args.prefetch > 0 and weather_model['files'] is None and len(times) > 1:
+        cache = WeatherModelCache(wmLoc)
+        time_res = getattr(weather_model['type'], '_time_res', None)
+        epochs = None
+        if args.interpolate_time and time_res is not None:
+            # both epochs around each date are needed
+            fetch_times = times
+            epochs = partial(_bracketing_epochs, timedelta(hours=time_res))
+        else:
+            fetch_times = [
+                t for t in times if not os.path.exists(os.path.join(
+                    wmLoc, make_weather_model_filename(weather_model['name'], t, ll_bounds)
+                )) and cache.find_superset(
+                    'processed', weather_model['name'], t, ll_bounds,
+                    zref=_ZREF if zref is None else zref, los=delay_kind(los)
+                ) is None
+            ]
+        prefetcher = WeatherModelPrefetcher(
+            weather_model['type'], fetch_times, wmLoc, lats=lats, lons=lons,
+            depth=args.prefetch, epochs=epochs
+        )
+
     # Loop over each datetime and compute the delay
-    for t, wfn, hfn in zip(times, wetNames, hydroNames):
-        try:
-            (_, _) = tropo_delay(los, lats, lons, ll_bounds, heights, flag, weather_model, wmLoc, zref,
-                                 outformat, t, out, download_only, wfn, hfn)
-
-        except RuntimeError:
-            log.exception("Date %s failed", t)
-            continue
+    try:
+        results = run_dates(
+            run_fcn, times, wetNames, hydroNames, njobs=njobs, prefetcher=prefetcher
+        )
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    write_summary(results, os.path.join(out, 'delay_summary.csv'))
+
+
+def _bracketing_epochs(time_res, t):
+    '''
+    Return the distinct weather model epochs on either side of t
+    '''
+    time1, time2, _ = get_bracketing_times(t, time_res)
+    return sorted({time1, time2})
+
+
+def _compute_date(los, lats, lons, ll_bounds, heights, flag, weather_model, wmLoc,
+                  zref, outformat, out, download_only, geometry, cpu_num, interp_time,
+                  stepSize, quadrature, tol, zcut, full_model, t, wfn, hfn):
+    '''
+    Compute the delays for a single date
+    '''
+    (_, _) = tropo_delay(los, lats, lons, ll_bounds, heights, flag, weather_model, wmLoc, zref,
+                         outformat, t, out, download_only, wfn, hfn,
+                         geometry=geometry, cpu_num=cpu_num, interp_time=interp_time,
+                         stepSize=stepSize, quadrature=quadrature, tol=tol,
+                         zcut=zcut, full_model=full_model)
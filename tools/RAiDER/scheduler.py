@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#
+# Author: Jeremy Maurer, Raymond Hogenson & David Bekaert
+# Copyright 2019, by the California Institute of Technology. ALL RIGHTS
+# RESERVED. United States Government Sponsorship acknowledged.
+#
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+"""
+Run the delay calculation for a list of dates, several at a time
+"""
+import copy
+import csv
+import logging
+import multiprocessing as mp
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from RAiDER.constants import _STEP
+from RAiDER.processWM import fetchWeatherModel
+
+log = logging.getLogger(__name__)
+
+# Rough number of float64 copies of each ray sample that are alive at once
+# while a chunk is processed (ECEF points, projected points, wet, hydro)
+_RAY_COPIES = 8
+# Typical number of rays in one chunk of the query point file
+_RAYS_PER_CHUNK = 10000
+
+
+def estimate_date_memory(npts, zref, cpu_num, stepSize=_STEP):
+    '''
+    Rough estimate of the peak memory (in bytes) needed to compute the delays
+    for a single date.
+
+    Inputs:
+        npts     - Number of query points
+        zref     - Integration height in meters
+        cpu_num  - Number of processes used by the ray integration
+        stepSize - Integration step size in meters
+    '''
+    # Slant rays are longer than zref; allow for an incidence angle up to ~60
+    # degrees
+    samples_per_ray = 2 * zref / stepSize
+    chunk_bytes = min(npts, _RAYS_PER_CHUNK) * samples_per_ray * 3 * 8 * _RAY_COPIES
+    # start points and look vectors, plus the output delays
+    geom_bytes = npts * (6 + 2) * 8
+    return int(geom_bytes + max(cpu_num, 1) * chunk_bytes)
+
+
+def get_num_jobs(njobs, cpus, max_memory=None, memory_fcn=None):
+    '''
+    Decide how many dates can run at the same time, and how many cpus each
+    of them may use, given a global cpu budget and an optional memory budget.
+
+    Inputs:
+        njobs       - Requested number of concurrent dates
+        cpus        - Total number of cpus that may be used
+        max_memory  - Memory budget in bytes (None for no limit)
+        memory_fcn  - Function returning the estimated memory in bytes that
+                      a single date needs when given a number of cpus
+    Outputs:
+        njobs       - Number of dates to run concurrently
+        cpus_each   - Number of cpus to give to each date
+    '''
+    cpus = max(cpus, 1)
+    njobs = max(1, min(njobs, cpus))
+
+    if max_memory is not None and memory_fcn is not None:
+        while njobs > 1 and njobs * memory_fcn(cpus // njobs) > max_memory:
+            njobs -= 1
+        if memory_fcn(cpus // njobs) > max_memory:
+            log.warning(
+                'A single date is estimated to need %.1f GB, more than the '
+                'memory budget of %.1f GB', memory_fcn(cpus // njobs) / 1e9, max_memory / 1e9
+            )
+
+    return njobs, cpus // njobs
+
+
+def _run_date(run_fcn, t, wfn, hfn, result_queue=None, index=None, log_level=None):
+    '''
+    Run a single date and report the outcome. Failures are logged and
+    returned rather than raised, so that one date can not bring down the rest
+    of the stack. In a separate process, the result is also put on
+    result_queue along with index, and log_level is the level of the RAiDER
+    logger, which the process does not inherit.
+    '''
+    if log_level is not None:
+        from RAiDER.logger import logger
+        logger.setLevel(log_level)
+
+    t0 = time.time()
+    try:
+        run_fcn(t, wfn, hfn)
+        status, message = 'success', ''
+    except (Exception, SystemExit) as e:
+        log.exception("Date %s failed", t)
+        status, message = 'failed', repr(e)
+
+    result = {
+        'date': t.strftime('%Y-%m-%dT%H:%M:%S'),
+        'status': status,
+        'wet_file': wfn,
+        'hydro_file': hfn,
+        'seconds': round(time.time() - t0, 1),
+        'message': message,
+    }
+    if result_queue is not None:
+        result_queue.put((index, result))
+    return result
+
+
+class WeatherModelPrefetcher(object):
+    '''
+    Download the weather model files for upcoming dates in background threads
+    while earlier dates are being processed. At most depth dates are being
+    downloaded or waiting to be processed at any one time, which bounds both
+    the number of open connections and the disk space used by files that are
+    not needed yet.
+
+    Files are written to the same location that prepareWeatherModel looks in,
+    so a date whose download has finished skips its own download step. A
+    failed download is logged and the date tries again on its own when it is
+    processed.
+
+    epochs is an optional function returning the list of model times needed
+    for a date, e.g. the two epochs around it when interpolating in time.
+    '''
+    def __init__(self, weather_model, times, wmLoc, lats=None, lons=None, depth=2,
+                 epochs=None):
+        self._weather_model = weather_model
+        self._epochs = epochs
+        self._wmLoc = wmLoc
+        self._lats = lats
+        self._lons = lons
+        self._depth = max(depth, 1)
+        self._pending = list(times)
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=self._depth)
+        self._fill()
+
+    def _fill(self):
+        '''
+        Start downloads until depth dates are in flight or waiting
+        '''
+        while self._pending and len(self._futures) < self._depth:
+            t = self._pending.pop(0)
+            self._futures[t] = self._executor.submit(self._fetch, t)
+
+    def _fetch(self, t):
+        '''
+        Download the weather model for a single date. Each download uses its
+        own copy of the weather model object, since fetch stores per-date
+        state on the object.
+        '''
+        log.info('Prefetching weather model for %s', t)
+        f = None
+        for epoch in (self._epochs(t) if self._epochs is not None else [t]):
+            weather_model = copy.deepcopy(self._weather_model)
+            try:
+                f = fetchWeatherModel(weather_model, self._lats, self._lons, epoch, self._wmLoc)
+            except Exception:
+                log.exception('Unable to prefetch weather data for %s', epoch)
+                return None
+        return f
+
+    def wait(self, t):
+        '''
+        Block until the download for date t has finished, and start the next
+        download in line. Returns the weather model filename, or None if
+        nothing was fetched for this date.
+        '''
+        future = self._futures.pop(t, None)
+        if future is None:
+            # Not prefetched (yet); the date will download it itself
+            if t in self._pending:
+                self._pending.remove(t)
+            return None
+
+        f = future.result()
+        self._fill()
+        return f
+
+    def close(self):
+        '''
+        Cancel the downloads that have not started and wait for the rest
+        '''
+        self._pending = []
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_dates(run_fcn, times, wetNames, hydroNames, njobs=1, prefetcher=None):
+    '''
+    Call run_fcn(time, wetFilename, hydroFilename) for every date, running up
+    to njobs dates at the same time.
+
+    Each date is run in its own (non-daemonic) process so that it can still
+    use a multiprocessing pool internally, and so that a crash in one date
+    only affects that date. The processes are started from a fresh server
+    process rather than forked from this one, whose prefetch threads may be
+    holding locks in the middle of a download; run_fcn and its arguments
+    must therefore be picklable.
+
+    If a prefetcher is given, each date waits for its download to finish
+    before it starts, while the downloads for the next dates carry on in the
+    background.
+
+    Dates that are listed more than once are only run once. Returns a list
+    of dictionaries, one per date, describing the outcome.
+    '''
+    # The same date twice would write the same files, possibly at the same time
+    dates, seen = [], set()
+    for date in zip(times, wetNames, hydroNames):
+        if date in seen:
+            log.warning('Date %s is listed more than once; running it once', date[0])
+            continue
+        seen.add(date)
+        dates.append(date)
+
+    if njobs <= 1:
+        results = []
+        for t, wfn, hfn in dates:
+            if prefetcher is not None:
+                prefetcher.wait(t)
+            results.append(_run_date(run_fcn, t, wfn, hfn))
+        return results
+
+    pending = list(enumerate(dates))
+    running = {}
+    results = {}
+    ctx = mp.get_context('forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn')
+    result_queue = ctx.Queue()
+    log_level = logging.getLogger('RAiDER').getEffectiveLevel()
+
+    while pending or running:
+        while pending and len(running) < njobs:
+            key, (t, wfn, hfn) = pending.pop(0)
+            if prefetcher is not None:
+                prefetcher.wait(t)
+            p = ctx.Process(
+                target=_run_date, args=(run_fcn, t, wfn, hfn, result_queue, key, log_level)
+            )
+            p.start()
+            running[key] = (p, t, wfn, hfn)
+            log.info('Started date %s (%d running, %d waiting)', t, len(running), len(pending))
+
+        try:
+            key, result = result_queue.get(timeout=1)
+            results[key] = result
+        except queue.Empty:
+            pass
+
+        for key, (p, t, wfn, hfn) in list(running.items()):
+            if key in results:
+                p.join()
+                del running[key]
+            elif not p.is_alive():
+                # Drain anything that arrived in the meantime before
+                # deciding that the process died without reporting
+                try:
+                    while True:
+                        index, result = result_queue.get_nowait()
+                        results[index] = result
+                except queue.Empty:
+                    pass
+                if key not in results:
+                    log.error('Date %s exited with code %s', t, p.exitcode)
+                    results[key] = {
+                        'date': t.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'status': 'failed',
+                        'wet_file': wfn,
+                        'hydro_file': hfn,
+                        'seconds': np.nan,
+                        'message': 'process exited with code {}'.format(p.exitcode),
+                    }
+                p.join()
+                del running[key]
+
+    return [results[key] for key in range(len(dates))]
+
+
+def write_summary(results, filename):
+    '''
+    Write the outcome of each date to a CSV file and log a short summary
+    '''
+    fields = ['date', 'status', 'wet_file', 'hydro_file', 'seconds', 'message']
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+    failed = [r['date'] for r in results if r['status'] != 'success']
+    log.info(
+        '%d of %d dates succeeded; summary written to %s',
+        len(results) - len(failed), len(results), filename
+    )
+    if failed:
+        log.warning('Failed dates: %s', ', '.join(failed))
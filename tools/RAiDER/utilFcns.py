@@ -1,10 +1,11 @@
 """Geodesy-related utility functions."""
+import hashlib
 import importlib
 import logging
 import multiprocessing as mp
 import os
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import h5py
 import numpy as np
@@ -171,6 +172,20 @@ def round_date(date, precision):
     return round_up if up_diff < down_diff else round_down
 
 
+def get_bracketing_times(date, precision):
+    '''
+    Return the two model epochs (multiples of precision) on either side of
+    date, and the fraction of the way from the first to the second epoch
+    that date lies at. If date is itself an epoch, both epochs are date and
+    the fraction is 0.
+    '''
+    rem = (date - datetime.min) % precision
+    before = date - rem
+    if rem == timedelta(0):
+        return before, before, 0.
+    return before, before + precision, rem / precision
+
+
 def _least_nonzero(a):
     """Fill in a flat array with the first non-nan value in the last dimension.
 
@@ -265,12 +280,50 @@ def makeDelayFileNames(time, los, outformat, weather_model_name, out):
     return wet_file_name, hydro_file_name
 
 
-def make_weather_model_filename(name, time, ll_bounds):
+def make_weather_model_filename(name, time, ll_bounds=None):
+    if ll_bounds is None:
+        # processed over the full extent of the weather model
+        return '{}_{}_full.h5'.format(name, time.strftime("%Y-%m-%dT%H_%M_%S"))
     return '{}_{}_{}N_{}N_{}E_{}E.h5'.format(
         name, time.strftime("%Y-%m-%dT%H_%M_%S"), *ll_bounds
     )
 
 
+def make_geom_hash(lats, lons, hgts, los, zref):
+    '''
+    Return a hex digest uniquely identifying a set of query points, so that
+    cached geometry (look vectors, ray start points) can be safely re-used.
+    The digest covers the lat/lon/hgt values, zref and the line-of-sight
+    source (including the contents of any LOS or orbit file).
+    '''
+    h = hashlib.sha1()
+    for arr in (lats, lons, hgts):
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        h.update(str(arr.shape).encode('utf-8'))
+        h.update(arr.tobytes())
+    h.update('zref={}'.format(float(zref)).encode('utf-8'))
+
+    if los is Zenith or los is None:
+        h.update(b'los=Zenith')
+    else:
+        los_type, los_file = los
+        h.update('los={}'.format(los_type).encode('utf-8'))
+        for fname in (los_file, los_file + '.vrt'):
+            if os.path.exists(fname):
+                _update_hash_from_file(h, fname)
+
+    return h.hexdigest()
+
+
+def _update_hash_from_file(h, filename, blockSize=2**20):
+    '''
+    Update a hashlib object with the contents of a file, read in blocks
+    '''
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            h.update(block)
+
+
 def checkShapes(los, lats, lons, hts):
     '''
     Make sure that by the time the code reaches here, we have a
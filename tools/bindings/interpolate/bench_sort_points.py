@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the sort_points option of RAiDER.interpolate.
+
+Times interpolate (3D grids) and interpolate_columns (native levels) on a
+single thread with the query points in their given order and sorted by
+grid tile, for two orders of points: uniformly random, and samples along
+slanted rays, which is what the delay calculation produces. Prints the
+plain time divided by the sorted time, so values above 1 mean sorting
+pays off. Usage examples:
+
+    python bench_sort_points.py
+    python bench_sort_points.py --grid 1400 700 60 --points 1e6 4e6
+"""
+import argparse
+import time
+
+import numpy as np
+
+from RAiDER.interpolate import interpolate, interpolate_columns
+
+_RAY_SAMPLES = 200
+
+
+def make_grid(nx, ny, nz, rng):
+    '''
+    Grid axes, a random field on them and the heights of each column,
+    which vary a little around the regular levels
+    '''
+    grid = (np.arange(nx, dtype=float), np.arange(ny, dtype=float), np.linspace(0., 1., nz))
+    values = rng.random((nx, ny, nz))
+    heights = np.sort(grid[2] + 0.01 * rng.random((nx, ny, nz)), axis=-1)
+    return grid, values, heights
+
+
+def random_points(grid, npoints, rng):
+    return np.stack([rng.uniform(axis[0], axis[-1], npoints) for axis in grid], axis=-1)
+
+
+def ray_points(grid, npoints, rng):
+    '''
+    Samples along straight rays that climb from the bottom to the top of the
+    grid while drifting horizontally over a few dozen cells
+    '''
+    nrays = max(npoints // _RAY_SAMPLES, 1)
+    start = random_points(grid, nrays, rng)
+    start[:, 2] = grid[2][0]
+    azimuth = rng.uniform(0, 2 * np.pi, nrays)
+    drift = rng.uniform(5, 50, nrays)
+    s = np.linspace(0., 1., _RAY_SAMPLES)
+    x = start[:, 0, np.newaxis] + (drift * np.cos(azimuth))[:, np.newaxis] * s
+    y = start[:, 1, np.newaxis] + (drift * np.sin(azimuth))[:, np.newaxis] * s
+    z = np.broadcast_to(grid[2][0] + (grid[2][-1] - grid[2][0]) * s, x.shape)
+    return np.stack([x, y, z], axis=-1).reshape(-1, 3)
+
+
+def best_time(fun, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def speedup(fun, repeat):
+    '''
+    Plain time over sorted time of fun(sort_points), checking that both give
+    the same result
+    '''
+    plain, expected = best_time(lambda: fun(False), repeat)
+    sorted_time, result = best_time(lambda: fun(True), repeat)
+    if not np.array_equal(expected, result, equal_nan=True):
+        raise RuntimeError('sort_points changed the result')
+    return plain / sorted_time
+
+
+def run(shape, npoints, repeat, seed=0):
+    rng = np.random.default_rng(seed)
+    grid, values, heights = make_grid(*shape, rng)
+    row = []
+    for make_points in (random_points, ray_points):
+        points = make_points(grid, npoints, rng)
+        row.append(speedup(
+            lambda sort_points: interpolate(
+                grid, values, points, fill_value=np.nan, max_threads=1, sort_points=sort_points
+            ), repeat
+        ))
+        row.append(speedup(
+            lambda sort_points: interpolate_columns(
+                grid[:2], heights, values, points, fill_value=np.nan, max_threads=1,
+                sort_points=sort_points
+            ), repeat
+        ))
+    return row
+
+
+def create_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    p.add_argument(
+        '--grid', type=int, nargs=3, action='append', metavar=('NX', 'NY', 'NZ'),
+        help='Grid shape, may be given several times '
+             '(default: 100 100 50, 500 500 60 and 1400 700 60)')
+    p.add_argument(
+        '--points', type=float, nargs='+', default=[1e5, 1e6],
+        help='Numbers of query points (default: 1e5 1e6)')
+    p.add_argument(
+        '--repeat', type=int, default=3,
+        help='Runs of each case, of which the fastest counts (default: 3)')
+    return p
+
+
+def main():
+    args = create_parser().parse_args()
+    shapes = args.grid or [(100, 100, 50), (500, 500, 60), (1400, 700, 60)]
+
+    print('plain time / sorted time, single thread')
+    print('{:<14s} {:>8s} {:>10s} {:>15s} {:>8s} {:>13s}'.format(
+        'grid', 'points', 'random 3D', 'random columns', 'rays 3D', 'rays columns'))
+    for shape in shapes:
+        for npoints in args.points:
+            row = run(shape, int(npoints), args.repeat)
+            print('{:<14s} {:>8.0e} {:>9.2f}x {:>14.2f}x {:>7.2f}x {:>12.2f}x'.format(
+                'x'.join(str(n) for n in shape), npoints, *row))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,10 @@
 #include "stdio.h"
 #include "interpolate.h"
 
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <numeric>
 #include <optional>
 
 // data_zs must have length data_x_N * data_y_N
@@ -175,6 +179,123 @@ void interpolate_3d(
     }
 }
 
+// Interpolation in z within a single column of the grid, linear or, with
+// derivatives ds, cubic Hermite
+inline bool interpolate_column(
+    const double * zs,
+    const double * ws,
+    const double * ds,
+    size_t data_z_N,
+    double z,
+    std::optional<double> fill_value,
+    double * out
+) {
+    size_t hiz = bisect_left(zs, zs + data_z_N, z);
+    if (fill_value.has_value()) {
+        if (fill_out_of_bounds(hiz, 1, data_z_N - 1, *fill_value, out)) {
+            return false;
+        }
+    }
+    else {
+        hiz = clamp_bounds(hiz, 1, data_z_N - 1);
+    }
+    size_t loz = hiz - 1;
+
+    double h = zs[hiz] - zs[loz],
+           t = (z - zs[loz]) / h;
+    if (ds == nullptr) {
+        *out = ws[loz] + (ws[hiz] - ws[loz]) * t;
+        return true;
+    }
+
+    // https://en.wikipedia.org/wiki/Cubic_Hermite_spline
+    double t2 = t * t,
+           t3 = t2 * t;
+    *out = (2 * t3 - 3 * t2 + 1) * ws[loz]
+         + (t3 - 2 * t2 + t) * h * ds[loz]
+         + (-2 * t3 + 3 * t2) * ws[hiz]
+         + (t3 - t2) * h * ds[hiz];
+    return true;
+}
+
+void interpolate_3d_columns(
+    double * data_xs,
+    size_t data_x_N,
+    double * data_ys,
+    size_t data_y_N,
+    double * data_zs,
+    size_t data_z_N,
+    double * data_ws,
+    double * interpolation_points,
+    double * out,
+    size_t N,
+    std::optional<double> fill_value,
+    const double * data_ds,
+    bool shared_zs
+) {
+    size_t data_yz_N = data_y_N * data_z_N;
+    for (size_t i = 0; i < N; i++) {
+        double x = interpolation_points[i * 3];
+        double y = interpolation_points[i * 3 + 1];
+        double z = interpolation_points[i * 3 + 2];
+
+        // The horizontal cell is found from the grid spacing...
+        size_t hix = find_arithmetic(data_xs, data_x_N, x);
+        size_t hiy = find_arithmetic(data_ys, data_y_N, y);
+        if (fill_value.has_value()) {
+            if (fill_out_of_bounds(hix, 1, data_x_N - 1, *fill_value, &out[i])) {
+                continue;
+            }
+            if (fill_out_of_bounds(hiy, 1, data_y_N - 1, *fill_value, &out[i])) {
+                continue;
+            }
+        }
+        else {
+            hix = clamp_bounds(hix, 1, data_x_N - 1);
+            hiy = clamp_bounds(hiy, 1, data_y_N - 1);
+        }
+        size_t lox = hix - 1;
+        size_t loy = hiy - 1;
+
+        // ...and the height is bracketed separately in each of its four
+        // corner columns
+        double w00, w01, w10, w11;
+        size_t offset00 = lox * data_yz_N + loy * data_z_N,
+               offset01 = lox * data_yz_N + hiy * data_z_N,
+               offset10 = hix * data_yz_N + loy * data_z_N,
+               offset11 = hix * data_yz_N + hiy * data_z_N;
+        size_t zs_scale = shared_zs ? 0 : 1;
+        const double * ds00 = data_ds == nullptr ? nullptr : &data_ds[offset00],
+                     * ds01 = data_ds == nullptr ? nullptr : &data_ds[offset01],
+                     * ds10 = data_ds == nullptr ? nullptr : &data_ds[offset10],
+                     * ds11 = data_ds == nullptr ? nullptr : &data_ds[offset11];
+        if (!interpolate_column(&data_zs[offset00 * zs_scale], &data_ws[offset00], ds00, data_z_N, z, fill_value, &w00) ||
+            !interpolate_column(&data_zs[offset01 * zs_scale], &data_ws[offset01], ds01, data_z_N, z, fill_value, &w01) ||
+            !interpolate_column(&data_zs[offset10 * zs_scale], &data_ws[offset10], ds10, data_z_N, z, fill_value, &w10) ||
+            !interpolate_column(&data_zs[offset11 * zs_scale], &data_ws[offset11], ds11, data_z_N, z, fill_value, &w11)) {
+            out[i] = *fill_value;
+            continue;
+        }
+
+        double x0 = data_xs[lox],
+               y0 = data_ys[loy],
+               x1 = data_xs[hix],
+               y1 = data_ys[hiy];
+
+        double dx = x1 - x0,
+               dy = y1 - y0,
+               dist_x0 = x - x0,
+               dist_x1 = x1 - x,
+               dist_y0 = y - y0,
+               dist_y1 = y1 - y;
+
+        out[i] = (
+            dist_x1 * (w00 * dist_y1 + w01 * dist_y0) +
+            dist_x0 * (w10 * dist_y1 + w11 * dist_y0)
+        ) / (dx * dy);
+    }
+}
+
 void interpolate(
     const std::vector<slice<double>> &grid,
     const slice<double> &values,
@@ -257,11 +378,254 @@ NEXT_POINT: ;
     }
 }
 
+// Three point estimate of the derivative at the end of the data, see
+// scipy.interpolate.PchipInterpolator
+static double pchip_edge_slope(double h0, double h1, double m0, double m1) {
+    auto sign = [](double x) { return (x > 0) - (x < 0); };
+    double d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1);
+    if (sign(d) != sign(m0)) {
+        return 0;
+    }
+    if (sign(m0) != sign(m1) && std::abs(d) > 3 * std::abs(m0)) {
+        return 3 * m0;
+    }
+    return d;
+}
+
+void pchip_slopes(const double * xs, const double * ys, size_t N, double * ds) {
+    if (N < 2) {
+        std::fill(ds, ds + N, 0.);
+        return;
+    }
+    if (N == 2) {
+        ds[0] = ds[1] = (ys[1] - ys[0]) / (xs[1] - xs[0]);
+        return;
+    }
+
+    double h_prev = xs[1] - xs[0],
+           m_prev = (ys[1] - ys[0]) / h_prev;
+    double h0 = h_prev, m0 = m_prev;
+    for (size_t k = 1; k + 1 < N; k++) {
+        double h = xs[k + 1] - xs[k],
+               m = (ys[k + 1] - ys[k]) / h;
+        if (m_prev * m <= 0) {
+            ds[k] = 0;
+        } else {
+            // Weighted harmonic mean of the neighbouring secants
+            double w1 = 2 * h + h_prev,
+                   w2 = h + 2 * h_prev;
+            ds[k] = (w1 + w2) / (w1 / m_prev + w2 / m);
+        }
+        if (k == 1) {
+            ds[0] = pchip_edge_slope(h0, h, m0, m);
+        }
+        if (k + 2 == N) {
+            ds[N - 1] = pchip_edge_slope(h, h_prev, m, m_prev);
+        }
+        h_prev = h;
+        m_prev = m;
+    }
+}
+
+// Value of the grid at a single point, 0 outside of it
+static double evaluate(const grid_3d &grid, double * point) {
+    double value;
+    if (grid.columns) {
+        interpolate_3d_columns(
+            grid.xs, grid.x_N, grid.ys, grid.y_N, grid.zs, grid.z_N,
+            grid.ws, point, &value, 1, std::nan("")
+        );
+    } else {
+        interpolate_3d(
+            grid.xs, grid.x_N, grid.ys, grid.y_N, grid.zs, grid.z_N,
+            grid.ws, point, &value, 1, std::nan(""), false
+        );
+    }
+    return value == value ? value : 0;
+}
+
+// Append the t in (t_lo, t_hi) at which a + t * (b - a) crosses one of the N
+// increasing coordinates in axis
+static void add_crossings(
+    const double * axis,
+    size_t N,
+    double a,
+    double b,
+    double t_lo,
+    double t_hi,
+    std::vector<double> &ts
+) {
+    if (!(a != b)) {
+        // parallel to the grid lines, or NaN
+        return;
+    }
+    double lo = std::min(a + t_lo * (b - a), a + t_hi * (b - a)),
+           hi = std::max(a + t_lo * (b - a), a + t_hi * (b - a));
+    for (size_t i = bisect_left(axis, axis + N, lo); i < N && axis[i] < hi; i++) {
+        ts.push_back((axis[i] - a) / (b - a));
+    }
+}
+
+double integrate_segment(const grid_3d &grid, const double * p0, const double * p1) {
+    thread_local std::vector<double> ts;
+    ts.assign({0., 1.});
+    add_crossings(grid.xs, grid.x_N, p0[0], p1[0], 0, 1, ts);
+    add_crossings(grid.ys, grid.y_N, p0[1], p1[1], 0, 1, ts);
+    if (!grid.columns) {
+        add_crossings(grid.zs, grid.z_N, p0[2], p1[2], 0, 1, ts);
+    } else {
+        // The levels of the four columns around each horizontal piece
+        std::sort(ts.begin(), ts.end());
+        size_t num_horizontal = ts.size();
+        for (size_t k = 0; k + 1 < num_horizontal; k++) {
+            double t_mid = (ts[k] + ts[k + 1]) / 2;
+            size_t hix = find_arithmetic(grid.xs, grid.x_N, p0[0] + t_mid * (p1[0] - p0[0])),
+                   hiy = find_arithmetic(grid.ys, grid.y_N, p0[1] + t_mid * (p1[1] - p0[1]));
+            if (hix < 1 || hix > grid.x_N - 1 || hiy < 1 || hiy > grid.y_N - 1) {
+                continue;
+            }
+            for (size_t ix = hix - 1; ix <= hix; ix++) {
+                for (size_t iy = hiy - 1; iy <= hiy; iy++) {
+                    add_crossings(
+                        &grid.zs[(ix * grid.y_N + iy) * grid.z_N], grid.z_N,
+                        p0[2], p1[2], ts[k], ts[k + 1], ts
+                    );
+                }
+            }
+        }
+    }
+    std::sort(ts.begin(), ts.end());
+
+    double point[3];
+    auto f = [&](double t) {
+        for (size_t dim = 0; dim < 3; dim++) {
+            point[dim] = p0[dim] + t * (p1[dim] - p0[dim]);
+        }
+        return evaluate(grid, point);
+    };
+
+    // Two point Gauss-Legendre is exact for cubics and, unlike Simpson's
+    // rule, never evaluates on a piece boundary, where the field may jump
+    // to the edge of the grid.
+    const double offset = 0.5 / std::sqrt(3.);
+    double total = 0;
+    for (size_t k = 0; k + 1 < ts.size(); k++) {
+        double t_lo = ts[k],
+               t_hi = ts[k + 1];
+        if (!(t_hi > t_lo)) {
+            continue;
+        }
+        double width = t_hi - t_lo,
+               t_mid = (t_lo + t_hi) / 2;
+        total += width / 2 * (f(t_mid - offset * width) + f(t_mid + offset * width));
+    }
+    return total;
+}
+
+void integrate_rays(
+    const grid_3d &grid,
+    const double * const * coords,
+    size_t num_rays,
+    size_t num_samples,
+    double step,
+    double * out
+) {
+    for (size_t ray = 0; ray < num_rays; ray++) {
+        double total = 0;
+        size_t offset = ray * num_samples;
+        for (size_t k = 0; k + 1 < num_samples; k++) {
+            double p0[3], p1[3];
+            for (size_t dim = 0; dim < 3; dim++) {
+                p0[dim] = coords[dim][offset + k];
+                p1[dim] = coords[dim][offset + k + 1];
+            }
+            total += integrate_segment(grid, p0, p1);
+        }
+        out[ray] = total * step;
+    }
+}
+
+std::vector<size_t> spatial_order(
+    const std::vector<slice<double>> &grid,
+    const double * points,
+    size_t point_dims,
+    size_t N
+) {
+    size_t dimensions = grid.size();
+    assert(dimensions <= point_dims);
+
+    // Number of bits needed to number the tiles along each axis
+    std::vector<size_t> bits(dimensions);
+    size_t max_bits = 0, total_bits = 0;
+    for (size_t dim = 0; dim < dimensions; dim++) {
+        size_t num_tiles = grid[dim].size / SORT_TILE_SIZE + 1;
+        while (((size_t) 1 << bits[dim]) < num_tiles) {
+            bits[dim]++;
+        }
+        max_bits = std::max(max_bits, bits[dim]);
+        total_bits += bits[dim];
+    }
+    assert(total_bits < 64);
+
+    // Contribution of each tile index along each axis to the Morton key, i.e.
+    // the bits of the index spread out so that those of the different axes
+    // interleave
+    std::vector<std::vector<uint64_t>> spread(dimensions);
+    size_t position = 0;
+    for (size_t bit = 0; bit < max_bits; bit++) {
+        for (size_t dim = 0; dim < dimensions; dim++) {
+            if (bit >= bits[dim]) {
+                continue;
+            }
+            std::vector<uint64_t> &table = spread[dim];
+            table.resize(grid[dim].size / SORT_TILE_SIZE + 1);
+            for (size_t tile = 0; tile < table.size(); tile++) {
+                table[tile] |= (uint64_t) ((tile >> bit) & 1) << position;
+            }
+            position++;
+        }
+    }
+
+    std::vector<uint64_t> keys(N);
+    for (size_t i = 0; i < N; i++) {
+        uint64_t key = 0;
+        for (size_t dim = 0; dim < dimensions; dim++) {
+            if (bits[dim] == 0) {
+                continue;
+            }
+            size_t cell = find_arithmetic(
+                grid[dim].ptr, grid[dim].size, points[i * point_dims + dim]
+            );
+            key |= spread[dim][cell / SORT_TILE_SIZE];
+        }
+        keys[i] = key;
+    }
+
+    std::vector<size_t> order(N);
+    if (total_bits <= 20) {
+        // Counting sort over the tiles
+        std::vector<size_t> starts(((size_t) 1 << total_bits) + 1, 0);
+        for (size_t i = 0; i < N; i++) {
+            starts[keys[i] + 1]++;
+        }
+        std::partial_sum(starts.begin(), starts.end(), starts.begin());
+        for (size_t i = 0; i < N; i++) {
+            order[starts[keys[i]]++] = i;
+        }
+    } else {
+        std::iota(order.begin(), order.end(), 0);
+        std::stable_sort(order.begin(), order.end(), [&](size_t a, size_t b) {
+            return keys[a] < keys[b];
+        });
+    }
+    return order;
+}
+
 void interpolate_1d_along_axis(
-    const py::buffer_info grid,
-    const py::buffer_info values,
-    const py::buffer_info interp_points,
-    py::buffer_info out,
+    const py::buffer_info &grid,
+    const py::buffer_info &values,
+    const py::buffer_info &interp_points,
+    const py::buffer_info &out,
     size_t axis,
     std::optional<double> fill_value,
     bool assume_sorted
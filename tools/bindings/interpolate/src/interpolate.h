@@ -11,6 +11,7 @@
 
 #include <iterator>
 #include <optional>
+#include <vector>
 
 #include "sys/types.h"
 #include "assert.h"
@@ -55,6 +56,33 @@ inline size_t find_left(RAIter begin, RAIter end, double x) {
     return bisect_left(begin + left, end, x) + left;
 }
 
+// Like bisect_left for an increasing axis, but starts from the index computed
+// from the mean grid spacing, so that the search is O(1) for evenly spaced
+// axes and only walks a few cells for nearly even ones.
+inline size_t find_arithmetic(const double * axis, size_t N, double x) {
+    if (!(x == x) || N < 2) {
+        // NaN is never inside the grid
+        return N;
+    }
+    double guess = (x - axis[0]) / (axis[N - 1] - axis[0]) * (N - 1);
+    size_t hi;
+    if (guess < 0) {
+        hi = 0;
+    } else if (guess >= N) {
+        hi = N;
+    } else {
+        hi = (size_t) guess + 1;
+    }
+
+    while (hi > 0 && x < axis[hi - 1]) {
+        hi--;
+    }
+    while (hi < N && !(x < axis[hi])) {
+        hi++;
+    }
+    return hi;
+}
+
 template<typename T>
 inline bool fill_out_of_bounds(size_t x, size_t lo, size_t hi, T fill_value, T * out) {
     if (x < lo || x > hi) {
@@ -145,6 +173,70 @@ void interpolate_3d(
     bool assume_sorted
 );
 
+// Rectilinear horizontal grid where every column has its own height profile.
+// data_zs and data_ws have shape (data_x_N, data_y_N, data_z_N) and the
+// heights must increase along each column. With shared_zs, data_zs is a
+// single column of heights used for all of them instead.
+//
+// If data_ds is given it holds the derivatives of data_ws along z (see
+// pchip_slopes), and each column is interpolated with a cubic Hermite spline
+// instead of linearly.
+void interpolate_3d_columns(
+    double * data_xs,
+    size_t data_x_N,
+    double * data_ys,
+    size_t data_y_N,
+    double * data_zs,
+    size_t data_z_N,
+    double * data_ws,
+    double * interpolation_points,
+    double * out,
+    size_t N,
+    std::optional<double> fill_value,
+    const double * data_ds = nullptr,
+    bool shared_zs = false
+);
+
+// A 3D grid for integrate_segment and integrate_rays. If columns is set, zs
+// holds the height of every node, shaped like ws, as in
+// interpolate_3d_columns; otherwise it is a single axis of data_z_N heights.
+struct grid_3d {
+    double * xs;
+    size_t x_N;
+    double * ys;
+    size_t y_N;
+    double * zs;
+    size_t z_N;
+    double * ws;
+    bool columns;
+};
+
+// Exact integral over t in [0, 1] of the linearly interpolated field along
+// the straight segment from p0 to p1, given in grid coordinates. Between
+// the crossings of grid lines (for a column grid, of the levels of the
+// surrounding columns) the field is a cubic in t, which Simpson's rule
+// integrates exactly. Points outside of the grid contribute nothing.
+double integrate_segment(const grid_3d &grid, const double * p0, const double * p1);
+
+// Integral of the field along num_rays paths of num_samples points each,
+// consecutive points being 'step' apart. coords holds one array per
+// coordinate, each of shape (num_rays, num_samples). The path between two
+// points is taken as straight in grid coordinates.
+void integrate_rays(
+    const grid_3d &grid,
+    const double * const * coords,
+    size_t num_rays,
+    size_t num_samples,
+    double step,
+    double * out
+);
+
+// Derivatives of the piecewise cubic Hermite interpolating polynomial (PCHIP)
+// through the N points (xs, ys), chosen as by Fritsch and Carlson so that the
+// interpolant is monotone wherever the data is and never overshoots, e.g. at
+// a temperature inversion. Same as scipy.interpolate.PchipInterpolator.
+void pchip_slopes(const double * xs, const double * ys, size_t N, double * ds);
+
 template <typename T>
 struct slice {
     size_t size;
@@ -161,6 +253,22 @@ void interpolate(
     bool assume_sorted
 );
 
+// Number of grid cells along each axis that make up one tile in
+// spatial_order
+const size_t SORT_TILE_SIZE = 8;
+
+// Order in which to visit the N interpolation points so that consecutive
+// points fall in nearby grid cells. The points are bucketed into tiles of
+// SORT_TILE_SIZE cells along each axis of 'grid' and the tiles are visited
+// along a Morton (Z-order) curve. Each point has point_dims coordinates of
+// which only the first grid.size() are used.
+std::vector<size_t> spatial_order(
+    const std::vector<slice<double>> &grid,
+    const double * points,
+    size_t point_dims,
+    size_t N
+);
+
 // Helper for handling the striding required to iterate along a given axis
 template<typename T>
 class axis_iterator {
@@ -259,10 +367,10 @@ public:
 };
 
 void interpolate_1d_along_axis(
-    const py::buffer_info grid,
-    const py::buffer_info values,
-    const py::buffer_info interp_points,
-    py::buffer_info out,
+    const py::buffer_info &grid,
+    const py::buffer_info &values,
+    const py::buffer_info &interp_points,
+    const py::buffer_info &out,
     size_t axis,
     std::optional<double> fill_value,
     bool assume_sorted
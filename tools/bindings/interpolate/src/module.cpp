@@ -11,29 +11,259 @@
 #include <pybind11/stl.h>
 
 #include <algorithm>
-#include <future>
 #include <sstream>
 #include <optional>
 
 #include "interpolate.h"
+#include "thread_pool.h"
 
 
 namespace py = pybind11;
 
+// Number of interpolation points handed to a thread at a time
+const size_t INTERP_BLOCK_SIZE = 1 << 14;
+
+// Non-owning view of the elements [begin, end) of 'info' along 'dim'
+static py::buffer_info buffer_view(
+    const py::buffer_info &info,
+    size_t dim,
+    size_t begin,
+    size_t end
+) {
+    std::vector<ssize_t> shape(info.shape);
+    shape[dim] = end - begin;
+    return py::buffer_info(
+        (unsigned char *) info.ptr + begin * info.strides[dim],
+        info.itemsize,
+        info.format,
+        info.ndim,
+        shape,
+        std::vector<ssize_t>(info.strides)
+    );
+}
+
+// Interpolation points, given either interleaved as one (N, dims) array or as
+// one array per coordinate with any shape and strides.
+namespace {
+struct interp_points_input {
+    size_t dims;
+    size_t size;
+    // Shape of the interpolated values
+    std::vector<ssize_t> shape;
+    // The interleaved points, or nullptr if they come one array per coordinate
+    double * interleaved = nullptr;
+    std::vector<py::buffer_info> coords;
+    // Keeps any converted arrays alive
+    std::vector<py::array> arrays;
+
+    // Copy the coordinates of the points [begin, end) into dest, interleaved
+    void gather(size_t begin, size_t end, double * dest) const {
+        thread_local std::vector<ssize_t> index;
+        for (size_t dim = 0; dim < dims; dim++) {
+            const py::buffer_info &info = coords[dim];
+            size_t ndim = info.ndim;
+
+            // Arrays whose elements are evenly spaced, e.g. contiguous ones,
+            // don't need the multi-dimensional index
+            ssize_t flat_stride = ndim == 0 ? 0 : info.strides[ndim - 1];
+            bool flat = true;
+            for (size_t k = 0; k + 1 < ndim; k++) {
+                flat = flat && info.strides[k] == info.strides[k + 1] * info.shape[k + 1];
+            }
+            if (flat) {
+                const unsigned char * ptr = (const unsigned char *) info.ptr + begin * flat_stride;
+                for (size_t i = begin; i < end; i++, ptr += flat_stride) {
+                    dest[(i - begin) * dims + dim] = *(const double *) ptr;
+                }
+                continue;
+            }
+
+            // Start at the multi-dimensional index of point 'begin'
+            index.assign(ndim, 0);
+            ssize_t offset = 0;
+            size_t rest = begin;
+            for (size_t k = ndim; k-- > 0;) {
+                index[k] = rest % info.shape[k];
+                rest /= info.shape[k];
+                offset += index[k] * info.strides[k];
+            }
+
+            const unsigned char * ptr = (const unsigned char *) info.ptr;
+            for (size_t i = begin; i < end; i++) {
+                dest[(i - begin) * dims + dim] = *(const double *) (ptr + offset);
+                for (size_t k = ndim; k-- > 0;) {
+                    if (++index[k] < info.shape[k]) {
+                        offset += info.strides[k];
+                        break;
+                    }
+                    offset -= (info.shape[k] - 1) * info.strides[k];
+                    index[k] = 0;
+                }
+            }
+        }
+    }
+};
+}
+
+static interp_points_input parse_interp_points(py::object interp_points, size_t dims) {
+    interp_points_input input;
+    input.dims = dims;
+
+    if (py::isinstance<py::tuple>(interp_points)) {
+        py::tuple coords = interp_points.cast<py::tuple>();
+        if (coords.size() != dims) {
+            std::stringstream ss;
+            ss << "Dimension mismatch! Grid is " << dims
+               << "D but interpolation points are " << coords.size() << "D!";
+            throw py::type_error(ss.str());
+        }
+        for (auto item : coords) {
+            input.arrays.push_back(py::cast<py::array_t<double>>(item));
+            input.coords.push_back(input.arrays.back().request());
+            if (input.coords.back().shape != input.coords.front().shape) {
+                throw py::type_error("All coordinate arrays must have the same shape!");
+            }
+        }
+        input.shape = input.coords.front().shape;
+        input.size = input.arrays.front().size();
+        return input;
+    }
+
+    auto array = py::cast<py::array_t<double, py::array::c_style | py::array::forcecast>>(interp_points);
+    if (array.ndim() == 0) {
+        throw py::type_error("Only arrays are supported, not scalar values!");
+    }
+    if (array.ndim() != 2) {
+        std::stringstream ss;
+        ss << "'interp_points' should have shape (N, " << dims
+           << ") or be a tuple of " << dims << " coordinate arrays.";
+        throw py::type_error(ss.str());
+    }
+    if ((size_t) array.shape(1) != dims) {
+        std::stringstream ss;
+        ss << "Dimension mismatch! Grid is " << dims
+           << "D but interpolation points are " << array.shape(1) << "D!";
+        throw py::type_error(ss.str());
+    }
+    input.size = array.shape(0);
+    input.shape = {array.shape(0)};
+    input.interleaved = array.mutable_data();
+    input.arrays.push_back(array);
+    return input;
+}
+
+static void check_same_shape(
+    const py::array_t<double, py::array::c_style> &array,
+    const py::array_t<double, py::array::c_style> &values,
+    const char * name
+) {
+    bool same = array.ndim() == values.ndim();
+    for (ssize_t i = 0; same && i < values.ndim(); i++) {
+        same = array.shape(i) == values.shape(i);
+    }
+    if (!same) {
+        std::stringstream ss;
+        ss << "'" << name << "' and 'values' must have the same shape!";
+        throw py::type_error(ss.str());
+    }
+}
+
+// The array to write the interpolated values to: 'out' if it was passed, or a
+// new array of the given shape.
+static py::array_t<double> make_output(
+    std::optional<py::array> out,
+    const std::vector<ssize_t> &shape,
+    size_t size
+) {
+    if (!out.has_value()) {
+        return py::array_t<double>(shape);
+    }
+    if (!py::isinstance<py::array_t<double, py::array::c_style>>(*out)
+            || !out->writeable()
+            || (size_t) out->size() != size) {
+        std::stringstream ss;
+        ss << "'out' must be a writeable, C contiguous float64 array with "
+           << size << " elements!";
+        throw py::type_error(ss.str());
+    }
+    return py::reinterpret_borrow<py::array_t<double>>(*out);
+}
+
+// Interpolate the points by calling interpolate_block(points, out, n) on
+// blocks of them, interleaved, on the thread pool. With sort_points the
+// points are visited in spatial_order over 'grid' instead and the results
+// scattered back to their original positions.
+template<typename F>
+static void interpolate_blocks(
+    const std::vector<slice<double>> &grid,
+    const interp_points_input &points,
+    double * out,
+    bool sort_points,
+    size_t max_threads,
+    F interpolate_block
+) {
+    size_t N = points.size, point_dims = points.dims;
+    double * interleaved = points.interleaved;
+
+    if (!sort_points) {
+        parallel_for(N, INTERP_BLOCK_SIZE, max_threads, [&](size_t begin, size_t end) {
+            if (interleaved != nullptr) {
+                interpolate_block(&interleaved[begin * point_dims], &out[begin], end - begin);
+                return;
+            }
+            thread_local std::vector<double> buffer;
+            buffer.resize((end - begin) * point_dims);
+            points.gather(begin, end, buffer.data());
+            interpolate_block(buffer.data(), &out[begin], end - begin);
+        });
+        return;
+    }
+
+    std::vector<double> interleaved_storage;
+    if (interleaved == nullptr) {
+        interleaved_storage.resize(N * point_dims);
+        parallel_for(N, INTERP_BLOCK_SIZE, max_threads, [&](size_t begin, size_t end) {
+            points.gather(begin, end, &interleaved_storage[begin * point_dims]);
+        });
+        interleaved = interleaved_storage.data();
+    }
+
+    std::vector<size_t> order = spatial_order(grid, interleaved, point_dims, N);
+    std::vector<double> sorted_points(N * point_dims);
+    std::vector<double> sorted_out(N);
+
+    parallel_for(N, INTERP_BLOCK_SIZE, max_threads, [&](size_t begin, size_t end) {
+        for (size_t i = begin; i < end; i++) {
+            std::copy_n(
+                &interleaved[order[i] * point_dims],
+                point_dims,
+                &sorted_points[i * point_dims]
+            );
+        }
+        interpolate_block(&sorted_points[begin * point_dims], &sorted_out[begin], end - begin);
+        for (size_t i = begin; i < end; i++) {
+            out[order[i]] = sorted_out[i];
+        }
+    });
+}
+
 PYBIND11_MODULE(interpolate, m) {
     m.doc() = "Fast linear interpolator over a regular grid";
 
     m.def("interpolate", [](
             std::vector<py::array_t<double, py::array::c_style>> points,
             py::array_t<double, py::array::c_style> values,
-            py::array_t<double, py::array::c_style> interp_points,
+            py::object interp_points,
             std::optional<double> fill_value,
             bool assume_sorted,
-            size_t max_threads
+            size_t max_threads,
+            bool sort_points,
+            std::optional<py::array> out,
+            std::optional<py::array_t<double, py::array::c_style>> slopes
         ) {
             size_t num_dims = points.size();
 
-            if (values.ndim() == 0 || interp_points.ndim() == 0) {
+            if (values.ndim() == 0) {
                 throw py::type_error("Only arrays are supported, not scalar values!");
             }
 
@@ -50,224 +280,132 @@ PYBIND11_MODULE(interpolate, m) {
                 throw py::type_error(ss.str());
             }
 
-            if (interp_points.ndim() != 2) {
-                throw py::type_error("'interp_points' should have shape (N, ndim).");
+            double * slopes_ptr = nullptr;
+            if (slopes.has_value()) {
+                if (num_dims != 3) {
+                    throw py::type_error("'slopes' are only supported on 3D grids!");
+                }
+                check_same_shape(*slopes, values, "slopes");
+                slopes_ptr = slopes->mutable_data();
             }
 
-            size_t interp_dims = interp_points.shape()[1];
-            if (num_dims != interp_dims) {
-                std::stringstream ss;
-                ss << "Dimension mismatch! Grid is " << num_dims
-                   << "D but interpolation points are " << interp_dims << "D!";
-                throw py::type_error(ss.str());
-            }
-            size_t num_elements = interp_points.shape()[0];
-            double * out = new double[num_elements];
+            interp_points_input input = parse_interp_points(interp_points, num_dims);
+            py::array_t<double> result = make_output(out, input.shape, input.size);
+            double * out_ptr = result.mutable_data();
 
             auto values_info = values.request();
-            auto interp_points_info = interp_points.request();
-
-
-            // Reasonable thread defaults based on profiling. It seems that spawning
-            // threads in powers of 2 yields optimal performance.
-            size_t desired_threads;
-            if (num_elements < 10000) {
-                desired_threads = 1;
-            } else if (num_elements < 4000000) {
-                desired_threads = 2;
-            } else if (num_elements < 160000000){
-                desired_threads = 4;
-            } else {
-                desired_threads = 8;
-            }
-            size_t num_threads = std::min(desired_threads, max_threads);
-            if (num_threads == 0) {
-                num_threads = 1;
-            }
-            size_t stride = (num_elements / num_threads);
-            if (stride * num_threads < num_elements) {
-                stride += 1;
+            std::vector<py::buffer_info> points_info;
+            std::vector<slice<double>> grid;
+            for (auto axis : points) {
+                points_info.push_back(axis.request());
+                grid.push_back(slice<double> {
+                    (size_t) points_info.back().shape[0],
+                    (double *) points_info.back().ptr
+                });
             }
 
-            double * values_ptr = (double *) values_info.ptr,
-                   * interp_points_ptr = (double *) interp_points_info.ptr;
+            double * values_ptr = (double *) values_info.ptr;
 
-            if (num_dims == 1) {
-                auto xs_info = points[0].request();
+            {
+                // Only raw pointers are used from here on
+                py::gil_scoped_release release;
 
-                double * xs_ptr = (double *) xs_info.ptr;
-
-                if (num_threads == 1) {
-                    interpolate_1d<double>(
-                        xs_ptr,
-                        points[0].size(),
-                        values_ptr,
-                        interp_points_ptr,
-                        out,
-                        num_elements,
-                        fill_value,
-                        assume_sorted
+                if (num_dims == 1) {
+                    interpolate_blocks(
+                        grid, input, out_ptr, sort_points, max_threads,
+                        [&](double * block_points, double * block_out, size_t n) {
+                            interpolate_1d<double>(
+                                grid[0].ptr,
+                                grid[0].size,
+                                values_ptr,
+                                block_points,
+                                block_out,
+                                n,
+                                fill_value,
+                                assume_sorted
+                            );
+                        }
                     );
-                } else {
-                    std::vector<std::future<void>> tasks;
-
-                    for (size_t i = 0; i < num_threads; i++) {
-                        size_t index = i * stride;
-                        tasks.push_back(
-                            std::async(
-                                &interpolate_1d<double, double *>,
-                                xs_ptr,
-                                xs_info.shape[0],
+                } else if (num_dims == 2) {
+                    interpolate_blocks(
+                        grid, input, out_ptr, sort_points, max_threads,
+                        [&](double * block_points, double * block_out, size_t n) {
+                            interpolate_2d(
+                                grid[0].ptr,
+                                grid[0].size,
+                                grid[1].ptr,
+                                grid[1].size,
                                 values_ptr,
-                                &interp_points_ptr[index],
-                                &out[index],
-                                index + stride < num_elements ? stride : num_elements - index,
+                                block_points,
+                                block_out,
+                                n,
                                 fill_value,
                                 assume_sorted
-                            )
-                        );
-                    }
-                    for (auto &future : tasks) {
-                        std::move(future);
-                    }
-                }
-            } else if (num_dims == 2) {
-                auto xs_info = points[0].request();
-                auto ys_info = points[1].request();
-
-                double * xs_ptr = (double *) xs_info.ptr,
-                       * ys_ptr = (double *) ys_info.ptr;
-
-                if (num_threads == 1) {
-                    interpolate_2d(
-                        xs_ptr,
-                        points[0].size(),
-                        ys_ptr,
-                        points[1].size(),
-                        values_ptr,
-                        interp_points_ptr,
-                        out,
-                        num_elements,
-                        fill_value,
-                        assume_sorted
+                            );
+                        }
                     );
-                } else {
-                    std::vector<std::future<void>> tasks;
-
-                    for (size_t i = 0; i < num_threads; i++) {
-                        size_t index = i * stride;
-                        tasks.push_back(
-                            std::async(
-                                &interpolate_2d,
-                                xs_ptr,
-                                points[0].size(),
-                                ys_ptr,
-                                points[1].size(),
+                } else if (num_dims == 3 && slopes_ptr != nullptr) {
+                    interpolate_blocks(
+                        grid, input, out_ptr, sort_points, max_threads,
+                        [&](double * block_points, double * block_out, size_t n) {
+                            interpolate_3d_columns(
+                                grid[0].ptr, grid[0].size,
+                                grid[1].ptr, grid[1].size,
+                                grid[2].ptr, grid[2].size,
+                                values_ptr, block_points, block_out, n,
+                                fill_value, slopes_ptr, true
+                            );
+                        }
+                    );
+                } else if (num_dims == 3) {
+                    interpolate_blocks(
+                        grid, input, out_ptr, sort_points, max_threads,
+                        [&](double * block_points, double * block_out, size_t n) {
+                            interpolate_3d(
+                                grid[0].ptr,
+                                grid[0].size,
+                                grid[1].ptr,
+                                grid[1].size,
+                                grid[2].ptr,
+                                grid[2].size,
                                 values_ptr,
-                                &interp_points_ptr[index * num_dims],
-                                &out[index],
-                                index + stride < num_elements ? stride : num_elements - index,
+                                block_points,
+                                block_out,
+                                n,
                                 fill_value,
                                 assume_sorted
-                            )
-                        );
-                    }
-                    for (auto &future : tasks) {
-                        std::move(future);
-                    }
-                }
-            } else if (num_dims == 3) {
-                auto xs_info = points[0].request();
-                auto ys_info = points[1].request();
-                auto zs_info = points[2].request();
-
-                double * xs_ptr = (double *) xs_info.ptr,
-                       * ys_ptr = (double *) ys_info.ptr,
-                       * zs_ptr = (double *) zs_info.ptr;
-
-                if (num_threads == 1) {
-                    interpolate_3d(
-                        xs_ptr,
-                        points[0].size(),
-                        ys_ptr,
-                        points[1].size(),
-                        zs_ptr,
-                        points[2].size(),
-                        values_ptr,
-                        interp_points_ptr,
-                        out,
-                        num_elements,
-                        fill_value,
-                        assume_sorted
+                            );
+                        }
                     );
                 } else {
-                    std::vector<std::future<void>> tasks;
-
-                    for (size_t i = 0; i < num_threads; i++) {
-                        size_t index = i * stride;
-                        tasks.push_back(
-                            std::async(
-                                &interpolate_3d,
-                                xs_ptr,
-                                points[0].size(),
-                                ys_ptr,
-                                points[1].size(),
-                                zs_ptr,
-                                points[2].size(),
-                                values_ptr,
-                                &interp_points_ptr[index * num_dims],
-                                &out[index],
-                                index + stride < num_elements ? stride : num_elements - index,
+                    slice<double> values_slice = {
+                        (size_t) values_info.size,
+                        values_ptr
+                    };
+
+                    interpolate_blocks(
+                        grid, input, out_ptr, sort_points, max_threads,
+                        [&](double * block_points, double * block_out, size_t n) {
+                            slice<double> interpolation_points_slice = {
+                                n * num_dims,
+                                block_points
+                            };
+                            slice<double> out_slice = {n, block_out};
+
+                            interpolate(
+                                grid,
+                                values_slice,
+                                interpolation_points_slice,
+                                out_slice,
                                 fill_value,
                                 assume_sorted
-                            )
-                        );
-                    }
-                    for (auto &future : tasks) {
-                        std::move(future);
-                    }
-                }
-            } else {
-                std::vector<slice<double>> grid;
-                for (auto axis : points) {
-                    auto info = axis.request();
-                    grid.push_back(slice<double> {
-                        (size_t) info.shape[0],
-                        (double *) info.ptr
-                    });
+                            );
+                        }
+                    );
                 }
-                slice<double> values_slice = {
-                    values_info.size / sizeof(double),
-                    values_ptr
-                };
-                slice<double> interpolation_points_slice = {
-                    values_info.size / sizeof(double),
-                    interp_points_ptr
-                };
-                slice<double> out_slice = {num_elements, out};
-
-                interpolate(
-                    grid,
-                    values_slice,
-                    interpolation_points_slice,
-                    out_slice,
-                    fill_value,
-                    assume_sorted
-                );
             }
 
-
-            py::capsule free_when_done(out, [](void *f) {
-                double *out = reinterpret_cast<double *>(f);
-                delete[] out;
-            });
-
-            return py::array_t<double>(
-                {num_elements}, // Shape
-                {sizeof(double)}, // Strides
-                out, // the data pointer
-                free_when_done
-            ); // numpy array references this parent
+            return result;
         },
         R"pbdoc(
             Linear interpolator in any dimension. Arguments are similar to
@@ -276,21 +414,339 @@ PYBIND11_MODULE(interpolate, m) {
             :param points: Tuple of N axis coordinates specifying the grid.
             :param values: Nd array containing the grid point values.
             :param interp_points: List of points to interpolate, should have
-                dimension (x, N). If this list is guaranteed to be sorted make sure
-                to use the `assume_sorted` option.
+                dimension (x, N), or a tuple of N coordinate arrays of the same
+                shape, which are read in place whatever their strides. If this
+                list is guaranteed to be sorted make sure to use the
+                `assume_sorted` option.
             :param fill_value: The value to return for interpolation points
                   outside of the grid range.
             :param assume_sorted: Enable optimization when the list of interpolation
                 points is sorted.
             :param max_threads: Limit the number of threads to a certain amount.
-                Note: The number of threads will always be one of {1, 2, 4, 8}
+                0 uses one thread per core.
+            :param sort_points: Interpolate the points grouped by grid tile,
+                visiting the tiles along a Morton curve, and scatter the
+                results back. This pays off for large numbers of points in
+                no particular spatial order.
+            :param out: Optional C contiguous float64 array with one element per
+                point to write the result to.
+            :param slopes: Derivatives of 'values' along the third axis from
+                `pchip_slopes`. If given, 3D grids are interpolated with a
+                monotone cubic spline along that axis (linearly along the
+                others) and `assume_sorted` is ignored.
+            :return: The interpolated values, shaped like the coordinate arrays
+                if a tuple of them was given.
         )pbdoc",
         py::arg("points"),
         py::arg("values"),
         py::arg("interp_points"),
         py::arg("fill_value") = std::nullopt,
         py::arg("assume_sorted") = false,
-        py::arg("max_threads") = 8
+        py::arg("max_threads") = 0,
+        py::arg("sort_points") = false,
+        py::arg("out") = std::nullopt,
+        py::arg("slopes") = std::nullopt
+    );
+
+    m.def("interpolate_columns", [](
+            std::vector<py::array_t<double, py::array::c_style>> points,
+            py::array_t<double, py::array::c_style> heights,
+            py::array_t<double, py::array::c_style> values,
+            py::object interp_points,
+            std::optional<double> fill_value,
+            size_t max_threads,
+            bool sort_points,
+            std::optional<py::array> out,
+            std::optional<py::array_t<double, py::array::c_style>> slopes
+        ) {
+            if (points.size() != 2) {
+                throw py::type_error("'points' must be a list of the two horizontal axes!");
+            }
+            for (auto arr : points) {
+                if (arr.ndim() != 1) {
+                    throw py::type_error("'points' must be a list of 1D arrays!");
+                }
+            }
+            if (heights.ndim() != 3 || values.ndim() != 3) {
+                throw py::type_error("'heights' and 'values' must be 3D arrays!");
+            }
+            for (size_t i = 0; i < 3; i++) {
+                if (heights.shape(i) != values.shape(i)) {
+                    throw py::type_error("'heights' and 'values' must have the same shape!");
+                }
+            }
+            if (heights.shape(0) != points[0].size() || heights.shape(1) != points[1].size()) {
+                std::stringstream ss;
+                ss << "Dimension mismatch! Grid is " << points[0].size() << "x"
+                   << points[1].size() << " but heights are " << heights.shape(0)
+                   << "x" << heights.shape(1) << "!";
+                throw py::type_error(ss.str());
+            }
+            double * slopes_ptr = nullptr;
+            if (slopes.has_value()) {
+                check_same_shape(*slopes, values, "slopes");
+                slopes_ptr = slopes->mutable_data();
+            }
+
+            interp_points_input input = parse_interp_points(interp_points, 3);
+            py::array_t<double> result = make_output(out, input.shape, input.size);
+            double * out_ptr = result.mutable_data();
+
+            auto xs_info = points[0].request(),
+                 ys_info = points[1].request(),
+                 zs_info = heights.request(),
+                 values_info = values.request();
+            double * xs_ptr = (double *) xs_info.ptr,
+                   * ys_ptr = (double *) ys_info.ptr,
+                   * zs_ptr = (double *) zs_info.ptr,
+                   * values_ptr = (double *) values_info.ptr;
+            size_t data_x_N = points[0].size(),
+                   data_y_N = points[1].size(),
+                   data_z_N = heights.shape(2);
+
+            std::vector<slice<double>> grid = {
+                {data_x_N, xs_ptr},
+                {data_y_N, ys_ptr}
+            };
+
+            {
+                py::gil_scoped_release release;
+
+                interpolate_blocks(
+                    grid, input, out_ptr, sort_points, max_threads,
+                    [&](double * block_points, double * block_out, size_t n) {
+                        interpolate_3d_columns(
+                            xs_ptr, data_x_N, ys_ptr, data_y_N, zs_ptr, data_z_N,
+                            values_ptr, block_points, block_out, n, fill_value,
+                            slopes_ptr
+                        );
+                    }
+                );
+            }
+
+            return result;
+        },
+        R"pbdoc(
+            Interpolator over a rectilinear horizontal grid where each column
+            has its own height profile, e.g. the native terrain-following
+            levels of a weather model. The horizontal cell is found from the
+            grid spacing and the height is bracketed in each of the four
+            surrounding columns; the column values are then combined
+            bilinearly.
+
+            :param points: Tuple of the two horizontal axis coordinates.
+            :param heights: 3D array of the height of each grid node, increasing
+                along the last axis.
+            :param values: 3D array containing the grid point values.
+            :param interp_points: List of points to interpolate, should have
+                dimension (x, 3), or a tuple of 3 coordinate arrays, see
+                `interpolate`.
+            :param fill_value: The value to return for interpolation points
+                  outside of the grid range.
+            :param max_threads: Limit the number of threads to a certain amount.
+                0 uses one thread per core.
+            :param sort_points: Interpolate the points grouped by horizontal
+                grid tile and scatter the results back, see `interpolate`.
+            :param out: Optional array to write the result to, see
+                `interpolate`.
+            :param slopes: Derivatives of 'values' along the columns from
+                `pchip_slopes`. If given, the columns are interpolated with a
+                monotone cubic spline instead of linearly.
+        )pbdoc",
+        py::arg("points"),
+        py::arg("heights"),
+        py::arg("values"),
+        py::arg("interp_points"),
+        py::arg("fill_value") = std::nullopt,
+        py::arg("max_threads") = 0,
+        py::arg("sort_points") = false,
+        py::arg("out") = std::nullopt,
+        py::arg("slopes") = std::nullopt
+    );
+
+    m.def("pchip_slopes", [](
+            py::array_t<double, py::array::c_style> heights,
+            py::array_t<double, py::array::c_style> values,
+            size_t max_threads
+        ) {
+            if (values.ndim() == 0) {
+                throw py::type_error("Only arrays are supported, not scalar values!");
+            }
+            size_t data_z_N = values.shape(values.ndim() - 1);
+            bool shared_zs = heights.ndim() == 1;
+            if (shared_zs) {
+                if ((size_t) heights.shape(0) != data_z_N) {
+                    throw py::type_error("'heights' must have one element per level!");
+                }
+            } else {
+                check_same_shape(heights, values, "heights");
+            }
+
+            py::array_t<double> slopes(std::vector<ssize_t>(
+                values.shape(), values.shape() + values.ndim()
+            ));
+            const double * zs_ptr = heights.data(),
+                         * values_ptr = values.data();
+            double * slopes_ptr = slopes.mutable_data();
+            size_t num_columns = data_z_N == 0 ? 0 : values.size() / data_z_N;
+
+            {
+                py::gil_scoped_release release;
+
+                parallel_for(num_columns, INTERP_BLOCK_SIZE / std::max(data_z_N, (size_t) 1), max_threads,
+                    [&](size_t begin, size_t end) {
+                        for (size_t column = begin; column < end; column++) {
+                            size_t offset = column * data_z_N;
+                            pchip_slopes(
+                                &zs_ptr[shared_zs ? 0 : offset],
+                                &values_ptr[offset],
+                                data_z_N,
+                                &slopes_ptr[offset]
+                            );
+                        }
+                    }
+                );
+            }
+
+            return slopes;
+        },
+        R"pbdoc(
+            Derivatives along the last axis for monotone cubic (PCHIP)
+            interpolation, to pass as 'slopes' to `interpolate` or
+            `interpolate_columns`. They only depend on the grid, so they are
+            computed once and reused for every call.
+
+            :param heights: The coordinates along the last axis, either 1D or
+                with the same shape as 'values'. Must be increasing.
+            :param values: The grid point values.
+            :param max_threads: Limit the number of threads to a certain amount.
+                0 uses one thread per core.
+        )pbdoc",
+        py::arg("heights"),
+        py::arg("values"),
+        py::arg("max_threads") = 0
+    );
+
+    m.def("integrate_rays", [](
+            std::vector<py::array_t<double, py::array::c_style>> points,
+            py::array_t<double, py::array::c_style> values,
+            std::vector<py::array_t<double, py::array::c_style | py::array::forcecast>> rays,
+            double step,
+            std::optional<py::array_t<double, py::array::c_style>> heights,
+            size_t max_threads
+        ) {
+            size_t num_axes = heights.has_value() ? 2 : 3;
+            if (points.size() != num_axes) {
+                throw py::type_error(heights.has_value()
+                    ? "'points' must be a list of the two horizontal axes!"
+                    : "'points' must be a list of the three grid axes!");
+            }
+            for (auto arr : points) {
+                if (arr.ndim() != 1) {
+                    throw py::type_error("'points' must be a list of 1D arrays!");
+                }
+            }
+            if (values.ndim() != 3) {
+                throw py::type_error("'values' must be a 3D array!");
+            }
+            if (heights.has_value()) {
+                check_same_shape(*heights, values, "heights");
+            }
+            for (size_t i = 0; i < num_axes; i++) {
+                if (values.shape(i) != points[i].size()) {
+                    std::stringstream ss;
+                    ss << "Dimension mismatch at axis " << i << "! 'points' is "
+                       << points[i].size() << " but 'values' is "
+                       << values.shape(i) << "!";
+                    throw py::type_error(ss.str());
+                }
+            }
+            if (rays.size() != 3) {
+                throw py::type_error("'rays' must be a tuple of 3 coordinate arrays!");
+            }
+            for (auto &arr : rays) {
+                bool same = arr.ndim() == rays[0].ndim();
+                for (ssize_t i = 0; same && i < arr.ndim(); i++) {
+                    same = arr.shape(i) == rays[0].shape(i);
+                }
+                if (!same) {
+                    throw py::type_error("The 'rays' coordinate arrays must have the same shape!");
+                }
+            }
+            if (rays[0].ndim() == 0) {
+                throw py::type_error("Only arrays are supported, not scalar values!");
+            }
+
+            size_t num_samples = rays[0].shape(rays[0].ndim() - 1);
+            size_t num_rays = num_samples == 0 ? 0 : rays[0].size() / num_samples;
+            py::array_t<double> result(std::vector<ssize_t>(
+                rays[0].shape(), rays[0].shape() + rays[0].ndim() - 1
+            ));
+            double * out_ptr = result.mutable_data();
+
+            grid_3d grid;
+            grid.xs = points[0].mutable_data();
+            grid.x_N = points[0].size();
+            grid.ys = points[1].mutable_data();
+            grid.y_N = points[1].size();
+            grid.columns = heights.has_value();
+            grid.zs = grid.columns ? heights->mutable_data() : points[2].mutable_data();
+            grid.z_N = values.shape(2);
+            grid.ws = values.mutable_data();
+            const double * coords[3] = {rays[0].data(), rays[1].data(), rays[2].data()};
+
+            {
+                py::gil_scoped_release release;
+
+                // Rays cross on the order of a hundred cells each
+                parallel_for(num_rays, INTERP_BLOCK_SIZE / 128, max_threads,
+                    [&](size_t begin, size_t end) {
+                        const double * block_coords[3];
+                        for (size_t dim = 0; dim < 3; dim++) {
+                            block_coords[dim] = coords[dim] + begin * num_samples;
+                        }
+                        integrate_rays(
+                            grid, block_coords, end - begin, num_samples, step,
+                            &out_ptr[begin]
+                        );
+                    }
+                );
+            }
+
+            return result;
+        },
+        R"pbdoc(
+            Integral of the linearly interpolated grid along paths of evenly
+            spaced points, e.g. the samples of a line of sight. The path is
+            taken as straight between consecutive points and every grid cell
+            it crosses is integrated exactly, since the interpolated field is
+            a cubic polynomial along a straight line within a cell. The result
+            therefore does not depend on the sampling rate beyond how well the
+            points follow the path.
+
+            :param points: Tuple of the three grid axes, or of the two
+                horizontal axes if 'heights' is given.
+            :param values: 3D array containing the grid point values.
+            :param rays: Tuple of 3 coordinate arrays of the same shape, the
+                last axis running along each path.
+            :param step: Distance between consecutive points of a path. The
+                result is in units of 'values' times units of 'step'.
+            :param heights: 3D array of the height of each grid node for a
+                grid with one height profile per column, see
+                `interpolate_columns`.
+            :param max_threads: Limit the number of threads to a certain amount.
+                0 uses one thread per core.
+
+            Points outside of the grid contribute nothing to the integral. The
+            result has the shape of the ray coordinates without their last
+            axis.
+        )pbdoc",
+        py::arg("points"),
+        py::arg("values"),
+        py::arg("rays"),
+        py::arg("step"),
+        py::arg("heights") = std::nullopt,
+        py::arg("max_threads") = 0
     );
 
     m.def("interpolate_along_axis", [](
@@ -324,15 +780,9 @@ PYBIND11_MODULE(interpolate, m) {
                 }
             }
 
-            size_t num_threads = std::max((size_t) 1, max_threads);
-
             if (axis_in < 0) { axis_in += dimensions; }
             if (axis_in >= dimensions || axis_in < 0) {
                 throw py::type_error("'axis' out of range!");
-            } else if (axis_in == 0 && max_threads > 1) {
-                throw std::runtime_error(
-                    "Cannot interpolate along axis 0 with multiple threads!"
-                );
             }
             size_t axis = (size_t) axis_in;
 
@@ -370,96 +820,42 @@ PYBIND11_MODULE(interpolate, m) {
 
             py::buffer_info out_info = out_array.request();
 
-            num_threads = std::min(num_threads, (size_t) points_info.shape[0]);
-
-            size_t thread_stride = points_info.shape[0] / num_threads;
-            if (thread_stride * num_threads < points_info.shape[0]) {
-                thread_stride += 1;
-            }
-
-
-            if (num_threads == 1) {
-                interpolate_1d_along_axis(
-                    std::move(points_info),
-                    std::move(values_info),
-                    std::move(interp_points_info),
-                    std::move(out_info),
-                    axis,
-                    fill_value,
-                    assume_sorted
-                );
-            } else {
-                std::vector<std::future<void>> tasks;
-
-                for (size_t i = 0; i < num_threads; i++) {
-                    size_t index = i * thread_stride;
-                    if (index >= points_info.shape[0]) {
-                        break;
-                    }
-                    size_t num_elements =
-                        index + thread_stride < points_info.shape[0]
-                        ? thread_stride : points_info.shape[0] - index;
+            {
+                py::gil_scoped_release release;
 
-                    if (num_elements == 0) {
-                        break;
-                    }
-
-                    std::vector<ssize_t> points_view_shape(points_info.shape);
-                    points_view_shape[0] = num_elements;
-                    py::buffer_info points_view_info(
-                        (unsigned char *) points_info.ptr + index * points_info.strides[0],
-                        points_info.itemsize,
-                        points_info.format,
-                        points_info.ndim,
-                        points_view_shape,
-                        std::vector<ssize_t>(points_info.strides)
-                    );
-                    std::vector<ssize_t> values_view_shape(values_info.shape);
-                    values_view_shape[0] = num_elements;
-                    py::buffer_info values_view_info(
-                        (unsigned char *) values_info.ptr + index * values_info.strides[0],
-                        values_info.itemsize,
-                        values_info.format,
-                        values_info.ndim,
-                        values_view_shape,
-                        std::vector<ssize_t>(values_info.strides)
-                    );
-                    std::vector<ssize_t> interp_points_view_shape(interp_points_info.shape);
-                    interp_points_view_shape[0] = num_elements;
-                    py::buffer_info interp_points_view_info(
-                        (unsigned char *) interp_points_info.ptr + index * interp_points_info.strides[0],
-                        interp_points_info.itemsize,
-                        interp_points_info.format,
-                        interp_points_info.ndim,
-                        interp_points_view_shape,
-                        std::vector<ssize_t>(interp_points_info.strides)
-                    );
-                    std::vector<ssize_t> out_view_shape(out_info.shape);
-                    out_view_shape[0] = num_elements;
-                    py::buffer_info out_view_info(
-                        (unsigned char *) out_info.ptr + index * out_info.strides[0],
-                        out_info.itemsize,
-                        out_info.format,
-                        out_info.ndim,
-                        out_view_shape,
-                        std::vector<ssize_t>(out_info.strides)
+                if (dimensions == 1) {
+                    interpolate_1d_along_axis(
+                        points_info,
+                        values_info,
+                        interp_points_info,
+                        out_info,
+                        axis,
+                        fill_value,
+                        assume_sorted
                     );
-                    tasks.push_back(
-                        std::async(
-                            &interpolate_1d_along_axis,
-                            std::move(points_view_info),
-                            std::move(values_view_info),
-                            std::move(interp_points_view_info),
-                            std::move(out_view_info),
-                            axis,
-                            fill_value,
-                            assume_sorted
-                        )
+                } else {
+                    // Split the work along the outermost dimension that is not
+                    // being interpolated over, in blocks of roughly
+                    // INTERP_BLOCK_SIZE output elements.
+                    size_t split = axis == 0 ? 1 : 0;
+                    size_t split_size = (size_t) interp_points_info.shape[split];
+                    size_t block_size = INTERP_BLOCK_SIZE * split_size
+                        / std::max(interp_points_size, (size_t) 1);
+
+                    parallel_for(split_size, block_size, max_threads,
+                        [&](size_t begin, size_t end) {
+                            interpolate_1d_along_axis(
+                                buffer_view(points_info, split, begin, end),
+                                buffer_view(values_info, split, begin, end),
+                                buffer_view(interp_points_info, split, begin, end),
+                                buffer_view(out_info, split, begin, end),
+                                axis,
+                                fill_value,
+                                assume_sorted
+                            );
+                        }
                     );
                 }
-                for (auto &future : tasks) {
-                    std::move(future);
-                }
             }
 
             return out_array;
@@ -481,6 +877,7 @@ PYBIND11_MODULE(interpolate, m) {
           :param assume_sorted: Enable optimization when the list of interpolation
                 points is sorted along the axis of interpolation.
           :param max_threads: Limit the number of threads to a certain amount.
+                0 uses one thread per core.
         )pbdoc",
         py::arg("points"),
         py::arg("values"),
@@ -488,7 +885,7 @@ PYBIND11_MODULE(interpolate, m) {
         py::arg("axis") = -1,
         py::arg("fill_value") = std::nullopt,
         py::arg("assume_sorted") = false,
-        py::arg("max_threads") = 8,
+        py::arg("max_threads") = 0,
         py::return_value_policy::move
     );
 }
@@ -2,6 +2,7 @@
 #include <catch2/catch.hpp>
 
 #include "interpolate.h"
+#include "thread_pool.h"
 
 
 TEST_CASE( "test_bisect_left", "[bisect_left]" ) {
@@ -21,3 +22,97 @@ TEST_CASE( "test_find_left", "[find_left]" ) {
     REQUIRE( find_left(list.begin(), list.end(), 3.99) == 3 );
     REQUIRE( find_left(list.begin(), list.end(), 4.2) == 4 );
 }
+
+TEST_CASE( "test_find_arithmetic", "[find_arithmetic]" ) {
+    std::vector<double> list = {1., 2., 3.5, 4.};
+    REQUIRE( find_arithmetic(list.data(), list.size(), 0.5) == 0 );
+    REQUIRE( find_arithmetic(list.data(), list.size(), 1.5) == 1 );
+    REQUIRE( find_arithmetic(list.data(), list.size(), 2.1) == 2 );
+    REQUIRE( find_arithmetic(list.data(), list.size(), 3.99) == 3 );
+    REQUIRE( find_arithmetic(list.data(), list.size(), 4.2) == 4 );
+}
+
+TEST_CASE( "test_parallel_for", "[parallel_for]" ) {
+    for (size_t threads : {0, 1, 3, 64}) {
+        std::vector<int> counts(1000, 0);
+        parallel_for(counts.size(), 7, threads, [&](size_t begin, size_t end) {
+            for (size_t i = begin; i < end; i++) {
+                counts[i] += 1;
+            }
+        });
+        for (int count : counts) {
+            REQUIRE( count == 1 );
+        }
+    }
+}
+
+TEST_CASE( "test_parallel_for_exception", "[parallel_for]" ) {
+    REQUIRE_THROWS_AS(
+        parallel_for(100, 1, 4, [](size_t begin, size_t end) {
+            if (begin == 50) {
+                throw std::runtime_error("error");
+            }
+        }),
+        std::runtime_error
+    );
+}
+
+TEST_CASE( "test_spatial_order", "[spatial_order]" ) {
+    std::vector<double> xs(32), ys(32);
+    for (size_t i = 0; i < 32; i++) {
+        xs[i] = i;
+        ys[i] = i;
+    }
+    std::vector<slice<double>> grid = {{32, xs.data()}, {32, ys.data()}};
+    // Alternate between opposite corners of the grid
+    std::vector<double> points = {
+        1., 1., 0.,
+        30., 30., 0.,
+        2., 2., 0.,
+        29., 29., 0.,
+        3., 3., 0.
+    };
+
+    std::vector<size_t> order = spatial_order(grid, points.data(), 3, 5);
+    REQUIRE( order == std::vector<size_t>({0, 2, 4, 1, 3}) );
+}
+
+TEST_CASE( "test_pchip_slopes", "[pchip_slopes]" ) {
+    std::vector<double> xs = {0., 1., 3., 4.};
+    std::vector<double> ds(4);
+
+    // Linear data has constant slopes
+    std::vector<double> linear = {1., 3., 7., 9.};
+    pchip_slopes(xs.data(), linear.data(), 4, ds.data());
+    for (double d : ds) {
+        REQUIRE( d == Approx(2.) );
+    }
+
+    // Flat at local extrema
+    std::vector<double> peak = {0., 1., 0., 1.};
+    pchip_slopes(xs.data(), peak.data(), 4, ds.data());
+    REQUIRE( ds[1] == 0. );
+    REQUIRE( ds[2] == 0. );
+}
+
+TEST_CASE( "test_integrate_segment", "[integrate_rays]" ) {
+    std::vector<double> xs = {0., 1., 3.}, ys = {0., 2.}, zs = {0., 1., 2., 4.};
+    // w = x * y * z, a cubic along any line through the grid
+    std::vector<double> ws(3 * 2 * 4);
+    for (size_t i = 0; i < 3; i++) {
+        for (size_t j = 0; j < 2; j++) {
+            for (size_t k = 0; k < 4; k++) {
+                ws[(i * 2 + j) * 4 + k] = xs[i] * ys[j] * zs[k];
+            }
+        }
+    }
+    grid_3d grid = {xs.data(), 3, ys.data(), 2, zs.data(), 4, ws.data(), false};
+
+    // Along (t, t, t) the interpolant is exactly t^3
+    double p0[3] = {0., 0., 0.}, p1[3] = {2., 2., 2.};
+    REQUIRE( integrate_segment(grid, p0, p1) == Approx(2.) );
+
+    // Entirely outside of the grid
+    double p2[3] = {5., 1., 1.}, p3[3] = {6., 1., 1.};
+    REQUIRE( integrate_segment(grid, p2, p3) == 0. );
+}
@@ -0,0 +1,168 @@
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+//
+// Author: Rohan Weeden
+// Copyright 2020, by the California Institute of Technology. ALL RIGHTS
+// RESERVED. United States Government Sponsorship acknowledged.
+//
+// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <deque>
+#include <exception>
+#include <functional>
+#include <mutex>
+#include <thread>
+
+#ifndef _WIN32
+#include <unistd.h>
+#endif
+
+#ifndef PY_FAST_INTERP_THREAD_POOL_H
+#define PY_FAST_INTERP_THREAD_POOL_H
+
+// Number of threads to use when the caller asks for 0 ("all of them").
+inline size_t default_num_threads() {
+    size_t n = std::thread::hardware_concurrency();
+    return n == 0 ? 1 : n;
+}
+
+// Process wide pool of worker threads. The workers are started the first time
+// they are needed and then kept alive, so repeated interpolation calls don't
+// pay for thread creation. The pool grows to the largest thread count that
+// has been requested so far.
+class ThreadPool {
+    struct State {
+        size_t num_workers = 0;
+        std::deque<std::function<void()>> queue;
+        std::mutex mutex;
+        std::condition_variable cv;
+    };
+
+    State * state = new State();
+#ifndef _WIN32
+    pid_t owner = getpid();
+#endif
+
+    ThreadPool() = default;
+
+    static void worker_loop(State * state) {
+        while (true) {
+            std::function<void()> job;
+            {
+                std::unique_lock<std::mutex> lock(state->mutex);
+                state->cv.wait(lock, [state] { return !state->queue.empty(); });
+                job = std::move(state->queue.front());
+                state->queue.pop_front();
+            }
+            job();
+        }
+    }
+
+    void ensure_workers(size_t num_workers) {
+#ifndef _WIN32
+        // Threads don't survive a fork (e.g. a multiprocessing pool), and the
+        // parent's lock may have been held at the time, so a child process
+        // starts over with a fresh state. The old one is intentionally leaked.
+        if (owner != getpid()) {
+            state = new State();
+            owner = getpid();
+        }
+#endif
+        std::lock_guard<std::mutex> lock(state->mutex);
+        for (; state->num_workers < num_workers; state->num_workers++) {
+            std::thread(&ThreadPool::worker_loop, state).detach();
+        }
+    }
+
+public:
+    // Never destroyed: the detached workers may still be waiting on the
+    // queue when the interpreter shuts down.
+    static ThreadPool &instance() {
+        static ThreadPool * pool = new ThreadPool();
+        return *pool;
+    }
+
+    // Call task(i) for every i in [0, num_tasks) using at most num_threads
+    // threads, one of which is the calling thread, and wait for all of them
+    // to finish. The first exception thrown by a task is rethrown here.
+    void run(
+        size_t num_tasks,
+        size_t num_threads,
+        const std::function<void(size_t)> &task
+    ) {
+        num_threads = std::min(num_threads, num_tasks);
+        if (num_threads <= 1) {
+            for (size_t i = 0; i < num_tasks; i++) {
+                task(i);
+            }
+            return;
+        }
+        ensure_workers(num_threads - 1);
+
+        std::atomic<size_t> next(0);
+        std::exception_ptr error;
+        size_t remaining = num_threads - 1;
+        std::mutex done_mutex;
+        std::condition_variable done_cv;
+
+        auto work = [&]() {
+            size_t i;
+            while ((i = next.fetch_add(1)) < num_tasks) {
+                try {
+                    task(i);
+                } catch (...) {
+                    std::lock_guard<std::mutex> lock(done_mutex);
+                    if (!error) {
+                        error = std::current_exception();
+                    }
+                    // Skip the remaining tasks
+                    next = num_tasks;
+                }
+            }
+        };
+
+        {
+            std::lock_guard<std::mutex> lock(state->mutex);
+            for (size_t i = 0; i < num_threads - 1; i++) {
+                state->queue.push_back([&]() {
+                    work();
+                    std::lock_guard<std::mutex> lock(done_mutex);
+                    remaining--;
+                    done_cv.notify_one();
+                });
+            }
+        }
+        state->cv.notify_all();
+
+        work();
+
+        std::unique_lock<std::mutex> lock(done_mutex);
+        done_cv.wait(lock, [&] { return remaining == 0; });
+        if (error) {
+            std::rethrow_exception(error);
+        }
+    }
+};
+
+// Split [0, num_items) into blocks of block_size items and call
+// func(begin, end) for each of them on the shared thread pool. A thread count
+// of 0 means one thread per hardware core.
+template<typename F>
+void parallel_for(size_t num_items, size_t block_size, size_t max_threads, F func) {
+    if (num_items == 0) {
+        return;
+    }
+    block_size = std::max(block_size, (size_t) 1);
+    size_t num_blocks = (num_items + block_size - 1) / block_size;
+    size_t num_threads = max_threads == 0 ? default_num_threads() : max_threads;
+
+    ThreadPool::instance().run(num_blocks, num_threads, [&](size_t block) {
+        size_t begin = block * block_size;
+        size_t end = std::min(begin + block_size, num_items);
+        func(begin, end);
+    });
+}
+
+#endif